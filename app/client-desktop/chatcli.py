@@ -1,6 +1,7 @@
 import socket
 import os
 import json
+from framing import FrameBuffer
 
 TARGET_IP = os.getenv("SERVER_IP") or "127.0.0.1"
 TARGET_PORT = os.getenv("SERVER_PORT") or "8889"
@@ -13,6 +14,7 @@ class ChatClient:
         print(TARGET_PORT)
         self.server_address = (TARGET_IP,int(TARGET_PORT))
         self.sock.connect(self.server_address)
+        self.frames = FrameBuffer(b'\r\n\r\n')
         self.tokenid=""
     def proses(self,cmdline):
         j=cmdline.split(" ")
@@ -24,9 +26,7 @@ class ChatClient:
                 return self.login(username,password)
             elif (command=='send'):
                 usernameto = j[1].strip()
-                message=""
-                for w in j[2:]:
-                   message="{} {}" . format(message,w)
+                message = " ".join(j[2:])
                 return self.sendmessage(usernameto,message)
             elif (command=='inbox'):
                 return self.inbox()
@@ -37,15 +37,9 @@ class ChatClient:
     def sendstring(self,string):
         try:
             self.sock.sendall(string.encode())
-            receivemsg = ""
-            while True:
-                data = self.sock.recv(64)
-                print("diterima dari server",data)
-                if (data):
-                    receivemsg = "{}{}" . format(receivemsg,data.decode())  #data harus didecode agar dapat di operasikan dalam bentuk string
-                    if receivemsg[-4:]=='\r\n\r\n':
-                        print("end of string")
-                        return json.loads(receivemsg)
+            receivemsg = self.frames.read_frame(self.sock)
+            print("diterima dari server",receivemsg)
+            return json.loads(receivemsg)
         except:
             self.sock.close()
             return { 'status' : 'ERROR', 'message' : 'Gagal'}
@@ -60,7 +54,7 @@ class ChatClient:
     def sendmessage(self,usernameto="xxx",message="xxx"):
         if (self.tokenid==""):
             return "Error, not authorized"
-        string="send {} {} {} \r\n" . format(self.tokenid,usernameto,message)
+        string="send {} {} {}\r\n" . format(self.tokenid,usernameto,message)
         print(string)
         result = self.sendstring(string)
         if result['status']=='OK':
@@ -3,10 +3,14 @@ import json
 import base64
 import json
 import os
+import hashlib
 from chat import Chat
+from framing import FrameBuffer
 
 TARGET_IP = "127.0.0.1"
 TARGET_PORT = 8889
+# ukuran potongan upload file (byte sebelum base64)
+UPLOAD_CHUNK = 256 * 1024
 
 
 class ChatClient:
@@ -14,8 +18,19 @@ class ChatClient:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_address = (TARGET_IP, TARGET_PORT)
         self.sock.connect(self.server_address)
+        self.frames = FrameBuffer(b"\r\n\r\n")
         self.tokenid = ""
         self.username = ""
+        # upload yang belum selesai: (mode, tujuan, filepath, checksum) -> upload_id
+        self.uploads = {}
+
+    def reconnect(self):
+        # session di server tetap berlaku, cukup buka koneksi baru
+        self.sock.close()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(self.server_address)
+        self.frames = FrameBuffer(b"\r\n\r\n")
+        return "Tersambung kembali"
 
     def proses(self, cmdline):
         j = cmdline.split(" ")
@@ -38,9 +53,7 @@ class ChatClient:
                 return self.add_realm(realmid, realm_address, realm_port)
             elif command == "send":
                 usernameto = j[1].strip()
-                message = ""
-                for w in j[2:]:
-                    message = "{} {}".format(message, w)
+                message = " ".join(j[2:])
                 return self.send_message(usernameto, message)
             elif command == "sendfile":
                 usernameto = j[1].strip()
@@ -48,9 +61,7 @@ class ChatClient:
                 return self.send_file(usernameto, filepath)
             elif command == "sendgroup":
                 usernamesto = j[1].strip()
-                message = ""
-                for w in j[2:]:
-                    message = "{} {}".format(message, w)
+                message = " ".join(j[2:])
                 return self.send_group_message(usernamesto, message)
             elif command == "sendgroupfile":
                 usernamesto = j[1].strip()
@@ -59,9 +70,7 @@ class ChatClient:
             elif command == "sendrealm":
                 realmid = j[1].strip()
                 usernameto = j[2].strip()
-                message = ""
-                for w in j[3:]:
-                    message = "{} {}".format(message, w)
+                message = " ".join(j[3:])
                 return self.send_realm_message(realmid, usernameto, message)
             elif command == "sendfilerealm":
                 realmid = j[1].strip()
@@ -71,9 +80,7 @@ class ChatClient:
             elif command == "sendgrouprealm":
                 realmid = j[1].strip()
                 usernamesto = j[2].strip()
-                message = ""
-                for w in j[3:]:
-                    message = "{} {}".format(message, w)
+                message = " ".join(j[3:])
                 return self.send_group_realm_message(realmid, usernamesto, message)
             elif command == "sendgroupfilerealm":
                 realmid = j[1].strip()
@@ -82,11 +89,19 @@ class ChatClient:
                 return self.send_group_file_realm(realmid, usernamesto, filepath)
             elif command == "inbox":
                 return self.get_inbox()
+            elif command == "download":
+                blob_id = j[1].strip()
+                filepath = j[2].strip()
+                return self.download(blob_id, filepath)
+            elif command == "reconnect":
+                return self.reconnect()
             elif command == "realminbox":
                 realmid = j[1].strip()
                 return self.get_realm_inbox(realmid)
             elif command == "logout":
                 return self.logout()
+            elif command == "logoutall":
+                return self.logout_all()
             elif command == "info":
                 return self.info()
             else:
@@ -97,13 +112,8 @@ class ChatClient:
     def sendstring(self, string):
         try:
             self.sock.sendall(string.encode())
-            receivedmsg = ""
-            while True:
-                data = self.sock.recv(1024)
-                if data:
-                    receivedmsg = "{}{}".format(receivedmsg, data.decode())
-                    if receivedmsg[-4:] == "\r\n\r\n":
-                        return json.loads(receivedmsg)
+            receivedmsg = self.frames.read_frame(self.sock)
+            return json.loads(receivedmsg)
         except:
             self.sock.close()
             return {"status": "ERROR", "message": "Gagal"}
@@ -142,14 +152,47 @@ class ChatClient:
         else:
             return "Error, {}".format(result["message"])
 
-    def send_file(self, usernameto, filepath):
-        if os.path.exists(filepath):
-            with open(filepath, "rb") as file:
-                encoded_file = base64.b64encode(file.read()).decode()
-            string = "sendfile {} {} {} {}\r\n".format(
-                self.tokenid, usernameto, filepath, encoded_file
+    def upload_file(self, mode, tujuan, filepath):
+        # file dikirim per potongan (upload-begin, upload-chunk, upload-commit),
+        # sehingga memori tetap kecil berapa pun ukuran file
+        size = os.path.getsize(filepath)
+        checksum = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            for potongan in iter(lambda: file.read(UPLOAD_CHUNK), b""):
+                checksum.update(potongan)
+        key = (mode, tujuan, filepath, checksum.hexdigest())
+        result = {"status": "ERROR"}
+        if key in self.uploads:
+            # upload sebelumnya terputus, lanjutkan dari offset yang sudah diterima server
+            result = self.sendstring("upload-status {} {}\r\n".format(self.tokenid, self.uploads[key]))
+        if result["status"] != "OK":
+            string = "upload-begin {} {} {} {} {} {}\r\n".format(
+                self.tokenid, mode, tujuan, filepath, size, checksum.hexdigest()
             )
             result = self.sendstring(string)
+            if result["status"] != "OK":
+                return result
+            self.uploads[key] = result["upload_id"]
+        upload_id = result["upload_id"]
+        offset = result["offset"]
+        with open(filepath, "rb") as file:
+            file.seek(offset)
+            for potongan in iter(lambda: file.read(UPLOAD_CHUNK), b""):
+                string = "upload-chunk {} {} {} {}\r\n".format(
+                    self.tokenid, upload_id, offset, base64.b64encode(potongan).decode()
+                )
+                result = self.sendstring(string)
+                if result["status"] != "OK":
+                    return result
+                offset = result["offset"]
+        result = self.sendstring("upload-commit {} {}\r\n".format(self.tokenid, upload_id))
+        if result["status"] == "OK":
+            del self.uploads[key]
+        return result
+
+    def send_file(self, usernameto, filepath):
+        if os.path.exists(filepath):
+            result = self.upload_file("user", usernameto, filepath)
             if result["status"] == "OK":
                 return "File berhasil dikirim"
             else:
@@ -167,12 +210,7 @@ class ChatClient:
 
     def send_group_file(self, usernamesto, filepath):
         if os.path.exists(filepath):
-            with open(filepath, "rb") as file:
-                encoded_file = base64.b64encode(file.read()).decode()
-            string = "sendgroupfile {} {} {} {}\r\n".format(
-                self.tokenid, usernamesto, filepath, encoded_file
-            )
-            result = self.sendstring(string)
+            result = self.upload_file("group", usernamesto, filepath)
             if result["status"] == "OK":
                 return "File grup berhasil dikirim"
             else:
@@ -238,6 +276,26 @@ class ChatClient:
         else:
             return "Error, {}".format(result["message"])
 
+    def download(self, blob_id, filepath):
+        # inbox hanya berisi blob_id dan size; isi file diunduh terpisah ke .part
+        # dan dilanjutkan dari ukuran .part bila download sebelumnya terputus
+        partial = filepath + ".part"
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        try:
+            self.sock.sendall("download {} {} {}\r\n".format(self.tokenid, blob_id, offset).encode())
+            result = json.loads(self.frames.read_frame(self.sock))
+            if result["status"] == "OK":
+                with open(partial, "ab") as fh:
+                    self.frames.read_raw(self.sock, result["count"], fh)
+                os.replace(partial, filepath)
+        except:
+            self.sock.close()
+            return "Error, Gagal"
+        if result["status"] == "OK":
+            return "File tersimpan di {}".format(filepath)
+        else:
+            return "Error, {}".format(result["message"])
+
     def get_realm_inbox(self, realmid):
         string = "realminbox {} {} \r\n".format(self.tokenid, realmid)
         result = self.sendstring(string)
@@ -255,6 +313,15 @@ class ChatClient:
         else:
             return "Error, {}".format(result["message"])
 
+    def logout_all(self):
+        string = "logoutall {} \r\n".format(self.tokenid)
+        result = self.sendstring(string)
+        if result["status"] == "OK":
+            self.tokenid = ""
+            return "Logout dari {} session".format(result["message"])
+        else:
+            return "Error, {}".format(result["message"])
+
     def info(self):
         string = "info {} \r\n"
         result = self.sendstring(string)
@@ -293,7 +360,10 @@ if __name__ == "__main__":
         12. Melihat pesan: inbox\n
         13. Melihat pesan realm: realminbox [nama_realm]\n
         14. Logout: logout\n
-        15. Melihat user yang aktif: info\n"""
+        15. Melihat user yang aktif: info\n
+        16. Mengunduh file dari inbox: download [blob_id] [path tujuan]\n
+        17. Menyambung ulang koneksi (upload/download yang terputus dilanjutkan saat diulang): reconnect\n
+        18. Logout dari semua perangkat: logoutall\n"""
         )
         cmdline = input("Command {}:".format(cc.tokenid))
         print(cc.proses(cmdline))
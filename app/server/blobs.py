@@ -0,0 +1,124 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+from os.path import join
+
+BLOB_ID = re.compile(r'[0-9a-f]{64}')
+
+
+class FileReply:
+    # Balasan download: server menulis header lalu isi file langsung dari disk (socket.sendfile),
+    # tanpa memuat file ke memori. header diisi oleh lapisan protokol sesuai mode koneksi.
+    def __init__(self, fh, offset, count, meta):
+        self.fh = fh
+        self.offset = offset
+        self.count = count
+        self.meta = meta
+        self.header = b''
+
+
+class BlobStore:
+    # File lampiran disimpan sekali dengan nama hash sha256 isinya, sehingga file yang sama
+    # (misalnya dikirim ke group) hanya ditulis satu kali. Jumlah referensi disimpan di <id>.ref;
+    # blob dihapus saat referensi terakhir dilepas.
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.refs = {}
+
+    def path(self, blob_id):
+        return join(self.directory, blob_id)
+
+    def tulis_tmp(self, path, content):
+        # ditulis ke file sementara dulu lalu di-rename, pembaca tidak pernah melihat file setengah jadi
+        tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as fh:
+            fh.write(content)
+        return tmp
+
+    def simpan(self, content, refs=1):
+        blob_id = hashlib.sha256(content).hexdigest()
+        path = self.path(blob_id)
+        tmp = None
+        if not os.path.exists(path):
+            tmp = self.tulis_tmp(path, content)
+        with self.lock:
+            if tmp is not None:
+                os.replace(tmp, path)
+            elif not os.path.exists(path):
+                # blob yang sama baru saja dihapus oleh release()
+                os.replace(self.tulis_tmp(path, content), path)
+            self.ubah_ref(blob_id, refs)
+        return blob_id
+
+    def pindahkan(self, tmp, blob_id, refs=1):
+        # file yang sudah lengkap di disk (hasil upload) dijadikan blob tanpa dibaca ulang;
+        # tmp harus berada di filesystem yang sama agar os.replace atomik
+        with self.lock:
+            if os.path.exists(self.path(blob_id)):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, self.path(blob_id))
+            self.ubah_ref(blob_id, refs)
+        return blob_id
+
+    def tautkan(self, src, blob_id, refs=1):
+        # blob milik shard lain (mode multi-proses) dijadikan blob di sini lewat hard link, tanpa menyalin
+        # isinya; referensinya dihitung terpisah di tiap shard. Disalin bila beda filesystem
+        if not BLOB_ID.fullmatch(blob_id):
+            raise FileNotFoundError(blob_id)
+        path = self.path(blob_id)
+        with self.lock:
+            if not os.path.exists(path):
+                tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copyfile(src, tmp)
+                os.replace(tmp, path)
+            self.ubah_ref(blob_id, refs)
+        return blob_id
+
+    def open(self, blob_id):
+        # file yang sudah dibuka tetap bisa dibaca walaupun blob dihapus di tengah download
+        if not BLOB_ID.fullmatch(blob_id):
+            raise FileNotFoundError(blob_id)
+        return open(self.path(blob_id), 'rb')
+
+    def read(self, blob_id):
+        with open(self.path(blob_id), 'rb') as fh:
+            return fh.read()
+
+    def acquire(self, blob_id, refs=1):
+        with self.lock:
+            self.ubah_ref(blob_id, refs)
+
+    def release(self, blob_id):
+        with self.lock:
+            self.ubah_ref(blob_id, -1)
+
+    def ubah_ref(self, blob_id, delta):
+        # dipanggil dengan self.lock dipegang
+        path = self.path(blob_id)
+        count = self.refs.get(blob_id)
+        if count is None:
+            try:
+                with open(path + '.ref', 'rb') as fh:
+                    count = int(fh.read())
+            except (OSError, ValueError):
+                count = 0
+        count += delta
+        if count > 0:
+            self.refs[blob_id] = count
+            os.replace(self.tulis_tmp(path + '.ref', str(count).encode()), path + '.ref')
+            return
+        self.refs.pop(blob_id, None)
+        for sisa in (path, path + '.ref'):
+            try:
+                os.remove(sisa)
+            except FileNotFoundError:
+                pass
@@ -3,17 +3,40 @@ import json
 import base64
 import json
 import os
+import hashlib
 from chat import Chat
+from framing import FrameBuffer
+from protocol import BinaryFrameBuffer, COMMANDS, PUSH, encode_frame
 
 TARGET_IP = "127.0.0.1"
 TARGET_PORT = 8889
+# ukuran potongan upload file (byte sebelum base64)
+UPLOAD_CHUNK = 256 * 1024
 
 class ChatClient:
     def __init__(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_address = (TARGET_IP,TARGET_PORT)
         self.sock.connect(self.server_address)
+        self.frames = FrameBuffer(b'\r\n\r\n')
+        self.binary = None
+        self.cursor = 0
+        self.pushed = []
+        #upload yang belum selesai: (mode, tujuan, filepath, checksum) -> upload_id, untuk dilanjutkan
+        self.uploads = {}
         self.tokenid=""
+
+    def reconnect(self):
+        #session di server tetap berlaku, jadi cukup buka koneksi baru (dan negosiasi ulang protokol biner)
+        self.sock.close()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(self.server_address)
+        self.frames = FrameBuffer(b'\r\n\r\n')
+        if self.binary is not None:
+            self.binary = None
+            return self.use_binary()
+        return "tersambung kembali"
+
     def proses(self,cmdline):
         j=cmdline.split(" ")
         try:
@@ -41,9 +64,7 @@ class ChatClient:
                 return self.join_group(groupname)
             elif (command=='send'):
                 usernameto = j[1].strip()
-                message=""
-                for w in j[2:]:
-                    message="{} {}" . format(message,w)
+                message = " ".join(j[2:])
                 return self.send_message(usernameto,message)
             elif (command=='sendfile'):
                 usernameto = j[1].strip()
@@ -51,9 +72,7 @@ class ChatClient:
                 return self.send_file(usernameto,filepath)
             elif (command=='sendgroup'):
                 groupname = j[1].strip()
-                message=""
-                for w in j[2:]:
-                    message="{} {}" . format(message,w)
+                message = " ".join(j[2:])
                 return self.send_group_message(groupname,message)
             elif (command=='sendgroupfile'):
                 groupname = j[1].strip()
@@ -62,9 +81,7 @@ class ChatClient:
             elif (command == 'sendprivaterealm'):
                 realmid = j[1].strip()
                 username_to = j[2].strip()
-                message = ""
-                for w in j[3:]:
-                    message = "{} {}".format(message, w)
+                message = " ".join(j[3:])
                 return self.send_realm_message(realmid, username_to, message)
             elif (command=='sendfilerealm'):
                 realmid = j[1].strip()
@@ -74,9 +91,7 @@ class ChatClient:
             elif (command=='sendgrouprealm'):
                 realmid = j[1].strip()
                 usernamesto = j[2].strip()
-                message=""
-                for w in j[3:]:
-                    message="{} {}" . format(message,w)
+                message = " ".join(j[3:])
                 return self.send_group_realm_message(realmid, usernamesto,message)
             elif (command=='sendgroupfilerealm'):
                 realmid = j[1].strip()
@@ -84,12 +99,30 @@ class ChatClient:
                 filepath = j[3].strip()
                 return self.send_group_file_realm(realmid, usernamesto,filepath)
             elif (command=='inbox'):
-                return self.inbox()
+                cursor = j[1].strip() if len(j) > 1 else ""
+                return self.inbox(cursor)
+            elif (command=='subscribe'):
+                return self.subscribe()
+            elif (command=='pushed'):
+                return self.get_pushed()
+            elif (command=='inboxwait'):
+                timeout = j[1].strip() if len(j) > 1 else ""
+                return self.inbox_wait(timeout)
+            elif (command=='download'):
+                blob_id = j[1].strip()
+                filepath = j[2].strip()
+                return self.download(blob_id, filepath)
+            elif (command=='reconnect'):
+                return self.reconnect()
             elif (command == 'getrealminbox'):
                 realmid = j[1].strip()
                 return self.realm_inbox(realmid)
+            elif (command=='binary'):
+                return self.use_binary()
             elif (command=='logout'):
                 return self.logout()
+            elif (command=='logoutall'):
+                return self.logout_all()
             elif (command=='info'):
                 return self.info()
             else:
@@ -98,17 +131,38 @@ class ChatClient:
             return "-Maaf, command tidak benar"
 
     def sendstring(self,string):
+        if self.binary is not None:
+            return self.sendframe('text', {}, string.encode())
         try:
             self.sock.sendall(string.encode())
-            receivemsg = ""
             while True:
-                data = self.sock.recv(1024)
-                print("diterima dari server",data)
-                if (data):
-                    receivemsg = "{}{}" . format(receivemsg,data.decode())  #data harus didecode agar dapat di operasikan dalam bentuk string
-                    if receivemsg[-4:]=='\r\n\r\n':
-                        print("end of string")
-                        return json.loads(receivemsg)
+                receivemsg = self.frames.read_frame(self.sock)
+                print("diterima dari server",receivemsg)
+                result = json.loads(receivemsg)
+                #frame push bisa datang di sela balasan bila koneksi sudah subscribe
+                if 'push' not in result:
+                    return result
+                self.pushed.append(result)
+        except:
+            self.sock.close()
+            return { 'status' : 'ERROR', 'message' : 'Gagal'}
+
+    def use_binary(self):
+        result = self.sendstring("protocol binary\r\n")
+        if result['status']=='OK':
+            self.binary = BinaryFrameBuffer()
+            return "protokol biner aktif"
+        else:
+            return "Error, {}" . format(result['message'])
+
+    def sendframe(self, command, meta, blob=b''):
+        try:
+            self.sock.sendall(encode_frame(COMMANDS[command], self.tokenid, meta, blob))
+            while True:
+                opcode, sessionid, result, blob = self.binary.read_frame(self.sock)
+                if opcode != PUSH:
+                    return result
+                self.pushed.append(result)
         except:
             self.sock.close()
             return { 'status' : 'ERROR', 'message' : 'Gagal'}
@@ -156,7 +210,7 @@ class ChatClient:
     def send_message(self,usernameto="xxx",message="xxx"):
         if (self.tokenid==""):
             return "Error, not authorized"
-        string="send {} {} {} \r\n" . format(self.tokenid,usernameto,message)
+        string="send {} {} {}\r\n" . format(self.tokenid,usernameto,message)
         print(string)
         result = self.sendstring(string)
         if result['status']=='OK':
@@ -171,17 +225,57 @@ class ChatClient:
         if not os.path.exists(filepath):
             return {'status': 'ERROR', 'message': 'File not found'}
         
-        with open(filepath, 'rb') as file:
-            file_content = file.read()
-            encoded_content = base64.b64encode(file_content)  # Decode byte-string to UTF-8 string
-        string="sendfile {} {} {} {}\r\n" . format(self.tokenid,usernameto,filepath,encoded_content)
-
-        result = self.sendstring(string)
+        result = self.upload_file('user', usernameto, filepath)
         if result['status']=='OK':
             return "file sent to {}" . format(usernameto)
         else:
             return "Error, {}" . format(result['message'])
 
+    def upload_file(self, mode, tujuan, filepath):
+        #file dikirim per potongan (upload-begin, upload-chunk, upload-commit), tidak pernah dimuat utuh ke memori
+        size = os.path.getsize(filepath)
+        checksum = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for potongan in iter(lambda: file.read(UPLOAD_CHUNK), b''):
+                checksum.update(potongan)
+        meta = {'mode': mode, 'tujuan': tujuan, 'filepath': filepath, 'size': size, 'checksum': checksum.hexdigest()}
+        key = (mode, tujuan, filepath, meta['checksum'])
+        result = {'status': 'ERROR'}
+        if key in self.uploads:
+            #upload sebelumnya terputus: tanya server sudah sampai byte ke berapa lalu lanjutkan
+            if self.binary is not None:
+                result = self.sendframe('upload-status', {'upload_id': self.uploads[key]})
+            else:
+                result = self.sendstring("upload-status {} {}\r\n" . format(self.tokenid, self.uploads[key]))
+        if result['status']!='OK':
+            if self.binary is not None:
+                result = self.sendframe('upload-begin', meta)
+            else:
+                result = self.sendstring("upload-begin {} {} {} {} {} {}\r\n" . format(self.tokenid, mode, tujuan, filepath, size, meta['checksum']))
+            if result['status']!='OK':
+                return result
+            self.uploads[key] = result['upload_id']
+        upload_id = result['upload_id']
+        offset = result['offset']
+        with open(filepath, 'rb') as file:
+            file.seek(offset)
+            for potongan in iter(lambda: file.read(UPLOAD_CHUNK), b''):
+                if self.binary is not None:
+                    #mode biner: potongan dikirim apa adanya tanpa base64
+                    result = self.sendframe('upload-chunk', {'upload_id': upload_id, 'offset': offset}, potongan)
+                else:
+                    result = self.sendstring("upload-chunk {} {} {} {}\r\n" . format(self.tokenid, upload_id, offset, base64.b64encode(potongan).decode()))
+                if result['status']!='OK':
+                    return result
+                offset = result['offset']
+        if self.binary is not None:
+            result = self.sendframe('upload-commit', {'upload_id': upload_id})
+        else:
+            result = self.sendstring("upload-commit {} {}\r\n" . format(self.tokenid, upload_id))
+        if result['status']=='OK':
+            del self.uploads[key]
+        return result
+
     def send_realm_message(self, realmid, username_to, message):
         if (self.tokenid==""):
             return "Error, not authorized"
@@ -211,7 +305,7 @@ class ChatClient:
     def send_group_message(self,groupname="xxx",message="xxx"):
         if (self.tokenid==""):
             return "Error, not authorized"
-        string="sendgroup {} {} {} \r\n" . format(self.tokenid,groupname,message)
+        string="sendgroup {} {} {}\r\n" . format(self.tokenid,groupname,message)
         print(string)
         result = self.sendstring(string)
         if result['status']=='OK':
@@ -226,13 +320,7 @@ class ChatClient:
         if not os.path.exists(filepath):
             return {'status': 'ERROR', 'message': 'File not found'}
         
-        with open(filepath, 'rb') as file:
-            file_content = file.read()
-            encoded_content = base64.b64encode(file_content)  # Decode byte-string to UTF-8 string
-
-        string="sendgroupfile {} {} {} {}\r\n" . format(self.tokenid,groupname,filepath, encoded_content)
-
-        result = self.sendstring(string)
+        result = self.upload_file('group', groupname, filepath)
         if result['status']=='OK':
             return "file sent to {}" . format(groupname)
         else:
@@ -241,7 +329,7 @@ class ChatClient:
     def send_group_realm_message(self, realmid, usernames_to, message):
         if self.tokenid=="":
             return "Error, not authorized"
-        string="sendgrouprealm {} {} {} {} \r\n" . format(self.tokenid, realmid, usernames_to, message)
+        string="sendgrouprealm {} {} {} {}\r\n" . format(self.tokenid, realmid, usernames_to, message)
 
         result = self.sendstring(string)
         if result['status']=='OK':
@@ -267,16 +355,94 @@ class ChatClient:
         else:
             return "Error {}".format(result['message'])
 
-    def inbox(self):
+    def inbox(self, cursor=""):
         if (self.tokenid==""):
             return "Error, not authorized"
-        string="inbox {} \r\n" . format(self.tokenid)
+        string="inbox {} {}\r\n" . format(self.tokenid, cursor)
         result = self.sendstring(string)
         if result['status']=='OK':
             return "{}" . format(json.dumps(result['messages']))
         else:
             return "Error, {}" . format(result['message'])
 
+    def subscribe(self):
+        if (self.tokenid==""):
+            return "Error, not authorized"
+        result = self.sendstring("subscribe {}\r\n" . format(self.tokenid))
+        if result['status']=='OK':
+            return "pesan baru akan dikirim langsung oleh server"
+        else:
+            return "Error, {}" . format(result['message'])
+
+    def get_pushed(self):
+        #push yang sudah tiba di socket tapi belum terbaca ikut diambil tanpa menunggu
+        self.sock.setblocking(False)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                if self.binary is not None:
+                    self.pushed.extend(frame[2] for frame in self.binary.feed(data))
+                else:
+                    self.pushed.extend(json.loads(frame) for frame in self.frames.feed(data))
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.setblocking(True)
+        pushed, self.pushed = self.pushed, []
+        return "{}" . format(json.dumps(pushed))
+
+    def inbox_wait(self, timeout=""):
+        if (self.tokenid==""):
+            return "Error, not authorized"
+        #server menahan balasan sampai ada pesan baru atau timeout, jadi tidak perlu polling
+        string="inbox-wait {} {} {}\r\n" . format(self.tokenid, self.cursor, timeout)
+        result = self.sendstring(string)
+        if result['status']=='OK':
+            self.cursor = result['cursor']
+            return "{}" . format(json.dumps(result['messages']))
+        else:
+            return "Error, {}" . format(result['message'])
+
+    def download(self, blob_id, filepath):
+        if (self.tokenid==""):
+            return "Error, not authorized"
+        #file ditulis ke .part dulu; bila .part sudah ada (download terputus), lanjutkan dari ukurannya
+        partial = filepath + '.part'
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        try:
+            if self.binary is not None:
+                self.sock.sendall(encode_frame(COMMANDS['download'], self.tokenid, {'blob_id': blob_id, 'offset': offset}))
+                while True:
+                    opcode, sessionid, result, blob = self.binary.read_frame(self.sock)
+                    if opcode != PUSH:
+                        break
+                    self.pushed.append(result)
+                if result['status']=='OK':
+                    with open(partial, 'ab') as fh:
+                        fh.write(blob)
+            else:
+                self.sock.sendall("download {} {} {}\r\n" . format(self.tokenid, blob_id, offset).encode())
+                while True:
+                    result = json.loads(self.frames.read_frame(self.sock))
+                    if 'push' not in result:
+                        break
+                    self.pushed.append(result)
+                if result['status']=='OK':
+                    #isi file menyusul tepat sebanyak count byte setelah header
+                    with open(partial, 'ab') as fh:
+                        self.frames.read_raw(self.sock, result['count'], fh)
+            if result['status']=='OK':
+                os.replace(partial, filepath)
+        except:
+            self.sock.close()
+            return "Error, Gagal"
+        if result['status']=='OK':
+            return "file {} disimpan di {}" . format(blob_id, filepath)
+        else:
+            return "Error, {}" . format(result['message'])
+
     def realm_inbox(self, realmid):
         if (self.tokenid==""):
             return "Error, not authorized"
@@ -298,6 +464,15 @@ class ChatClient:
         else:
             return "Error, {}" . format(result['message'])
 
+    def logout_all(self):
+        string="logoutall {}\r\n".format(self.tokenid)
+        result = self.sendstring(string)
+        if result['status']=='OK':
+            self.tokenid=""
+            return "Logout dari {} session" . format(result['message'])
+        else:
+            return "Error, {}" . format(result['message'])
+
     def info(self):
         string="info \r\n"
         result = self.sendstring(string)
@@ -324,9 +499,15 @@ if __name__=="__main__":
         9. Mengirim file ke group: sendgroupfile [usernames to] [filename]\n
         10. Mengirim pesan ke group realm: sendgrouprealm [name_realm] [usernames to] [message]\n
         11. Mengirim file ke group realm: sendgroupfilerealm [name_realm] [usernames to] [filename]\n
-        12. Melihat pesan: inbox\n
+        12. Melihat pesan: inbox [cursor (opsional, seq terakhir yang sudah dibaca)]\n
         13. Melihat pesan realm: realminbox [nama_realm]\n
         14. Logout: logout\n
-        15. Melihat user yang aktif: info\n""")
+        15. Melihat user yang aktif: info\n
+        16. Pindah ke protokol biner (file tanpa base64): binary\n
+        17. Menunggu pesan baru: inboxwait [timeout detik]\n
+        18. Berlangganan push pesan baru: subscribe, lalu lihat dengan: pushed\n
+        19. Mengunduh file dari inbox: download [blob_id] [path tujuan]\n
+        20. Menyambung ulang koneksi (upload/download yang terputus dilanjutkan saat diulang): reconnect\n
+        21. Logout dari semua perangkat: logoutall\n""")
         cmdline = input("Command {}:" . format(cc.tokenid))
         print(cc.proses(cmdline))
\ No newline at end of file
@@ -1,239 +1,736 @@
 import base64
 import os
 from os.path import join, dirname, realpath
+from urllib.parse import quote, unquote
 import json
-import uuid
 import logging
 from queue import  Queue
+from collections import deque
 import threading 
 import socket
+import time
 import shutil
-from datetime import datetime
+from framing import FrameBuffer
+from dispatcher import CommandRegistry, daftar_username
+from mailboxes import PendingReply
+from push import PushHub
+from wal import WriteAheadLog, WALError
+from store import buat_store
+from messages import Message
+from blobs import BlobStore, FileReply
+from uploads import UploadManager, UploadError, UPLOAD_CHUNK_MAX
+from spool import RealmSpool, node_id
+from locks import StripedLock
+from sessions import SessionManager
+from shards import ShardRouter, SHARD_INDEX, per_shard
+
+INBOX_WAIT_TIMEOUT = float(os.getenv("INBOX_WAIT_TIMEOUT") or "30")
+INBOX_WAIT_MAX = float(os.getenv("INBOX_WAIT_MAX") or "300")
+# command yang berjalan lebih lama dari COMMAND_SLOW_MS milidetik dicatat di log; 0 = tidak dicatat
+COMMAND_SLOW_MS = float(os.getenv("COMMAND_SLOW_MS") or "500")
+# WAL_DIR kosong = state hanya di memori seperti semula
+WAL_DIR = per_shard(os.getenv("WAL_DIR") or "")
+WAL_SYNC = (os.getenv("WAL_SYNC") or "1") == "1"
+WAL_FLUSH_MS = float(os.getenv("WAL_FLUSH_MS") or "5")
+WAL_SNAPSHOT_EVERY = int(os.getenv("WAL_SNAPSHOT_EVERY") or "10000")
+# batas waktu menunggu balasan realm untuk command yang butuh hasilnya (addrealm, getrealminbox)
+REALM_TIMEOUT = float(os.getenv("REALM_TIMEOUT") or "10")
+# link realm yang diam diuji dengan ping tiap REALM_PING_INTERVAL detik; reconnect memakai backoff
+# eksponensial antara REALM_RECONNECT_MIN dan REALM_RECONNECT_MAX detik
+REALM_PING_INTERVAL = float(os.getenv("REALM_PING_INTERVAL") or "15")
+REALM_RECONNECT_MIN = float(os.getenv("REALM_RECONNECT_MIN") or "0.5")
+REALM_RECONNECT_MAX = float(os.getenv("REALM_RECONNECT_MAX") or "30")
+# batas pesan realm yang belum di-ack per realm (di spool); di atas itu send*realm ditolak
+REALM_QUEUE_MAX = int(os.getenv("REALM_QUEUE_MAX") or "100000")
+# jumlah batch realm yang boleh dikirim tanpa menunggu balasan; sisanya menunggu di spool, bukan di memori
+REALM_WINDOW = int(os.getenv("REALM_WINDOW") or "8")
+# antrian keluar per realm dan id server ini
+REALM_SPOOL_DIR = per_shard(os.getenv("REALM_SPOOL_DIR") or join(dirname(realpath(__file__)), 'files', 'realm'))
+# pesan yang diteruskan ke realm dikumpulkan menjadi satu frame recvrealmbatch; dikirim saat
+# jumlah/ukuran batch tercapai atau REALM_BATCH_MS sejak pesan pertama
+REALM_BATCH_MS = float(os.getenv("REALM_BATCH_MS") or "5")
+REALM_BATCH_MAX = int(os.getenv("REALM_BATCH_MAX") or "128")
+REALM_BATCH_BYTES = int(os.getenv("REALM_BATCH_BYTES") or str(256 * 1024))
+# command yang boleh ada di dalam recvrealmbatch
+REALM_BATCH_COMMANDS = ('recvrealmprivatemsg', 'recvfilerealm', 'recvrealmgroupmsg', 'recvgroupfilerealm')
+# lampiran disimpan sekali per isi file, dengan nama hash sha256
+BLOB_DIR = per_shard(os.getenv("BLOB_DIR") or join(dirname(realpath(__file__)), 'files', 'blobs'))
+
+DECODE_STEP = 256 * 1024
+
+def decode_file(encoded_file):
+    # client lama mengirim repr bytes python (b'...'), client lain mengirim base64 polos
+    if encoded_file.startswith("b'") and encoded_file.endswith("'"):
+        encoded_file = encoded_file[2:-1]
+    if len(encoded_file) <= DECODE_STEP or len(encoded_file) % 4:
+        return base64.b64decode(encoded_file)
+    # file besar di-decode per potongan (kelipatan 4 karakter): GIL dilepas di antara potongan sehingga
+    # worker pool lain (send/inbox) tidak menunggu satu decode panjang
+    return b''.join(base64.b64decode(encoded_file[i:i + DECODE_STEP]) for i in range(0, len(encoded_file), DECODE_STEP))
+
+def teruskan(data, command, username_from=None):
+    # ganti nama command (dan session pengirim) tanpa memecah isi pesan yang diteruskan ke realm lain
+    if username_from is None:
+        data = "{} {}".format(command, data.split(" ", 1)[1])
+    else:
+        data = "{} {} {}".format(command, username_from, data.split(" ", 2)[2])
+    if not data.endswith("\r\n"):
+        data += "\r\n"
+    return data
+
+def baca_cursor(cursor):
+    # cursor inbox: "<seq inbox>" atau "<seq inbox>,<group>=<seq>,..." (nama group di-quote); group yang
+    # tidak disebut dibaca dari posisi user saat bergabung
+    bagian = str(cursor).split(",")
+    groups = {}
+    for item in bagian[1:]:
+        groupname, seq = item.rsplit("=", 1)
+        groups[unquote(groupname)] = int(seq)
+    return int(bagian[0]), groups
+
+def tulis_cursor(seq, groups):
+    # tanpa group tetap berupa angka seperti semula
+    if not groups:
+        return seq
+    return ",".join([str(seq)] + ["{}={}".format(quote(groupname, safe=''), posisi) for groupname, posisi in sorted(groups.items())])
+
+def batch_valid(commands):
+    # isi recvrealmbatch: {'node': str, 'items': [[id bilangan bulat, command], ...]}
+    if not isinstance(commands, dict) or not isinstance(commands.get('node'), str) or not isinstance(commands.get('items'), list):
+        return False
+    return all(isinstance(item, list) and len(item) == 2 and type(item[0]) is int and isinstance(item[1], str)
+               for item in commands['items'])
+
+# balasan pengganti untuk request yang tidak pernah sampai ke tujuan
+REALM_GAGAL = {'status': 'ERROR', 'message': 'Gagal'}
+REALM_TERPUTUS = {'status': 'ERROR', 'message': 'Realm Tidak Terhubung'}
+
+class RealmReply:
+    # balasan realm yang belum datang; diisi oleh thread pembaca link realm
+    def __init__(self, callback=None):
+        self.event = threading.Event()
+        self.hasil = None
+        # callback(hasil) dipanggil di thread pembaca, untuk request yang tidak ditunggu
+        self.callback = callback
+
+    def set(self, hasil):
+        self.hasil = hasil
+        self.event.set()
+        if self.callback is not None:
+            self.callback(hasil)
+
+    def wait(self, timeout=REALM_TIMEOUT):
+        if not self.event.wait(timeout):
+            return {'status': 'ERROR', 'message': 'Realm tidak merespon'}
+        return self.hasil
 
 class RealmThreadCommunication(threading.Thread):
-    def __init__(self, chats, realm_dest_address, realm_dest_port):
+    # Link ke server realm lain. Request dikirim lewat antrian oleh thread penulis tanpa menunggu
+    # balasan (pipelining); thread ini membaca balasan. Server tujuan membalas request satu koneksi
+    # sesuai urutan, jadi balasan dicocokkan dengan request menurut urutan kirim (FIFO).
+    # Pesan yang diteruskan (antri) ditulis ke RealmSpool di disk, lalu thread kumpulkan mengirimnya
+    # per batch (maksimal REALM_WINDOW batch belum dibalas) dan melepasnya dari spool setelah di-ack.
+    # Bila koneksi putus, thread ini menyambung ulang dengan backoff eksponensial, mengulang handshake
+    # (recvrealm), lalu semua pesan di spool yang belum di-ack dikirim ulang sesuai urutan id.
+    # Request yang menunggu hasil (sendstring) langsung gagal selama link putus.
+    # Server lama (mis. mesin2) membaca semua byte yang tertampung sampai \r\n terakhir sebagai satu
+    # command, jadi request yang dikirim berurutan tanpa menunggu akan bergabung. Karena itu setiap koneksi
+    # mulai tanpa pipelining (satu request menunggu balasannya) dan baru pipelining setelah tujuan
+    # membalas recvrealmbatch, yang hanya dikenal server yang memotong command per baris.
+    def __init__(self, chats, realm_id, realm_dest_address, realm_dest_port, handshake=None, spool=None):
         self.chats = chats
         self.chat = {}
+        # dipegang sekali oleh recvrealmbatch untuk seluruh isi batch; RLock karena put() ikut memakainya
+        self.chat_lock = threading.RLock()
+        # id pesan terakhir yang sudah diterapkan per server pengirim (dipakai dengan chat_lock), dan id
+        # pesan yang gagal karena shard penerima tidak tersedia: batch berikutnya ditolak sampai id itu dikirim ulang
+        self.applied = {}
+        self.tertahan = {}
+        self.realm_id = realm_id
         self.realm_dest_address = realm_dest_address
         self.realm_dest_port = realm_dest_port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.realm_dest_address, self.realm_dest_port))
-        threading.Thread.__init__(self)
+        self.sock = None
+        # outbox dan waiting berisi (data, RealmReply)
+        self.outbox = deque()
+        self.waiting = deque()
+        self.lock = threading.Condition()
+        # False: request berikutnya baru dikirim setelah balasan request sebelumnya datang
+        self.pipelining = False
+        # command recvrealm yang dikirim pertama kali di setiap koneksi baru
+        self.handshake = handshake
+        self.handshake_reply = RealmReply(self.cek_balasan)
+        self.backoff = REALM_RECONNECT_MIN
+        # jeda sebelum spool dikirim ulang setelah batch ditolak tujuan, naik dua kali lipat sampai REALM_RECONNECT_MAX
+        self.jeda = REALM_RECONNECT_MIN
+        self.bangun = threading.Event()
+        self.last_recv = time.monotonic()
+        self.spool = spool or RealmSpool(REALM_SPOOL_DIR, realm_id)
+        if handshake is not None:
+            self.spool.set_tujuan(realm_dest_address, realm_dest_port, handshake)
+        # id spool yang belum dikirim di koneksi ini; generasi naik setiap antrian diulang dari spool,
+        # balasan untuk batch dari generasi lama diabaikan
+        self.antrian = deque(self.spool.ids())
+        self.inflight = 0
+        self.generasi = 0
+        self.batch_cond = threading.Condition()
+        # dimatikan bila server tujuan versi lama belum mengenal recvrealmbatch
+        self.batching = True
+        # percobaan pertama langsung di sini seperti semula; bila gagal, thread ini yang mencoba lagi
+        try:
+            self.pasang(self.buka())
+        except OSError as e:
+            logging.warning("REALM {}:{} gagal terhubung: {}".format(realm_dest_address, realm_dest_port, e))
+        threading.Thread.__init__(self, daemon=True)
+        self.start()
+        threading.Thread(target=self.tulis, daemon=True).start()
+        threading.Thread(target=self.kumpulkan, daemon=True).start()
+        threading.Thread(target=self.detak, daemon=True).start()
+
+    def terhubung(self):
+        return self.sock is not None
+
+    def sambung(self, handshake, realm_dest_address, realm_dest_port):
+        # addrealm untuk realm yang link-nya putus: alamat boleh berubah, reconnect dicoba sekarang juga
+        self.spool.set_tujuan(realm_dest_address, realm_dest_port, handshake)
+        with self.lock:
+            self.handshake = handshake
+            self.realm_dest_address = realm_dest_address
+            self.realm_dest_port = realm_dest_port
+            self.handshake_reply = RealmReply(self.cek_balasan)
+            self.backoff = REALM_RECONNECT_MIN
+        self.bangun.set()
+        return self.handshake_reply
+
+    def kirim(self, string, callback=None):
+        # kembali segera setelah request masuk antrian; RealmReply bisa ditunggu bila hasilnya perlu
+        reply = RealmReply(callback)
+        with self.lock:
+            terputus = self.sock is None
+            if not terputus:
+                self.outbox.append((string, reply))
+                self.lock.notify_all()
+        if terputus:
+            reply.set(REALM_TERPUTUS)
+        return reply
 
     def sendstring(self, string):
+        return self.kirim(string).wait()
+
+    def antri(self, string):
+        # pesan yang diteruskan tanpa perlu balasan; False bila spool penuh
+        # (tujuan terlalu lama tidak bisa dihubungi)
+        with self.batch_cond:
+            if len(self.spool) >= REALM_QUEUE_MAX:
+                return False
+            self.antrian.append(self.spool.tambah(string))
+            self.batch_cond.notify()
+        return True
+
+    def ulang(self):
+        # dipanggil dengan batch_cond dipegang: semua yang belum di-ack dikirim lagi dari awal
+        self.generasi += 1
+        self.inflight = 0
+        self.antrian = deque(self.spool.ids())
+        self.batch_cond.notify()
+
+    def ulangi(self, generasi):
+        # batch lain dari generasi yang sama mungkin juga ditolak; cukup diulang sekali
+        with self.batch_cond:
+            if generasi == self.generasi and self.sock is not None:
+                self.jeda = min(self.jeda * 2, REALM_RECONNECT_MAX)
+                self.ulang()
+
+    def siap_kirim(self):
+        return self.antrian and self.sock is not None and self.inflight < REALM_WINDOW
+
+    def kumpulkan(self):
+        while True:
+            with self.batch_cond:
+                while not self.siap_kirim():
+                    self.batch_cond.wait()
+                batas = time.monotonic() + REALM_BATCH_MS / 1000
+                while len(self.antrian) < REALM_BATCH_MAX:
+                    sisa = batas - time.monotonic()
+                    if sisa <= 0:
+                        break
+                    self.batch_cond.wait(sisa)
+                # dimasukkan ke outbox sambil memegang batch_cond, urutan antar batch tetap terjaga
+                self.kirim_batch(self.ambil_batch())
+
+    def ambil_batch(self):
+        ids = []
+        total = 0
+        while self.antrian and len(ids) < REALM_BATCH_MAX and total < REALM_BATCH_BYTES:
+            msg_id = self.antrian.popleft()
+            try:
+                total += self.spool.panjang(msg_id)
+            except KeyError:
+                continue
+            ids.append(msg_id)
+        return ids
+
+    def kirim_batch(self, ids):
+        if not ids:
+            return
+        # pesan di-fsync sebelum dikirim, jadi yang sudah diterima tujuan pasti masih ada di spool setelah crash
+        self.spool.sync()
+        generasi = self.generasi
+        if not self.batching:
+            for msg_id in ids:
+                self.inflight += 1
+                self.kirim(self.spool.baca(msg_id), lambda hasil, ids=[msg_id]: self.cek_batch(generasi, ids, hasil))
+            return
+        # baris command di-encode JSON, sehingga \r\n di dalamnya tidak memotong frame
+        items = [[msg_id, self.spool.baca(msg_id).rstrip("\r\n")] for msg_id in ids]
+        data = "recvrealmbatch {} {}\r\n".format(self.realm_id, json.dumps({'node': self.chats.node, 'items': items}))
+        self.inflight += 1
+        self.kirim(data, lambda hasil: self.cek_batch(generasi, ids, hasil))
+
+    def cek_batch(self, generasi, ids, hasil):
+        with self.batch_cond:
+            if generasi != self.generasi:
+                return
+            self.inflight -= 1
+            self.batch_cond.notify()
+            if hasil is REALM_GAGAL or hasil is REALM_TERPUTUS:
+                # koneksi putus; antrian diulang dari spool saat tersambung lagi
+                return
+            if self.batching and hasil.get('message') == '**Protocol Tidak Benar':
+                logging.warning("REALM {}: tujuan tidak mendukung recvrealmbatch, pesan dikirim satu per satu".format(self.realm_id))
+                self.batching = False
+                self.ulang()
+                return
+        if self.batching and hasil.get('status') != 'OK':
+            # batch ditolak seluruhnya (realm belum dikenal tujuan, shard penerima sedang restart): tidak di-ack,
+            # semua yang belum di-ack dikirim ulang dari spool setelah jeda
+            self.cek_balasan(hasil)
+            timer = threading.Timer(self.jeda, self.ulangi, (generasi,))
+            timer.daemon = True
+            timer.start()
+            return
+        self.jeda = REALM_RECONNECT_MIN
+        if self.batching and not self.pipelining:
+            # tujuan mengenal recvrealmbatch: request berikutnya di koneksi ini boleh dikirim tanpa menunggu
+            with self.lock:
+                self.pipelining = True
+                self.lock.notify_all()
+        for item in hasil.get('results', [hasil]):
+            self.cek_balasan(item)
+        self.spool.ack(ids)
+
+    def cek_balasan(self, hasil):
+        if hasil.get('status') != 'OK':
+            logging.warning("REALM {}:{} membalas: {}".format(self.realm_dest_address, self.realm_dest_port, hasil))
+
+    def tulis(self):
+        while True:
+            with self.lock:
+                while self.sock is None or not self.outbox or (self.waiting and not self.pipelining):
+                    self.lock.wait()
+                item = self.outbox.popleft()
+                self.waiting.append(item)
+                sock = self.sock
+            try:
+                sock.sendall(item[0].encode())
+            except OSError as e:
+                # thread pembaca yang membereskan antrian dan menyambung ulang
+                logging.warning("REALM {}:{} gagal mengirim: {}".format(self.realm_dest_address, self.realm_dest_port, e))
+                self.putus(sock)
+
+    def putus(self, sock):
         try:
-            self.sock.sendall(string.encode())
-            receivedmsg = ""
-            while True:
-                data = self.sock.recv(1024)
-                print("diterima dari server", data)
-                if (data):
-                    receivedmsg = "{}{}" . format(receivedmsg, data.decode())  #data harus didecode agar dapat di operasikan dalam bentuk string
-                    if receivedmsg[-4:]=='\r\n\r\n':
-                        print("end of string")
-                        return json.loads(receivedmsg)
-        except:
-            self.sock.close()
-            return { 'status' : 'ERROR', 'message' : 'Gagal'}
-    
-    def put(self, message):
-        dest = message['msg_to']
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def detak(self):
+        # heartbeat: link yang diam diuji dengan ping; tanpa balasan apa pun selama REALM_TIMEOUT, koneksi diputus
+        while True:
+            time.sleep(REALM_PING_INTERVAL)
+            sock = self.sock
+            if sock is None or time.monotonic() - self.last_recv < REALM_PING_INTERVAL:
+                continue
+            self.kirim("ping\r\n").wait()
+            if self.sock is sock and time.monotonic() - self.last_recv > REALM_TIMEOUT:
+                logging.warning("REALM {}:{} tidak merespon ping".format(self.realm_dest_address, self.realm_dest_port))
+                self.putus(sock)
+
+    def buka(self):
+        sock = socket.create_connection((self.realm_dest_address, self.realm_dest_port), timeout=REALM_TIMEOUT)
+        sock.settimeout(None)
+        return sock
+
+    def hubungkan(self):
+        while True:
+            try:
+                return self.buka()
+            except OSError as e:
+                logging.warning("REALM {}:{} gagal terhubung, dicoba lagi dalam {}s: {}".format(
+                    self.realm_dest_address, self.realm_dest_port, self.backoff, e))
+            self.tunggu_backoff()
+
+    def tunggu_backoff(self):
+        self.bangun.wait(self.backoff)
+        self.bangun.clear()
+        self.backoff = min(self.backoff * 2, REALM_RECONNECT_MAX)
+
+    def pasang(self, sock):
+        with self.lock:
+            self.sock = sock
+            self.last_recv = time.monotonic()
+            self.pipelining = False
+            if self.handshake is not None:
+                reply = self.handshake_reply
+                if reply.event.is_set():
+                    reply = RealmReply(self.cek_balasan)
+                self.outbox.appendleft((self.handshake, reply))
+            self.lock.notify_all()
+        with self.batch_cond:
+            self.batch_cond.notify()
+        logging.warning("REALM {}:{} terhubung".format(self.realm_dest_address, self.realm_dest_port))
+
+    def run(self):
+        while True:
+            if self.sock is None:
+                self.pasang(self.hubungkan())
+            sock = self.sock
+            self.baca(sock)
+            with self.lock:
+                self.sock = None
+                gagal = [reply for data, reply in self.waiting] + [reply for data, reply in self.outbox]
+                self.waiting = deque()
+                self.outbox = deque()
+            sock.close()
+            with self.batch_cond:
+                self.ulang()
+            for reply in gagal:
+                reply.set(REALM_GAGAL)
+            self.tunggu_backoff()
+
+    def baca(self, sock):
+        frames = FrameBuffer(b'\r\n\r\n')
         try:
-            self.chat[dest].put(message)
-        except KeyError:
-            self.chat[dest]=Queue()
+            while True:
+                receivedmsg = frames.read_frame(sock)
+                if receivedmsg is None:
+                    break
+                try:
+                    hasil = json.loads(receivedmsg)
+                except ValueError:
+                    # balasan rusak tidak menghentikan link, cukup request ini yang gagal
+                    hasil = {'status': 'ERROR', 'message': 'Balasan realm tidak valid'}
+                with self.lock:
+                    self.last_recv = time.monotonic()
+                    self.backoff = REALM_RECONNECT_MIN
+                    reply = self.waiting.popleft()[1] if self.waiting else None
+                    # tanpa pipelining, thread penulis menunggu balasan ini
+                    self.lock.notify_all()
+                if reply is not None:
+                    reply.set(hasil)
+        except OSError as e:
+            logging.warning("REALM {}:{} terputus: {}".format(self.realm_dest_address, self.realm_dest_port, e))
+
+    def put(self, dest, message):
+        # dest: nama penerima; satu Message boleh masuk ke antrian beberapa penerima
+        with self.chat_lock:
+            if dest not in self.chat:
+                self.chat[dest] = Queue()
             self.chat[dest].put(message)
 
 class Chat:
+    # Model konkurensi: satu objek Chat dipakai bersama oleh semua thread handler, tanpa lock global.
+    # - Profil user (nama, negara, password, mailbox) tidak diubah setelah dibuat: dibaca tanpa lock.
+    # - Mailbox dan timeline group punya lock sendiri untuk append/since.
+    # - Cek-lalu-ubah (register, addgroup, joingroup, cursor inbox) memakai StripedLock per username
+    #   atau nama group, sehingga hanya request untuk key yang sama yang saling menunggu.
+    # - Daftar anggota group dan keanggotaan user diganti utuh saat berubah; pembaca memakai snapshot.
+    # - Antrian realm memakai chat_lock milik link realm, tabel realm memakai realm_lock.
+    # Mode multi-proses (SERVER_PROCESSES > 1): tiap proses punya Chat sendiri berisi user milik
+    # shard-nya (lihat ShardRouter). Pesan ke user/group di shard lain dikirim lewat RPC (shard_ops),
+    # group disimpan di shard pemiliknya dan disalin ke shard yang punya anggota group itu.
+    # Link realm masuk selalu dilayani shard pemilik realm_id (dedup per pengirim ada di sana); antrian
+    # realm user ada di shard pemilik user dan diisi/diambil lewat RPC realmput/realmchat.
     def __init__(self):
-        self.sessions={}
-        self.users = {}
-        self.group = {}
-        self.users['messi']={ 'nama': 'Lionel Messi', 'negara': 'Argentina', 'password': 'surabaya', 'incoming' : {}, 'outgoing': {}}
-        self.users['henderson']={ 'nama': 'Jordan Henderson', 'negara': 'Inggris', 'password': 'surabaya', 'incoming': {}, 'outgoing': {}}
-        self.users['lineker']={ 'nama': 'Gary Lineker', 'negara': 'Inggris', 'password': 'surabaya','incoming': {}, 'outgoing':{}}
+        self.shards = ShardRouter(int(SHARD_INDEX)) if SHARD_INDEX is not None else None
+        self.sessions = SessionManager(self.shards.milik if self.shards is not None else None)
+        self.user_locks = StripedLock()
+        self.group_locks = StripedLock()
+        self.realm_lock = threading.Lock()
+        self.blobs = BlobStore(BLOB_DIR)
+        # file upload sementara di bawah BLOB_DIR agar bisa di-rename menjadi blob
+        self.uploads = UploadManager(join(BLOB_DIR, 'uploads'))
+        self.store = buat_store(self.blobs)
+        self.users = self.store.users
+        self.group = self.store.group
+        for username, nama, negara in (('messi', 'Lionel Messi', 'Argentina'), ('henderson', 'Jordan Henderson', 'Inggris'),
+                                       ('lineker', 'Gary Lineker', 'Inggris')):
+            # di mode multi-proses user bawaan hanya dibuat di shard pemiliknya
+            if username not in self.users and self.shard_lain(username) is None:
+                self.store.add_user(username, 'surabaya', nama, negara)
         self.realms = {}
-    def proses(self,data):
-        j=data.split(" ")
+        self.node = node_id(REALM_SPOOL_DIR)
+        self.push = PushHub()
+        self.commands = CommandRegistry(self.sessions)
+        self.daftar_command()
+        if COMMAND_SLOW_MS > 0:
+            self.commands.add_hook(self.catat_lambat)
+        self.pulihkan_realm()
+        self.wal = None
+        # store sqlite sudah persisten sendiri, WAL hanya untuk store memori
+        if WAL_DIR and not self.store.persistent:
+            self.wal = WriteAheadLog(WAL_DIR, self.dump_state, WAL_FLUSH_MS / 1000, WAL_SNAPSHOT_EVERY)
+            self.pulihkan()
+            self.wal.start()
+        if self.shards is not None:
+            self.shard_ops = {
+                'pesan': self.terima_pesan,
+                'pesangroup': self.terima_group,
+                'addgroup': self.tambah_group,
+                'joingroup': self.tambah_anggota,
+                'cekuser': self.cek_user,
+                'cekgroup': self.cek_group,
+                'info': self.info_lokal,
+                'realm': self.buka_realm,
+                'recvrealm': self.terima_realm,
+                'realmput': self.terima_realm_put,
+                'realmchat': self.get_realm_chat,
+            }
+            self.shards.layani(self.rpc)
+
+    def pulihkan_realm(self):
+        # link realm yang spool-nya masih berisi pesan dibuat ulang agar pesan itu tetap terkirim
+        for name in sorted(os.listdir(REALM_SPOOL_DIR)):
+            if not name.endswith('.spool'):
+                continue
+            realm_id = unquote(name[:-len('.spool')])
+            spool = RealmSpool(REALM_SPOOL_DIR, realm_id)
+            if spool.tujuan is None or not len(spool):
+                continue
+            realm_dest_address, realm_dest_port, handshake = spool.tujuan
+            self.realms[realm_id] = RealmThreadCommunication(self, realm_id, realm_dest_address, realm_dest_port, handshake, spool)
+
+#   ===================== Persistensi (write-ahead log) =====================
+    def catat(self, record, sync=True):
+        if self.wal is not None:
+            self.wal.append(record, sync=sync and WAL_SYNC)
+
+    def dump_state(self):
+        # dipanggil dari thread WAL; salin daftar key dulu karena handler bisa menambah user/group
+        users = {}
+        for username in list(self.users):
+            user = self.users[username]
+            users[username] = {
+                'nama': user['nama'],
+                'negara': user['negara'],
+                'password': user['password'],
+                'incoming': user['incoming'].dump(),
+                'outgoing': user['outgoing'].dump(),
+            }
+        group = {}
+        for groupname in list(self.group):
+            g = self.group[groupname]
+            group[groupname] = {
+                'admin': g['admin'],
+                'members': list(g['members']),
+                'timeline': g['timeline'].dump(),
+                'cursors': {member: self.store.group_cursor(groupname, member) for member in g['members']},
+            }
+        return {'users': users, 'group': group}
+
+    def pulihkan(self):
+        snapshot, records = self.wal.load()
+        if snapshot is not None:
+            for username, user in snapshot['users'].items():
+                self.tambah_user(username, user['password'], user['nama'], user['negara'])
+                self.users[username]['incoming'].load(user['incoming'])
+                self.users[username]['outgoing'].load(user['outgoing'])
+            for groupname, group in snapshot['group'].items():
+                self.buat_group(groupname, group['admin'])
+                for member in group['members'][1:]:
+                    self.store.add_member(groupname, member)
+                if 'timeline' in group:
+                    self.group[groupname]['timeline'].load(group['timeline'])
+                for member, cursor in group.get('cursors', {}).items():
+                    self.store.set_group_cursor(groupname, member, cursor)
+        for record in records:
+            self.terapkan(record)
+        logging.warning("WAL: {} record diputar ulang" . format(len(records)))
+
+    def terapkan(self, record):
+        # replay harus idempoten: record bisa sudah tercakup di snapshot
+        op = record['op']
+        if op == 'register':
+            if record['username'] not in self.users:
+                self.tambah_user(record['username'], record['password'], record['nama'], record['negara'])
+        elif op == 'message':
+            message = Message.load(record['message'])
+            # pengirim di shard lain (mode multi-proses) mencatat outgoing-nya sendiri dengan op sent
+            if self.users[record['to']]['incoming'].restore(record['seq'], record['from'], message) and record['from'] in self.users:
+                self.users[record['from']]['outgoing'].append(record['to'], message)
+        elif op == 'sent':
+            self.users[record['from']]['outgoing'].restore(record['seq'], record['to'], Message.load(record['message']))
+        elif op == 'groupmessage':
+            self.group[record['group']]['timeline'].restore(record['seq'], record['from'], Message.load(record['message']))
+        elif op == 'groupcursor':
+            # log lama: cursor baca group dulu disimpan per anggota, sekarang per session / di cursor client
+            self.store.set_group_cursor(record['group'], record['username'], record['cursor'])
+        elif op == 'addgroup':
+            self.buat_group(record['group'], record['admin'])
+        elif op == 'joingroup':
+            if record['username'] not in self.group[record['group']]['members']:
+                self.store.add_member(record['group'], record['username'])
+
+    def daftar_command(self):
+        c = self.commands
+        c.register('auth', self.autentikasi_user, ['username', 'password'], session=False, route='username')
+        c.register('register', self.register_user, ['username', 'password', 'nama', 'negara'], session=False, route='username')
+        c.register('logout', self.logout, ['sessionid'], session=False)
+        c.register('logoutall', self.logout_all, ['sessionid'], user='username')
+        c.register('info', self.info, session=False)
+        c.register('ping', self.ping, session=False)
+#   ===================== Komunikasi dalam satu server =====================
+        c.register('addgroup', self.addgroup, ['sessionid', 'groupname'])
+        c.register('joingroup', self.joingroup, ['sessionid', 'groupname'])
+        c.register('send', self.send_message, ['sessionid', 'username_dest'], rest='message', limited=True)
+        c.register('sendgroup', self.send_group_message, ['sessionid', 'groupname'], rest='message', limited=True)
+        c.register('inbox', self.get_inbox, ['sessionid'], optional=['cursor'], user='username')
+        c.register('subscribe', self.subscribe, ['sessionid'], user='username')
+        c.register('inbox-wait', self.inbox_wait, ['sessionid'], optional=['cursor', 'timeout'],
+                   types={'timeout': float}, user='username')
+        c.register('sendfile', self.send_file, ['sessionid', 'username_dest', 'filepath', 'encoded_file'], heavy=True, limited=True)
+        c.register('sendgroupfile', self.send_group_file, ['sessionid', 'groupname', 'filepath', 'encoded_file'], heavy=True, limited=True)
+        c.register('upload-begin', self.upload_begin, ['sessionid', 'mode', 'tujuan', 'filepath', 'size', 'checksum'],
+                   types={'size': int})
+        c.register('upload-chunk', self.upload_chunk, ['sessionid', 'upload_id', 'offset', 'chunk'], types={'offset': int},
+                   heavy=True)
+        c.register('upload-commit', self.upload_commit, ['sessionid', 'upload_id'], heavy=True, limited=True)
+        c.register('upload-status', self.upload_status, ['sessionid', 'upload_id'])
+        c.register('download', self.download, ['sessionid', 'blob_id'], optional=['offset'], types={'offset': int}, user='username')
+#   ===================== Komunikasi dengan server lain =====================
+        c.register('addrealm', self.add_realm, ['realm_id', 'realm_dest_address', 'realm_dest_port'],
+                   types={'realm_dest_port': int}, session=False, raw=True, heavy=True)
+        c.register('recvrealm', self.recv_realm, ['realm_id', 'realm_dest_address', 'realm_dest_port'],
+                   types={'realm_dest_port': int}, session=False, raw=True, route='realm_id')
+        c.register('sendprivaterealm', self.send_realm_message, ['sessionid', 'realm_id', 'username_dest'], rest='message', raw=True, limited=True)
+        c.register('sendfilerealm', self.send_file_realm, ['sessionid', 'realm_id', 'username_dest', 'filepath', 'encoded_file'],
+                   raw=True, heavy=True, limited=True)
+        c.register('recvfilerealm', self.recv_file_realm, ['username_from', 'realm_id', 'username_dest', 'filepath', 'encoded_file'],
+                   session=False, raw=True, heavy=True, route='realm_id')
+        c.register('recvrealmprivatemsg', self.recv_realm_message, ['username_from', 'realm_id', 'username_dest'], rest='message',
+                   session=False, raw=True, route='realm_id')
+        c.register('sendgrouprealm', self.send_group_realm_message, ['sessionid', 'realm_id', 'usernames_to'], rest='message',
+                   types={'usernames_to': daftar_username}, raw=True, limited=True)
+        c.register('sendgroupfilerealm', self.send_group_file_realm, ['sessionid', 'realm_id', 'usernames_to', 'filepath', 'encoded_file'],
+                   types={'usernames_to': daftar_username}, raw=True, heavy=True, limited=True)
+        c.register('recvgroupfilerealm', self.recv_group_file_realm, ['username_from', 'realm_id', 'usernames_to', 'filepath', 'encoded_file'],
+                   types={'usernames_to': daftar_username}, session=False, raw=True, heavy=True, route='realm_id')
+        c.register('recvrealmgroupmsg', self.recv_group_realm_message, ['username_from', 'realm_id', 'usernames_to'], rest='message',
+                   types={'usernames_to': daftar_username}, session=False, raw=True, route='realm_id')
+        c.register('recvrealmbatch', self.recv_realm_batch, ['realm_id'], rest='commands', types={'commands': json.loads},
+                   session=False, heavy=True, route='realm_id')
+        c.register('getrealminbox', self.get_realm_inbox, ['sessionid', 'realmid'], user='username', heavy=True)
+        c.register('getrealmchat', self.get_realm_chat, ['realmid', 'username'], session=False, route='realmid')
+
+    def berat(self, name):
+        # command yang dijalankan server di worker pool berat (lihat Command.heavy)
+        command = self.commands.get(name)
+        return command is not None and command.heavy
+
+    def catat_lambat(self, name, durasi, hasil):
+        # hook CommandRegistry: durasi tiap command, hanya yang lambat yang ditulis ke log
+        if durasi * 1000 >= COMMAND_SLOW_MS:
+            logging.warning("LAMBAT: {} {:.1f} ms" . format(name.upper(), durasi * 1000))
+
+#   ===================== Shard (mode multi-proses) =====================
+    def shard_lain(self, key):
+        # shard lain pemilik user/group/token ini; None di mode satu proses atau bila milik shard ini
+        return None if self.shards is None else self.shards.tujuan(key)
+
+    def shard_teks(self, data):
+        # dipakai server sebelum command dijalankan: command milik shard lain tidak dijalankan di sini,
+        # koneksinya diserahkan ke shard itu
+        if self.shards is None:
+            return None
+        command = self.commands.get(data.split(" ", 1)[0].strip())
+        if command is None:
+            return None
+        kunci = command.kunci(data)
+        return self.shards.tujuan(kunci) if kunci else None
+
+    def shard_frame(self, command, sessionid, args):
+        if self.shards is None:
+            return None
+        command = self.commands.get(command)
+        if command is None or command.route is None:
+            return None
+        kunci = sessionid if command.route == 'sessionid' else args.get(command.route)
+        return self.shards.tujuan(kunci) if isinstance(kunci, str) and kunci else None
+
+    def rpc(self, request):
+        # permintaan dari shard lain (ShardRouter.panggil), satu method per op di shard_ops
+        op = self.shard_ops.get(request.get('op'))
+        if op is None:
+            return {'status': 'ERROR', 'message': '**Protocol Tidak Benar'}
         try:
-            command=j[0].strip()
-            if (command=='auth'):
-                username=j[1].strip()
-                password=j[2].strip()
-                logging.warning("AUTH: auth {} {}" . format(username,password))
-                return self.autentikasi_user(username,password)
-            
-            elif (command=='register'):
-                username=j[1].strip()
-                password=j[2].strip()
-                nama=j[3].strip()
-                negara=j[4].strip()
-                logging.warning("REGISTER: register {} {}" . format(username,password))
-                return self.register_user(username,password, nama, negara)
-            
-#   ===================== Komunikasi dalam satu server =====================            
-            elif (command=='addgroup'):
-                sessionid = j[1].strip()
-                groupname = j[2].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("ADDGROUP: session {} added group {}" . format(sessionid, groupname))
-                return self.addgroup(sessionid,usernamefrom,groupname)
-            elif (command == 'joingroup'):
-                sessionid = j[1].strip()
-                groupname = j[2].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("JOINGROUP: session {} added group {}" . format(sessionid, groupname))
-                return self.joingroup(sessionid, usernamefrom, groupname)
-            elif (command=='send'):
-                sessionid = j[1].strip()
-                usernameto = j[2].strip()
-                message=""
-                for w in j[3:]:
-                    message="{} {}" . format(message,w)
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SEND: session {} send message from {} to {}" . format(sessionid, usernamefrom,usernameto))
-                return self.send_message(sessionid,usernamefrom,usernameto,message)
-            elif (command=='sendgroup'):
-                sessionid = j[1].strip()
-                groupname = j[2].strip()
-                message=""
-                for w in j[3:]:
-                    message="{} {}" . format(message,w)
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SEND: session {} send message from {} to {}" . format(sessionid, groupname, usernamefrom,groupname))
-                return self.send_group_message(sessionid,groupname, usernamefrom,message)
-            elif (command=='inbox'):
-                sessionid = j[1].strip()
-                username = self.sessions[sessionid]['username']
-                logging.warning("INBOX: {}" . format(sessionid))
-                return self.get_inbox(username)
-            elif (command=='sendfile'):
-                sessionid = j[1].strip()
-                usernameto = j[2].strip()
-                filepath = j[3].strip()
-                encoded_file = j[4].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDFILE: session {} send file from {} to {}" . format(sessionid, usernamefrom, usernameto))
-                return self.send_file(sessionid, usernamefrom, usernameto, filepath, encoded_file)
-            elif (command=='sendgroupfile'):
-                sessionid = j[1].strip()
-                groupname = j[2].strip()
-                filepath = j[3].strip()
-                encoded_file = j[4].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDGROUPFILE: session {} send file from {} to {}" . format(sessionid, usernamefrom, groupname))
-                return self.send_group_file(sessionid, usernamefrom, groupname, filepath, encoded_file)
-
-
-  #   ===================== Komunikasi dengan server lain =====================           
-            elif (command=='addrealm'):
-                realm_id = j[1].strip()
-                realm_dest_address = j[2].strip()
-                realm_dest_port = int(j[3].strip())
-                return self.add_realm(realm_id, realm_dest_address, realm_dest_port, data)
-            elif (command=='recvrealm'):
-                realm_id = j[1].strip()
-                realm_dest_address = j[2].strip()
-                realm_dest_port = int(j[3].strip())
-                return self.recv_realm(realm_id, realm_dest_address, realm_dest_port, data)
-            elif (command == 'sendprivaterealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernameto = j[3].strip()
-                message = ""
-                for w in j[4:]:
-                    message = "{} {}".format(message, w)
-                print(message)
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDPRIVATEREALM: session {} send message from {} to {} in realm {}".format(sessionid, usernamefrom, usernameto, realm_id))
-                return self.send_realm_message(sessionid, realm_id, usernamefrom, usernameto, message, data)
-            elif (command == 'sendfilerealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernameto = j[3].strip()
-                filepath = j[4].strip()
-                encoded_file = j[5].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDFILEREALM: session {} send file from {} to {} in realm {}".format(sessionid, usernamefrom, usernameto, realm_id))
-                return self.send_file_realm(sessionid, realm_id, usernamefrom, usernameto, filepath, encoded_file, data)
-            elif (command == 'recvfilerealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernameto = j[3].strip()
-                filepath = j[4].strip()
-                encoded_file = j[5].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("RECVFILEREALM: session {} send file from {} to {} in realm {}".format(sessionid, usernamefrom, usernameto, realm_id))
-                return self.recv_file_realm(sessionid, realm_id, usernamefrom, usernameto, filepath, encoded_file, data)
-            elif (command == 'recvrealmprivatemsg'):
-                usernamefrom = j[1].strip()
-                realm_id = j[2].strip()
-                usernameto = j[3].strip()
-                message = ""
-                for w in j[4:]:
-                    message = "{} {}".format(message, w)
-                print(message)
-                logging.warning("RECVREALMPRIVATEMSG: recieve message from {} to {} in realm {}".format( usernamefrom, usernameto, realm_id))
-                return self.recv_realm_message(realm_id, usernamefrom, usernameto, message, data)
-            elif (command == 'sendgrouprealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernamesto = j[3].strip().split(',')
-                message = ""
-                for w in j[4:]:
-                    message = "{} {}".format(message, w)
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDGROUPREALM: session {} send message from {} to {} in realm {}".format(sessionid, usernamefrom, usernamesto, realm_id))
-                return self.send_group_realm_message(sessionid, realm_id, usernamefrom,usernamesto, message,data)
-            elif (command == 'sendgroupfilerealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernamesto = j[3].strip().split(',')
-                filepath = j[4].strip()
-                encoded_file = j[5].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDGROUPFILEREALM: session {} send file from {} to {} in realm {}".format(sessionid, usernamefrom, usernamesto, realm_id))
-                return self.send_group_file_realm(sessionid, realm_id, usernamefrom, usernamesto, filepath, encoded_file, data)
-            elif (command == 'recvgroupfilerealm'):
-                sessionid = j[1].strip()
-                realm_id = j[2].strip()
-                usernamesto = j[3].strip().split(',')
-                filepath = j[4].strip()
-                encoded_file = j[5].strip()
-                usernamefrom = self.sessions[sessionid]['username']
-                logging.warning("SENDGROUPFILEREALM: session {} send file from {} to {} in realm {}".format(sessionid, usernamefrom, usernamesto, realm_id))
-                return self.recv_group_file_realm(sessionid, realm_id, usernamefrom, usernamesto, filepath, encoded_file, data)
-            elif (command == 'recvrealmgroupmsg'):
-                usernamefrom = j[1].strip()
-                realm_id = j[2].strip()
-                usernamesto = j[3].strip().split(',')
-                message = ""
-                for w in j[4:]:
-                    message = "{} {}".format(message, w) 
-                logging.warning("RECVGROUPREALM: send message from {} to {} in realm {}".format(usernamefrom, usernamesto, realm_id))
-                return self.recv_group_realm_message(realm_id, usernamefrom,usernamesto, message,data)
-            elif (command == 'getrealminbox'):
-                sessionid = j[1].strip()
-                realmid = j[2].strip()
-                username = self.sessions[sessionid]['username']
-                logging.warning("GETREALMINBOX: {} from realm {}".format(sessionid, realmid))
-                return self.get_realm_inbox(username, realmid)
-            elif (command == 'getrealmchat'):
-                realmid = j[1].strip()
-                username = j[2].strip()
-                logging.warning("GETREALMCHAT: from realm {}".format(realmid))
-                return self.get_realm_chat(realmid, username)
-            elif (command=='logout'):
-                sessionid = j[1].strip()
-                return  self.logout(sessionid)
-            elif (command=='info'):
-                return self.info()
-            else:
-                print(command)
+            return op(**request['args'])
+        except KeyError:
+            return { 'status': 'ERROR', 'message' : 'Informasi tidak ditemukan'}
+        except WALError as e:
+            return {'status': 'ERROR', 'message': str(e)}
+
+    def proses(self, data, defer=False, conn=None):
+        # defer=True: inbox-wait dikembalikan sebagai PendingReply agar server yang menunggu
+        # conn: koneksi pemanggil (untuk subscribe push), None bila dipanggil langsung
+        hasil = self.jalankan(data, conn)
+        if isinstance(hasil, PendingReply) and not defer:
+            hasil = hasil.wait()
+        return hasil
+
+    def jalankan(self, data, conn=None):
+        try:
+            name = data.split(" ", 1)[0].strip()
+            command = self.commands.get(name)
+            if command is None:
+                print(name)
+                return {'status': 'ERROR', 'message': '**Protocol Tidak Benar'}
+            args = command.parse(data)
+            logging.warning("{}: {}" . format(command.name.upper(), args.get('sessionid') or args.get('username', '')))
+            return self.commands.dispatch(command, args, data, conn)
+        except KeyError:
+            return { 'status': 'ERROR', 'message' : 'Informasi tidak ditemukan'}
+        except WALError as e:
+            # perubahan sudah di memori tetapi tidak tersimpan di log
+            return {'status': 'ERROR', 'message': str(e)}
+        except (IndexError, ValueError):
+            return {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
+
+    def proses_frame(self, command, sessionid, args, blob=b'', defer=False, conn=None):
+        hasil = self.jalankan_frame(command, sessionid, args, blob, conn)
+        if isinstance(hasil, PendingReply) and not defer:
+            hasil = hasil.wait()
+        return hasil
+
+    def jalankan_frame(self, command, sessionid, args, blob=b'', conn=None):
+        # jalur protokol biner: argumen sudah terstruktur di meta, isi file dikirim mentah di blob
+        try:
+            command = self.commands.get(command)
+            if command is None:
                 return {'status': 'ERROR', 'message': '**Protocol Tidak Benar'}
+            if not isinstance(args, dict):
+                return {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
+            fields = command.args + command.optional + (command.rest,)
+            args = {field: value for field, value in args.items() if field in fields}
+            args['sessionid'] = sessionid
+            if blob:
+                args['content'] = blob
+            logging.warning("{}: {}" . format(command.name.upper(), sessionid))
+            return self.commands.dispatch(command, args, conn=conn)
         except KeyError:
             return { 'status': 'ERROR', 'message' : 'Informasi tidak ditemukan'}
-        except IndexError:
+        except WALError as e:
+            # perubahan sudah di memori tetapi tidak tersimpan di log
+            return {'status': 'ERROR', 'message': str(e)}
+        except (TypeError, ValueError):
             return {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
 
     def autentikasi_user(self,username,password):
@@ -241,453 +738,599 @@ class Chat:
             return { 'status': 'ERROR', 'message': 'User Tidak Ada' }
         if (self.users[username]['password']!= password):
             return { 'status': 'ERROR', 'message': 'Password Salah' }
-        tokenid = str(uuid.uuid4()) 
-        self.sessions[tokenid]={ 'username': username, 'userdetail':self.users[username]}
+        tokenid = self.sessions.buat(username, self.users[username])
         return { 'status': 'OK', 'tokenid': tokenid }
     
     def register_user(self,username, password, nama, negara):
-        if (username in self.users):
-            return { 'status': 'ERROR', 'message': 'User Sudah Ada' }
         nama = nama.replace("_", " ")
-        self.users[username]={ 
-            'nama': nama,
-            'negara': negara,
-            'password': password,
-            'incoming': {},
-            'outgoing': {}
-            }
-        tokenid = str(uuid.uuid4()) 
-        self.sessions[tokenid]={ 'username': username, 'userdetail':self.users[username]}
+        with self.user_locks.kunci(username):
+            if (username in self.users):
+                return { 'status': 'ERROR', 'message': 'User Sudah Ada' }
+            self.tambah_user(username, password, nama, negara)
+            self.catat({'op': 'register', 'username': username, 'password': password, 'nama': nama, 'negara': negara})
+        tokenid = self.sessions.buat(username, self.users[username])
         return { 'status': 'OK', 'tokenid': tokenid }
 
+    def tambah_user(self, username, password, nama, negara):
+        self.store.add_user(username, password, nama, negara)
+
     def get_user(self,username):
         if (username not in self.users):
             return False
         return self.users[username]
 
 #   ===================== Komunikasi dalam satu server =====================
-    def addgroup(self, sessionid, usernamefrom, groupname):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
-        self.group[groupname]={
-            'admin': usernamefrom,
-            'members': [usernamefrom],
-            'message':{}
-        }
+    def addgroup(self, username_from, groupname):
+        return self.tambah_group(groupname, username_from)
+
+    def tambah_group(self, groupname, admin):
+        # juga dijalankan lewat RPC addgroup di shard pemilik group, yang menentukan nama group sudah dipakai atau belum
+        with self.group_locks.kunci(groupname):
+            # group yang sudah ada tidak dibuat ulang (anggota dan timeline-nya akan hilang)
+            if groupname in self.group:
+                return {'status': 'ERROR', 'message': 'Group Sudah Ada'}
+            shard = self.shard_lain(groupname)
+            if shard is not None:
+                hasil = self.shards.panggil(shard, 'addgroup', groupname=groupname, admin=admin)
+                if hasil['status'] != 'OK':
+                    return hasil
+            # di shard admin (bila bukan pemilik group) ini salinan group untuk anggota lokal
+            self.buat_group(groupname, admin)
+            self.catat({'op': 'addgroup', 'group': groupname, 'admin': admin})
         return {'status': 'OK', 'message': 'Add group successful'}
+
+    def buat_group(self, groupname, admin):
+        self.store.add_group(groupname, admin)
     
-    def joingroup(self, sessionid, usernamefrom, groupname):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
-        if usernamefrom in self.group[groupname]['members']:
-            return {'status': 'ERROR', 'message': 'User sudah dalam group'}
-        self.group[groupname]['members'].append(usernamefrom)
-        return {'status': 'OK', 'message': 'Add group successful'}
+    def joingroup(self, username_from, groupname):
+        hasil = self.tambah_anggota(groupname, username_from)
+        hasil.pop('admin', None)
+        return hasil
+
+    def tambah_anggota(self, groupname, username):
+        # anggota dicatat dulu di shard pemilik group, lalu di salinan group di shard user ini
+        shard = self.shard_lain(groupname)
+        if shard is not None:
+            hasil = self.shards.panggil(shard, 'joingroup', groupname=groupname, username=username)
+            if hasil['status'] != 'OK':
+                return hasil
+        with self.group_locks.kunci(groupname):
+            if shard is not None and groupname not in self.group:
+                self.buat_group(groupname, hasil['admin'])
+                self.catat({'op': 'addgroup', 'group': groupname, 'admin': hasil['admin']})
+            group = self.group[groupname]
+            if username in group['members']:
+                return {'status': 'ERROR', 'message': 'User sudah dalam group'}
+            self.store.add_member(groupname, username)
+            self.catat({'op': 'joingroup', 'group': groupname, 'username': username})
+        return {'status': 'OK', 'message': 'Add group successful', 'admin': group['admin']}
     
-    def send_message(self,sessionid,username_from,username_dest,message):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_message(self,username_from,username_dest,message):
         s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
-
-        if (s_fr==False or s_to==False):
+        if s_fr is False:
             return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
 
-        message = { 'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message }
-        outqueue_sender = s_fr['outgoing']
-        inqueue_receiver = s_to['incoming']
-        try:	
-            outqueue_sender[username_from].put(message)
-        except KeyError:
-            outqueue_sender[username_from]=Queue()
-            outqueue_sender[username_from].put(message)
-        try:
-            inqueue_receiver[username_from].put(message)
-        except KeyError:
-            inqueue_receiver[username_from]=Queue()
-            inqueue_receiver[username_from].put(message)
+        message = Message(s_fr['nama'], message)
+        gagal = self.kirim_pesan(username_from, username_dest, message)
+        if gagal is not None:
+            return gagal
         return {'status': 'OK', 'message': 'Message Sent'}
     
-    def send_group_message(self, sessionid, groupname, username_from, message):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_group_message(self, groupname, username_from, message):
         s_fr = self.get_user(username_from)
         if s_fr is False:
             return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
-        for username_dest in self.group[groupname]['members']:
-            s_to = self.get_user(username_dest)
-            if s_to is False:
-                continue
-            message = {'group': groupname,'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message}
-            try:    
-                self.group[groupname]['message'][username_from].put(message)
-            except KeyError:
-                self.group[groupname]['message'][username_from]=Queue()
-                self.group[groupname]['message'][username_from].put(message)
-            
-            outqueue_sender = s_fr['outgoing']
-            inqueue_receiver = s_to['incoming']
-            try:    
-                outqueue_sender[username_from].put(message)
-            except KeyError:
-                outqueue_sender[username_from]=Queue()
-                outqueue_sender[username_from].put(message)
-            try:
-                inqueue_receiver[username_from].put(message)
-            except KeyError:
-                inqueue_receiver[username_from]=Queue()
-                inqueue_receiver[username_from].put(message)
+        message = Message(s_fr['nama'], message, group=groupname)
+        self.kirim_group(username_from, groupname, message)
         return {'status': 'OK', 'message': 'Message Sent'}
-    
-    def get_inbox(self,username):
-        s_fr = self.get_user(username)
-        incoming = s_fr['incoming']
+
+    def cek_user(self, username):
+        # user di shard lain diperiksa di shard pemiliknya (RPC cekuser)
+        shard = self.shard_lain(username)
+        if shard is not None:
+            return self.shards.panggil(shard, 'cekuser', username=username)
+        user = self.get_user(username)
+        if user is False:
+            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        return {'status': 'OK', 'nama': user['nama']}
+
+    def cek_group(self, groupname):
+        shard = self.shard_lain(groupname)
+        if shard is not None:
+            return self.shards.panggil(shard, 'cekgroup', groupname=groupname)
+        if groupname not in self.group:
+            return {'status': 'ERROR', 'message': 'Group Tidak Ditemukan'}
+        return {'status': 'OK'}
+
+    def path_blob(self, message):
+        # lokasi lampiran untuk shard tujuan, yang membuat hard link-nya sendiri (BlobStore.tautkan)
+        return os.path.abspath(self.blobs.path(message.blob_id)) if message.blob_id is not None else None
+
+    def kirim_pesan(self, username_from, username_dest, message):
+        # None bila terkirim, dict error bila tidak; referensi lampiran milik pemanggil dilepas bila gagal.
+        # Pesan ke user di shard lain masuk lewat RPC pesan; shard ini hanya menyimpan outgoing dan melepas
+        # referensi lampirannya (shard tujuan punya sendiri)
+        shard = self.shard_lain(username_dest)
+        if shard is None:
+            if self.get_user(username_dest) is False:
+                if message.blob_id is not None:
+                    self.blobs.release(message.blob_id)
+                return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+            self.deliver_message(username_from, username_dest, message)
+            return None
+        hasil = self.shards.panggil(shard, 'pesan', username_from=username_from, username_dest=username_dest,
+                                    message=message.dump(), blob=self.path_blob(message))
+        if message.blob_id is not None:
+            self.blobs.release(message.blob_id)
+        if hasil['status'] != 'OK':
+            return hasil
+        seq = self.users[username_from]['outgoing'].append(username_dest, message)
+        self.catat({'op': 'sent', 'from': username_from, 'to': username_dest, 'seq': seq, 'message': message.dump()})
+        return None
+
+    def terima_pesan(self, username_from, username_dest, message, blob=None):
+        # RPC pesan: pesan dari user di shard lain untuk user di shard ini
+        if self.get_user(username_dest) is False:
+            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        message = Message.load(message)
+        if blob is not None:
+            self.blobs.tautkan(blob, message.blob_id)
+        return {'status': 'OK', 'seq': self.masuk_inbox(username_from, username_dest, message)}
+
+    def kirim_group(self, username_from, groupname, message):
+        # pesan ditulis di shard pemilik group, yang lalu menyalinnya ke shard lain yang punya anggota group.
+        # Group yang tidak ada: KeyError, setelah referensi lampiran milik pemanggil dilepas
+        shard = self.shard_lain(groupname)
+        if shard is None:
+            if groupname not in self.group:
+                if message.blob_id is not None:
+                    self.blobs.release(message.blob_id)
+                raise KeyError(groupname)
+            seq = self.deliver_group_message(username_from, groupname, message)
+            self.sebarkan_group(username_from, groupname, message)
+            return seq
+        hasil = self.shards.panggil(shard, 'pesangroup', username_from=username_from, groupname=groupname,
+                                    message=message.dump(), blob=self.path_blob(message))
+        if message.blob_id is not None:
+            self.blobs.release(message.blob_id)
+        if hasil['status'] != 'OK':
+            # sama seperti group yang tidak ada di mode satu proses
+            raise KeyError(groupname)
+        return hasil['seq']
+
+    def terima_group(self, username_from, groupname, message, blob=None):
+        # RPC pesangroup: di shard pemilik group diteruskan lagi ke salinan group, di shard lain hanya ditulis
+        if groupname not in self.group:
+            return {'status': 'ERROR', 'message': 'Group Tidak Ditemukan'}
+        message = Message.load(message)
+        if blob is not None:
+            self.blobs.tautkan(blob, message.blob_id)
+        seq = self.deliver_group_message(username_from, groupname, message)
+        if self.shards.milik(groupname):
+            self.sebarkan_group(username_from, groupname, message)
+        return {'status': 'OK', 'seq': seq}
+
+    def sebarkan_group(self, username_from, groupname, message):
+        if self.shards is None:
+            return
+        tujuan = {self.shards.pemilik(member) for member in self.group[groupname]['members']} - {self.shards.index}
+        for shard in sorted(tujuan):
+            hasil = self.shards.panggil(shard, 'pesangroup', username_from=username_from, groupname=groupname,
+                                        message=message.dump(), blob=self.path_blob(message))
+            if hasil['status'] != 'OK':
+                logging.warning("SHARD: pesan group {} tidak tersalin ke shard {}: {}".format(groupname, shard, hasil['message']))
+
+    def deliver_message(self, username_from, username_dest, message):
+        self.users[username_from]['outgoing'].append(username_dest, message)
+        return self.masuk_inbox(username_from, username_dest, message)
+
+    def masuk_inbox(self, username_from, username_dest, message):
+        seq = self.users[username_dest]['incoming'].append(username_from, message)
+        self.catat({'op': 'message', 'from': username_from, 'to': username_dest, 'seq': seq, 'message': message.dump()})
+        self.push.publish(username_dest, {'status': 'OK', 'push': 'message', 'seq': seq, 'from': username_from,
+                                          'message': message.to_inbox(self.users[username_dest]['nama'])})
+        return seq
+
+    def deliver_group_message(self, username_from, groupname, message):
+        # fan-out saat dibaca: pesan ditulis sekali ke timeline group, anggota membacanya lewat cursor masing-masing
+        group = self.group[groupname]
+        seq = group['timeline'].append(username_from, message)
+        self.catat({'op': 'groupmessage', 'group': groupname, 'from': username_from, 'seq': seq, 'message': message.dump()})
+        self.push.publish_many(group['members'], {'status': 'OK', 'push': 'group', 'group': groupname, 'seq': seq,
+                                                  'from': username_from, 'message': message.to_inbox()})
+        return seq
+
+    def push_realm(self, realm_id, username_from, username_dest, message):
+        self.push.publish(username_dest, {'status': 'OK', 'push': 'realm', 'realm': realm_id, 'from': username_from,
+                                          'message': message.to_dict(self.users[username_dest]['nama'])})
+
+    def subscribe(self, username, conn=None):
+        # koneksi ini akan menerima frame push setiap ada pesan masuk untuk username
+        if conn is None:
+            return {'status': 'ERROR', 'message': 'Push tidak didukung koneksi ini'}
+        self.push.subscribe(username, conn)
+        groups = {groupname: self.group[groupname]['timeline'].last_seq for groupname in self.store.groups_of(username)}
+        return {'status': 'OK', 'message': 'Subscribed', 'cursor': tulis_cursor(self.get_user(username)['incoming'].last_seq, groups)}
+
+    def get_inbox(self, username, session=None, cursor=None):
+        # cursor (lihat baca_cursor) berisi posisi baca inbox dan tiap group. Tanpa cursor dari client dipakai
+        # posisi milik session lalu dimajukan, sehingga tiap perangkat membaca inbox yang sama; cursor dari
+        # client tidak memajukan posisi mana pun, jadi membaca ulang dengan cursor lama tetap melihat pesan yang sama
+        simpan_cursor = cursor is None and session is not None
+        if cursor is None:
+            mulai, posisi = (session.get('cursor', 0) if session else 0), None
+        else:
+            mulai, posisi = baca_cursor(cursor)
+        user = self.get_user(username)
+        entries, last_seq = user['incoming'].since(mulai)
         msgs={}
-        for users in incoming:
-            msgs[users]=[]
-            while not incoming[users].empty():
-                msgs[users].append(s_fr['incoming'][users].get_nowait())
-        return {'status': 'OK', 'messages': msgs}
+        for seq, sender, message in entries:
+            msgs.setdefault(sender, []).append(message.to_inbox(user['nama']))
+        groups = {}
+        # baca-lalu-majukan posisi session dikunci per user agar dua poll bersamaan tidak memundurkannya
+        with self.user_locks.kunci(username):
+            if posisi is None:
+                posisi = session.get('groups', {}) if session else {}
+            for groupname in self.store.groups_of(username):
+                mulai = posisi.get(groupname)
+                if mulai is None:
+                    # session baru, group yang baru diikuti, atau cursor tanpa posisi group ini
+                    mulai = self.store.group_cursor(groupname, username)
+                entries, groups[groupname] = self.group[groupname]['timeline'].since(mulai)
+                for seq, sender, message in entries:
+                    msgs.setdefault(sender, []).append(message.to_inbox(user['nama']))
+            if simpan_cursor:
+                session['cursor'] = max(session.get('cursor', 0), last_seq)
+                session['groups'] = groups
+        return {'status': 'OK', 'messages': msgs, 'cursor': tulis_cursor(last_seq, groups)}
 
-    def send_file(self, sessionid, username_from, username_dest, filepath ,encoded_file):
-        if sessionid not in self.sessions:
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
-        
-        s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
+    def inbox_wait(self, username, session=None, cursor=None, timeout=INBOX_WAIT_TIMEOUT):
+        # long-poll: bila belum ada pesan baru, request ditahan sampai ada pesan masuk atau timeout
+        hasil = self.get_inbox(username, session, cursor)
+        timeout = min(timeout, INBOX_WAIT_MAX)
+        if hasil['messages'] or timeout <= 0:
+            return hasil
+        seq, groups = baca_cursor(hasil['cursor'])
+        watches = [(self.get_user(username)['incoming'], seq)]
+        for groupname, posisi in groups.items():
+            watches.append((self.group[groupname]['timeline'], posisi))
+        return PendingReply(watches, timeout, lambda: self.get_inbox(username, session, cursor))
 
-        if s_fr is False or s_to is False:
+    def send_file(self, username_from, username_dest, filepath ,encoded_file=None, content=None):
+        s_fr = self.get_user(username_from)
+        if s_fr is False:
             return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        # tujuan diperiksa sebelum isi file di-decode dan disimpan
+        hasil = self.cek_user(username_dest)
+        if hasil['status'] != 'OK':
+            return hasil
 
         filename = os.path.basename(filepath)
-        message = {
-            'msg_from': s_fr['nama'],
-            'msg_to': s_to['nama'],
-            'file_name': filename,
-            'file_content': encoded_file
-        }
-
-        outqueue_sender = s_fr['outgoing']
-        inqueue_receiver = s_to['incoming']
-        try:
-            outqueue_sender[username_from].put(json.dumps(message))
-        except KeyError:
-            outqueue_sender[username_from] = Queue()
-            outqueue_sender[username_from].put(json.dumps(message))
-        try:
-            inqueue_receiver[username_from].put(json.dumps(message))
-        except KeyError:
-            inqueue_receiver[username_from] = Queue()
-            inqueue_receiver[username_from].put(json.dumps(message))
-        
-        # Simpan file ke folder dengan nama yang mencerminkan waktu pengiriman dan nama asli file
-        now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        folder_name = f"{now}_{username_from}_{username_dest}_{filename}"
-        folder_path = join(dirname(realpath(__file__)), 'files/')
-        os.makedirs(folder_path, exist_ok=True)
-        folder_path = join(folder_path, folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-        file_destination = os.path.join(folder_path, filename)
-        if 'b' in encoded_file[0]:
-            msg = encoded_file[2:-1]
-
-            with open(file_destination, "wb") as fh:
-                fh.write(base64.b64decode(msg))
-        else:
-            tail = encoded_file.split()
-        
+        if content is None:
+            content = decode_file(encoded_file)
+        message = Message(s_fr['nama'], file_name=filename, blob_id=self.blobs.simpan(content), file_size=len(content))
+        gagal = self.kirim_pesan(username_from, username_dest, message)
+        if gagal is not None:
+            return gagal
         return {'status': 'OK', 'message': 'File Sent'}
 
-    def send_group_file(self, sessionid, username_from, groupname, filepath, encoded_file):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_group_file(self, username_from, groupname, filepath, encoded_file=None, content=None):
         s_fr = self.get_user(username_from)
         if s_fr is False:
             return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        # sama seperti send_file: group diperiksa sebelum isi file di-decode dan disimpan
+        hasil = self.cek_group(groupname)
+        if hasil['status'] != 'OK':
+            return hasil
 
         filename = os.path.basename(filepath)
-        for username_dest in self.group[groupname]['members']:
-            s_to = self.get_user(username_dest)
-            if s_to is False:
-                continue
-            message = {
-                'group': groupname,
-                'msg_from': s_fr['nama'],
-                'msg_to': s_to['nama'],
-                'file_name': filename,
-                'file_content': encoded_file
-            }
-
-            try:    
-                self.group[groupname]['message'][username_from].put(message)
-            except KeyError:
-                self.group[groupname]['message'][username_from]=Queue()
-                self.group[groupname]['message'][username_from].put(message)
-            
-            outqueue_sender = s_fr['outgoing']
-            inqueue_receiver = s_to['incoming']
-            try:
-                outqueue_sender[username_from].put(json.dumps(message))
-            except KeyError:
-                outqueue_sender[username_from] = Queue()
-                outqueue_sender[username_from].put(json.dumps(message))
-            try:
-                inqueue_receiver[username_from].put(json.dumps(message))
-            except KeyError:
-                inqueue_receiver[username_from] = Queue()
-                inqueue_receiver[username_from].put(json.dumps(message))
-        
-            # Simpan file ke folder dengan nama yang mencerminkan waktu pengiriman dan nama asli file
-            now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            folder_name = f"{now}_{username_from}_{username_dest}_{filename}"
-            folder_path = join(dirname(realpath(__file__)), 'files/')
-            os.makedirs(folder_path, exist_ok=True)
-            folder_path = join(folder_path, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            file_destination = os.path.join(folder_path, filename)
-            if 'b' in encoded_file[0]:
-                msg = encoded_file[2:-1]
-
-                with open(file_destination, "wb") as fh:
-                    fh.write(base64.b64decode(msg))
-            else:
-                tail = encoded_file.split()
-        
+        if content is None:
+            content = decode_file(encoded_file)
+        message = Message(s_fr['nama'], group=groupname, file_name=filename, blob_id=self.blobs.simpan(content),
+                          file_size=len(content))
+        self.kirim_group(username_from, groupname, message)
         return {'status': 'OK', 'message': 'File Sent'}
 
 
+    def upload_begin(self, username_from, mode, tujuan, filepath, size, checksum):
+        # upload bertahap: upload-begin -> upload-chunk (berulang, offset berurutan) -> upload-commit
+        if mode == 'user' and self.cek_user(tujuan)['status'] != 'OK':
+            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        if mode == 'group' and self.cek_group(tujuan)['status'] != 'OK':
+            return {'status': 'ERROR', 'message': 'Group Tidak Ditemukan'}
+        try:
+            upload = self.uploads.begin(username_from, mode, tujuan, os.path.basename(filepath), size, checksum)
+        except UploadError as e:
+            return e.hasil
+        return {'status': 'OK', 'upload_id': upload.upload_id, 'offset': 0, 'chunk_max': UPLOAD_CHUNK_MAX}
+
+    def upload_chunk(self, username_from, upload_id, offset, chunk=None, content=None):
+        if content is None:
+            content = decode_file(chunk)
+        try:
+            offset = self.uploads.chunk(upload_id, username_from, offset, content)
+        except UploadError as e:
+            return e.hasil
+        return {'status': 'OK', 'offset': offset}
+
+    def upload_status(self, username_from, upload_id):
+        # dipakai client untuk melanjutkan upload yang terputus dari offset ini
+        try:
+            upload = self.uploads.get(upload_id, username_from)
+        except UploadError as e:
+            return e.hasil
+        return {'status': 'OK', 'upload_id': upload_id, 'offset': upload.received, 'size': upload.size}
+
+    def upload_commit(self, username_from, upload_id):
+        try:
+            upload, blob_id = self.uploads.commit(upload_id, username_from)
+        except UploadError as e:
+            return e.hasil
+        self.blobs.pindahkan(upload.path, blob_id)
+        # bila pengiriman gagal, kirim_pesan/kirim_group melepas referensi blob ini
+        s_fr = self.get_user(username_from)
+        if upload.mode == 'group':
+            message = Message(s_fr['nama'], group=upload.tujuan, file_name=upload.filename, blob_id=blob_id, file_size=upload.size)
+            self.kirim_group(username_from, upload.tujuan, message)
+        else:
+            message = Message(s_fr['nama'], file_name=upload.filename, blob_id=blob_id, file_size=upload.size)
+            gagal = self.kirim_pesan(username_from, upload.tujuan, message)
+            if gagal is not None:
+                return gagal
+        return {'status': 'OK', 'message': 'File Sent', 'blob_id': blob_id}
+
+    def download(self, username, blob_id, offset=0):
+        # balasan berisi header JSON (size = ukuran file, count = byte yang menyusul) lalu isi file
+        # mulai dari offset; download yang terputus dilanjutkan dengan offset = byte yang sudah diterima
+        try:
+            fh = self.blobs.open(blob_id)
+        except FileNotFoundError:
+            return {'status': 'ERROR', 'message': 'File Tidak Ditemukan'}
+        size = os.fstat(fh.fileno()).st_size
+        if offset < 0 or offset > size:
+            fh.close()
+            return {'status': 'ERROR', 'message': 'Offset Tidak Valid', 'size': size}
+        return FileReply(fh, offset, size - offset, {'status': 'OK', 'blob_id': blob_id, 'size': size,
+                                                     'offset': offset, 'count': size - offset})
+
 #   ===================== Komunikasi dengan server lain =====================
     def add_realm(self, realm_id, realm_dest_address, realm_dest_port, data):
-        j = data.split()
-        j[0] = "recvrealm"
-        data = ' '.join(j)
-        data += "\r\n"
-        if realm_id in self.realms:
-            return {'status': 'ERROR', 'message': 'Realm sudah ada'}
+        handshake = teruskan(data, "recvrealm")
+        hasil = self.buka_realm(realm_id, realm_dest_address, realm_dest_port, handshake)
+        if self.shards is not None and hasil['status'] == 'OK':
+            # mode multi-proses: tiap shard membuka link realm sendiri untuk user-nya
+            self.shards.siarkan('realm', realm_id=realm_id, realm_dest_address=realm_dest_address,
+                                realm_dest_port=realm_dest_port, handshake=handshake)
+        return hasil
 
-        self.realms[realm_id] = RealmThreadCommunication(self, realm_dest_address, realm_dest_port)
-        result = self.realms[realm_id].sendstring(data)
-        return result
+    def buka_realm(self, realm_id, realm_dest_address, realm_dest_port, handshake):
+        with self.realm_lock:
+            realm = self.realms.get(realm_id)
+            if realm is None:
+                realm = self.realms[realm_id] = RealmThreadCommunication(self, realm_id, realm_dest_address, realm_dest_port,
+                                                                         handshake)
+                reply = realm.handshake_reply
+            elif realm.terhubung():
+                return {'status': 'ERROR', 'message': 'Realm sudah ada'}
+            else:
+                # link yang putus disambung ulang; pesan yang masih di antrian tetap dikirim
+                reply = realm.sambung(handshake, realm_dest_address, realm_dest_port)
+        return reply.wait()
 
     def recv_realm(self, realm_id, realm_dest_address, realm_dest_port, data):
-        self.realms[realm_id] = RealmThreadCommunication(self, realm_dest_address, realm_dest_port)
+        hasil = self.terima_realm(realm_id, realm_dest_address, realm_dest_port)
+        if self.shards is not None:
+            self.shards.siarkan('recvrealm', realm_id=realm_id, realm_dest_address=realm_dest_address,
+                                realm_dest_port=realm_dest_port)
+        return hasil
+
+    def terima_realm(self, realm_id, realm_dest_address, realm_dest_port):
+        # handshake diulang setiap kali link pengirim reconnect; antrian realm yang sudah ada dipertahankan
+        with self.realm_lock:
+            if realm_id not in self.realms:
+                self.realms[realm_id] = RealmThreadCommunication(self, realm_id, realm_dest_address, realm_dest_port)
         return {'status':'OK'}
 
-    def send_realm_message(self, sessionid, realm_id, username_from, username_dest, message, data):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_realm_message(self, realm_id, username_from, username_dest, message, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
-        if (s_fr==False or s_to==False):
-            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
-        message = { 'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message }
-        self.realms[realm_id].put(message)
-        
-        j = data.split()
-        j[0] = "recvrealmprivatemsg"
-        j[1] = username_from
-        data = ' '.join(j)
-        data += "\r\n"
-        self.realms[realm_id].sendstring(data)
+        users = self.get_users([username_from, username_dest])
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users
+        if not self.realms[realm_id].antri(teruskan(data, "recvrealmprivatemsg", username_from)):
+            return {'status': 'ERROR', 'message': 'Antrian Realm Penuh'}
+        self.catat_realm(realm_id, [username_dest], [s_to], Message(s_fr['nama'], message))
         return {'status': 'OK', 'message': 'Message Sent to Realm'}
     
-    def send_file_realm(self, sessionid, realm_id, username_from, username_dest, filepath, encoded_file, data):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_file_realm(self, realm_id, username_from, username_dest, filepath, encoded_file, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
-        if (s_fr==False or s_to==False):
-            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
-        
+        users = self.get_users([username_from, username_dest])
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users
+        # isi file diperiksa sebelum masuk spool: base64 rusak tidak ikut diteruskan ke realm lain
+        content = decode_file(encoded_file)
+        if not self.realms[realm_id].antri(teruskan(data, "recvfilerealm", username_from)):
+            return {'status': 'ERROR', 'message': 'Antrian Realm Penuh'}
+
         filename = os.path.basename(filepath)
-        message = {
-            'msg_from': s_fr['nama'],
-            'msg_to': s_to['nama'],
-            'file_name': filename,
-            'file_content': encoded_file
-        }
-        self.realms[realm_id].put(message)
-        
-        now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        folder_name = f"{now}_{username_from}_{username_dest}_{filename}"
-        folder_path = join(dirname(realpath(__file__)), 'files/')
-        os.makedirs(folder_path, exist_ok=True)
-        folder_path = join(folder_path, folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-        file_destination = os.path.join(folder_path, filename)
-        if 'b' in encoded_file[0]:
-            msg = encoded_file[2:-1]
-
-            with open(file_destination, "wb") as fh:
-                fh.write(base64.b64decode(msg))
-        else:
-            tail = encoded_file.split()
-        
-        j = data.split()
-        j[0] = "recvfilerealm"
-        j[1] = username_from
-        data = ' '.join(j)
-        data += "\r\n"
-        self.realms[realm_id].sendstring(data)
+        message = Message(s_fr['nama'], file_name=filename, blob_id=self.blobs.simpan(content), file_size=len(content))
+        self.catat_realm(realm_id, [username_dest], [s_to], message)
         return {'status': 'OK', 'message': 'File Sent to Realm'}
     
-    def recv_file_realm(self, sessionid, realm_id, username_from, username_dest, filepath, encoded_file, data):
+    def recv_file_realm(self, realm_id, username_from, username_dest, filepath, encoded_file, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
-        if (s_fr==False or s_to==False):
-            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        users = self.get_users([username_from, username_dest])
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users
         
         filename = os.path.basename(filepath)
-        message = {
-            'msg_from': s_fr['nama'],
-            'msg_to': s_to['nama'],
-            'file_name': filename,
-            'file_content': encoded_file
-        }
-        self.realms[realm_id].put(message)
-        
-        now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        folder_name = f"{now}_{username_from}_{username_dest}_{filename}"
-        folder_path = join(dirname(realpath(__file__)), 'files/')
-        os.makedirs(folder_path, exist_ok=True)
-        folder_path = join(folder_path, folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-        file_destination = os.path.join(folder_path, filename)
-        if 'b' in encoded_file[0]:
-            msg = encoded_file[2:-1]
-
-            with open(file_destination, "wb") as fh:
-                fh.write(base64.b64decode(msg))
-        else:
-            tail = encoded_file.split()
-        
-        return {'status': 'OK', 'message': 'File Received to Realm'}
+        content = decode_file(encoded_file)
+        message = Message(s_fr['nama'], file_name=filename, blob_id=self.blobs.simpan(content), file_size=len(content))
+        hasil = self.taruh_realm(realm_id, [username_dest], [s_to], message, username_from)
+        return hasil or {'status': 'OK', 'message': 'File Received to Realm'}
 
     def recv_realm_message(self, realm_id, username_from, username_dest, message, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        s_to = self.get_user(username_dest)
-        if (s_fr==False or s_to==False):
+        users = self.get_users([username_from, username_dest])
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users
+        message = Message(s_fr['nama'], message)
+        hasil = self.taruh_realm(realm_id, [username_dest], [s_to], message, username_from)
+        return hasil or {'status': 'OK', 'message': 'Message Sent to Realm'}
+
+    def get_users(self, usernames):
+        # profil semua user, atau dict error bila salah satunya tidak ada; diperiksa sebelum pesan diantrikan.
+        # User di shard lain diperiksa lewat cek_user, profilnya hanya berisi nama
+        users = []
+        for username in usernames:
+            if self.shard_lain(username) is None:
+                user = self.get_user(username)
+                if user is False:
+                    return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+            else:
+                user = self.cek_user(username)
+                if user['status'] != 'OK':
+                    return user
+            users.append(user)
+        return users
+
+    def taruh_realm(self, realm_id, usernames, users, message, username_from=None):
+        # antrian realm user ada di shard pemilik user (getrealmchat diambil dari sana); user di shard lain
+        # lewat RPC realmput. username_from diisi untuk pesan dari realm lain, yang juga di-push ke penerima.
+        # Message memegang satu referensi lampiran per penerima; None bila semua berhasil, atau error pertama
+        gagal = None
+        for username, user in zip(usernames, users):
+            shard = self.shard_lain(username)
+            if shard is None:
+                self.realms[realm_id].put(user['nama'], message)
+                if username_from is not None:
+                    self.push_realm(realm_id, username_from, username, message)
+                continue
+            realm = self.realms[realm_id]
+            hasil = self.shards.panggil(shard, 'realmput', realm_id=realm_id, realm_dest_address=realm.realm_dest_address,
+                                        realm_dest_port=realm.realm_dest_port, username_dest=username,
+                                        message=message.dump(), blob=self.path_blob(message), username_from=username_from)
+            if message.blob_id is not None:
+                self.blobs.release(message.blob_id)
+            if hasil['status'] != 'OK' and gagal is None:
+                gagal = hasil
+        return gagal
+
+    def terima_realm_put(self, realm_id, realm_dest_address, realm_dest_port, username_dest, message, blob=None, username_from=None):
+        # RPC realmput: pesan realm untuk user di shard ini. Tabel realm hanya di memori, jadi shard yang
+        # baru dijalankan ulang mengenal realm ini lagi dari sini, seperti saat handshake recvrealm
+        self.terima_realm(realm_id, realm_dest_address, realm_dest_port)
+        user = self.get_user(username_dest)
+        if user is False:
             return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
-        message = { 'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message }
-        self.realms[realm_id].put(message)
-        return {'status': 'OK', 'message': 'Message Sent to Realm'}
+        message = Message.load(message)
+        if blob is not None:
+            self.blobs.tautkan(blob, message.blob_id)
+        return self.taruh_realm(realm_id, [username_dest], [user], message, username_from) or {'status': 'OK'}
+
+    def catat_realm(self, realm_id, usernames, users, message):
+        # salinan pesan keluar untuk getrealmchat; pesan sudah di spool, jadi kegagalan di sini hanya dicatat
+        hasil = self.taruh_realm(realm_id, usernames, users, message)
+        if hasil is not None:
+            logging.warning("REALM {}: salinan pesan tidak tersimpan: {}".format(realm_id, hasil['message']))
 
-    def send_group_realm_message(self, sessionid, realm_id, username_from, usernames_to, message, data):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_group_realm_message(self, realm_id, username_from, usernames_to, message, data):
         if realm_id not in self.realms:
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        for username_to in usernames_to:
-            s_to = self.get_user(username_to)
-            message = {'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message }
-            self.realms[realm_id].put(message)
-        
-        j = data.split()
-        j[0] = "recvrealmgroupmsg"
-        j[1] = username_from
-        data = ' '.join(j)
-        data +="\r\n"
-        self.realms[realm_id].sendstring(data)
+        users = self.get_users([username_from] + usernames_to)
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users[0], users[1:]
+        if not self.realms[realm_id].antri(teruskan(data, "recvrealmgroupmsg", username_from)):
+            return {'status': 'ERROR', 'message': 'Antrian Realm Penuh'}
+        self.catat_realm(realm_id, usernames_to, s_to, Message(s_fr['nama'], message))
         return {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
     
-    def send_group_file_realm(self, sessionid, realm_id, username_from, usernames_to, filepath, encoded_file, data):
-        if (sessionid not in self.sessions):
-            return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+    def send_group_file_realm(self, realm_id, username_from, usernames_to, filepath, encoded_file, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
+        users = self.get_users([username_from] + usernames_to)
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users[0], users[1:]
+        # isi file diperiksa sebelum masuk spool: base64 rusak tidak ikut diteruskan ke realm lain
+        content = decode_file(encoded_file)
+        if not self.realms[realm_id].antri(teruskan(data, "recvgroupfilerealm", username_from)):
+            return {'status': 'ERROR', 'message': 'Antrian Realm Penuh'}
 
-        if (s_fr==False):
-                return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
-            
         filename = os.path.basename(filepath)
-        for username_to in usernames_to:
-            s_to = self.get_user(username_to)
-            message = {
-                'msg_from': s_fr['nama'],
-                'msg_to': s_to['nama'],
-                'file_name': filename,
-                'file_content': encoded_file
-            }
-            self.realms[realm_id].put(message)
-        
-            now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            folder_name = f"{now}_{username_from}_{username_to}_{filename}"
-            folder_path = join(dirname(realpath(__file__)), 'files/')
-            os.makedirs(folder_path, exist_ok=True)
-            folder_path = join(folder_path, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            file_destination = os.path.join(folder_path, filename)
-            if 'b' in encoded_file[0]:
-                msg = encoded_file[2:-1]
-
-                with open(file_destination, "wb") as fh:
-                    fh.write(base64.b64decode(msg))
-            else:
-                tail = encoded_file.split()
-        
-        j = data.split()
-        j[0] = "recvgroupfilerealm"
-        j[1] = username_from
-        data = ' '.join(j)
-        data += "\r\n"
-        self.realms[realm_id].sendstring(data)
+        # satu blob untuk semua penerima, satu referensi per antrian realm
+        blob_id = self.blobs.simpan(content, refs=len(usernames_to))
+        message = Message(s_fr['nama'], file_name=filename, blob_id=blob_id, file_size=len(content))
+        self.catat_realm(realm_id, usernames_to, s_to, message)
         return {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
 
-    def recv_group_file_realm(self, sessionid, realm_id, username_from, usernames_to, filepath, encoded_file, data):
+    def recv_group_file_realm(self, realm_id, username_from, usernames_to, filepath, encoded_file, data):
         if (realm_id not in self.realms):
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-
-        if (s_fr==False):
-                return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
+        users = self.get_users([username_from] + usernames_to)
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users[0], users[1:]
             
         filename = os.path.basename(filepath)
-        for username_to in usernames_to:
-            s_to = self.get_user(username_to)
-            message = {
-                'msg_from': s_fr['nama'],
-                'msg_to': s_to['nama'],
-                'file_name': filename,
-                'file_content': encoded_file
-            }
-            self.realms[realm_id].put(message)
-        
-            now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            folder_name = f"{now}_{username_from}_{username_to}_{filename}"
-            folder_path = join(dirname(realpath(__file__)), 'files/')
-            os.makedirs(folder_path, exist_ok=True)
-            folder_path = join(folder_path, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            file_destination = os.path.join(folder_path, filename)
-            if 'b' in encoded_file[0]:
-                msg = encoded_file[2:-1]
-
-                with open(file_destination, "wb") as fh:
-                    fh.write(base64.b64decode(msg))
-            else:
-                tail = encoded_file.split()
-        
-        return {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
+        content = decode_file(encoded_file)
+        blob_id = self.blobs.simpan(content, refs=len(usernames_to))
+        message = Message(s_fr['nama'], file_name=filename, blob_id=blob_id, file_size=len(content))
+        hasil = self.taruh_realm(realm_id, usernames_to, s_to, message, username_from)
+        return hasil or {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
 
     def recv_group_realm_message(self, realm_id, username_from, usernames_to, message, data):
         if realm_id not in self.realms:
             return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
-        s_fr = self.get_user(username_from)
-        for username_to in usernames_to:
-            s_to = self.get_user(username_to)
-            message = {'msg_from': s_fr['nama'], 'msg_to': s_to['nama'], 'msg': message }
-            self.realms[realm_id].put(message)
-        return {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
+        users = self.get_users([username_from] + usernames_to)
+        if isinstance(users, dict):
+            return users
+        s_fr, s_to = users[0], users[1:]
+        hasil = self.taruh_realm(realm_id, usernames_to, s_to, Message(s_fr['nama'], message), username_from)
+        return hasil or {'status': 'OK', 'message': 'Message Sent to Group in Realm'}
+
+    def recv_realm_batch(self, realm_id, commands):
+        # satu frame berisi banyak pesan dari realm yang sama, diterapkan dengan satu kali ambil lock.
+        # commands = {'node': id server pengirim, 'items': [[id, command], ...]} dengan id naik per pengirim;
+        # pesan yang dikirim ulang setelah reconnect (id <= id terakhir) tidak diterapkan dua kali.
+        # Pesan yang gagal karena shard penerima tidak tersedia membuat batch ditolak (tidak di-ack pengirim),
+        # begitu juga batch berikutnya sampai pesan itu dikirim ulang, agar urutan dan dedup tetap benar
+        if realm_id not in self.realms:
+            return {'status': 'ERROR', 'message': 'Realm Tidak Ditemukan'}
+        if not batch_valid(commands):
+            return {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
+        realm = self.realms[realm_id]
+        node = commands['node']
+        results = []
+        with realm.chat_lock:
+            terakhir = realm.applied.get(node, 0)
+            for msg_id, data in commands['items']:
+                if msg_id <= terakhir:
+                    results.append({'status': 'OK', 'message': 'Duplikat'})
+                    continue
+                if realm.tertahan.get(node, msg_id) != msg_id:
+                    return {'status': 'ERROR', 'message': 'Menunggu Pesan {}'.format(realm.tertahan[node])}
+                realm.tertahan.pop(node, None)
+                if data.split(" ", 1)[0] not in REALM_BATCH_COMMANDS:
+                    hasil = {'status': 'ERROR', 'message': '**Protocol Tidak Benar'}
+                else:
+                    hasil = self.jalankan(data)
+                if hasil.get('message') == 'Shard Tidak Tersedia':
+                    realm.tertahan[node] = msg_id
+                    realm.applied[node] = terakhir
+                    return hasil
+                terakhir = msg_id
+                results.append(hasil)
+            realm.applied[node] = terakhir
+        return {'status': 'OK', 'results': results}
 
     def get_realm_inbox(self, username,realmid):
         if (realmid not in self.realms):
@@ -696,19 +1339,47 @@ class Chat:
         result = self.realms[realmid].sendstring("getrealmchat {} {}\r\n".format(realmid, username))
         return result
     def get_realm_chat(self, realmid, username):
+        # link realm dilayani shard pemilik realm, antrian user di shard lain diambil lewat RPC realmchat
+        shard = self.shard_lain(username)
+        if shard is not None:
+            return self.shards.panggil(shard, 'realmchat', realmid=realmid, username=username)
         s_fr = self.get_user(username)
+        if s_fr is False:
+            return {'status': 'ERROR', 'message': 'User Tidak Ditemukan'}
         msgs = []
-        while not self.realms[realmid].chat[s_fr['nama']].empty():
-            msgs.append(self.realms[realmid].chat[s_fr['nama']].get_nowait())
+        realm = self.realms[realmid]
+        # dikosongkan di bawah chat_lock: dua pengambil bersamaan tidak saling merebut pesan di tengah
+        with realm.chat_lock:
+            antrian = realm.chat[s_fr['nama']]
+            while not antrian.empty():
+                message = antrian.get_nowait()
+                msgs.append(message.to_dict(s_fr['nama'], self.blobs))
+                # pesan realm yang sudah diambil tidak disimpan lagi
+                if message.blob_id is not None:
+                    self.blobs.release(message.blob_id)
         return {'status': 'OK', 'messages': msgs}
     def logout(self, sessionid):
-        if (bool(self.sessions) == True):
-            del self.sessions[sessionid]
+        if self.sessions.hapus(sessionid):
             return {'status': 'OK'}
         else:
             return {'status': 'ERROR', 'message': 'Belum Login'}
+    def logout_all(self, username):
+        # semua session milik user ini (semua perangkat) dibuang sekaligus
+        return {'status': 'OK', 'message': self.sessions.hapus_user(username)}
+    def ping(self):
+        return {'status': 'OK', 'message': 'pong'}
     def info(self):
-        return {'status': 'OK', 'message': self.sessions}
+        # user yang sedang login dan jumlah session-nya; tokenid tidak pernah dikirim
+        hasil = self.info_lokal()
+        if self.shards is not None:
+            # user tiap shard berbeda, jadi hasil semua shard cukup digabung
+            for shard in self.shards.lain():
+                lain = self.shards.panggil(shard, 'info')
+                if lain['status'] == 'OK':
+                    hasil['message'].update(lain['message'])
+        return hasil
+    def info_lokal(self):
+        return {'status': 'OK', 'message': self.sessions.aktif()}
 
 if __name__=="__main__":
     j = Chat()
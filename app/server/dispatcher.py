@@ -0,0 +1,107 @@
+import inspect
+import time
+
+
+def daftar_username(value):
+    return value.split(',')
+
+
+class Command:
+    def __init__(self, name, handler, args=(), optional=(), rest=None, types=None, session=True, user='username_from', raw=False,
+                 heavy=False, route=None, limited=False):
+        self.name = name
+        self.handler = handler
+        # urutan field setelah nama command pada protokol teks
+        self.args = tuple(args)
+        # field tambahan di akhir baris yang boleh tidak dikirim
+        self.optional = tuple(optional)
+        # field terakhir yang mengambil sisa baris (isi pesan)
+        self.rest = rest
+        self.types = types or {}
+        # session=True: sessionid di-resolve sekali menjadi username pengirim
+        self.session = session
+        self.user = user
+        # raw=True: baris asli ikut dikirim sebagai argumen data (diteruskan ke realm lain)
+        self.raw = raw
+        # heavy=True: decode/tulis file atau menunggu realm, dijalankan server di worker pool terpisah
+        self.heavy = heavy
+        # field yang menentukan shard pemilik command di mode multi-proses (token session, username, atau realm)
+        self.route = route or ('sessionid' if 'sessionid' in self.args else None)
+        self.route_index = self.args.index(self.route) + 1 if self.route in self.args else None
+        # limited=True: dibatasi token bucket session (Session.batasi), dipakai command pengirim pesan
+        self.limited = limited
+        self.params = frozenset(inspect.signature(handler).parameters)
+
+    def parse(self, data):
+        # hanya field header yang dipisah; isi pesan diambil utuh sebagai sisa baris
+        n = len(self.args)
+        j = data.split(" ", n + 1)
+        args = {}
+        for i, field in enumerate(self.args, start=1):
+            args[field] = j[i].strip()
+        if self.optional:
+            j = data.split(None, n + len(self.optional) + 1)
+            for i, field in enumerate(self.optional, start=n + 1):
+                if i < len(j):
+                    args[field] = j[i].strip()
+        if self.rest is not None:
+            message = j[n + 1] if len(j) > n + 1 else ""
+            if message.endswith("\r\n"):
+                message = message[:-2]
+            args[self.rest] = message
+        return args
+
+    def kunci(self, data):
+        # nilai field route dari baris teks tanpa mem-parse isi pesan; None bila tidak ada
+        if self.route_index is None:
+            return None
+        j = data.split(" ", self.route_index + 1)
+        return j[self.route_index].strip() if len(j) > self.route_index else None
+
+
+class CommandRegistry:
+    # Peta nama command -> handler. Menambah command cukup dengan register(),
+    # tanpa menyentuh rantai if/elif di Chat.proses.
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.commands = {}
+        self.hooks = []
+
+    def register(self, name, handler, args=(), **options):
+        self.commands[name] = Command(name, handler, args, **options)
+
+    def add_hook(self, hook):
+        # hook(nama_command, durasi_detik, hasil) dipanggil setelah setiap command
+        self.hooks.append(hook)
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def dispatch(self, command, args, data=None, conn=None):
+        for field, convert in command.types.items():
+            if field in args:
+                args[field] = convert(args[field])
+        if command.session:
+            session = self.sessions.get(args['sessionid'])
+            if session is None:
+                # token tidak dikenal, sudah logout, atau kedaluwarsa
+                return {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+            args[command.user] = session['username']
+            # handler yang butuh state session (posisi baca inbox) menerimanya langsung, tanpa lookup ulang
+            args['session'] = session
+            if command.limited:
+                tunggu = session.batasi()
+                if tunggu:
+                    return {'status': 'ERROR', 'message': 'Server sibuk', 'retry_after': round(tunggu, 3)}
+        if command.raw:
+            args['data'] = data
+        if conn is not None:
+            args['conn'] = conn
+        kwargs = {key: value for key, value in args.items() if key in command.params}
+        start = time.perf_counter()
+        hasil = command.handler(**kwargs)
+        if self.hooks:
+            durasi = time.perf_counter() - start
+            for hook in self.hooks:
+                hook(command.name, durasi, hasil)
+        return hasil
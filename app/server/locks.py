@@ -0,0 +1,16 @@
+import os
+import threading
+
+# jumlah lock per StripedLock; dua key berbeda berbagi lock dengan peluang 1/LOCK_STRIPES
+LOCK_STRIPES = int(os.getenv("LOCK_STRIPES") or "64")
+
+
+class StripedLock:
+    # Sekumpulan lock yang dipilih menurut hash key (username / nama group). Operasi pada key
+    # berbeda hampir selalu memakai lock berbeda sehingga bisa berjalan paralel, tanpa menyimpan
+    # satu lock per key dan tanpa lock global. Satu thread hanya boleh memegang satu stripe.
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def kunci(self, key):
+        return self.locks[hash(key) % len(self.locks)]
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from itertools import islice
+from messages import Message
+
+MAILBOX_SIZE = int(os.getenv("MAILBOX_SIZE") or "10000")
+
+
+class Mailbox:
+    # Kotak pesan satu user. Setiap pesan mendapat nomor urut (seq) yang terus naik dan
+    # disimpan di ring buffer; membaca tidak menghapus pesan, pembaca cukup menyimpan
+    # seq terakhir yang sudah dilihat (cursor). Pesan tertua dibuang bila kapasitas penuh.
+    def __init__(self, capacity=MAILBOX_SIZE, on_evict=None):
+        self.entries = deque(maxlen=capacity)
+        # dipanggil dengan pesan yang terbuang dari ring buffer (melepas referensi lampiran)
+        self.on_evict = on_evict
+        self.last_seq = 0
+        # last_seq dari snapshot (load); semua seq sampai di sini sudah tercakup snapshot
+        self.loaded_seq = 0
+        self.lock = threading.Lock()
+        # callback sekali pakai yang dipanggil saat pesan berikutnya masuk (inbox-wait)
+        self.waiters = []
+
+    def append(self, sender, message):
+        with self.lock:
+            self.last_seq += 1
+            seq = self.last_seq
+            self.simpan(seq, sender, message)
+            waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter()
+        return seq
+
+    def simpan(self, seq, sender, message):
+        if self.on_evict is not None and len(self.entries) == self.entries.maxlen:
+            self.on_evict(self.entries[0][2])
+        self.entries.append((seq, sender, message))
+
+    def add_waiter(self, cursor, waiter):
+        # False bila sudah ada pesan setelah cursor, jadi tidak perlu menunggu
+        with self.lock:
+            if self.last_seq > cursor:
+                return False
+            self.waiters.append(waiter)
+            return True
+
+    def remove_waiter(self, waiter):
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def restore(self, seq, sender, message):
+        # dipakai saat replay WAL: seq yang sudah ada diabaikan sehingga replay idempoten. Seq diambil di
+        # bawah lock tetapi record WAL ditulis setelahnya, jadi dua pengirim bersamaan bisa tercatat
+        # terbalik; seq yang lebih kecil dari last_seq disisipkan di posisinya, bukan dibuang
+        with self.lock:
+            if seq > self.last_seq:
+                self.last_seq = seq
+                self.simpan(seq, sender, message)
+                return True
+            full = len(self.entries) == self.entries.maxlen
+            if seq <= self.loaded_seq or (full and seq < self.entries[0][0]):
+                # sudah ada di snapshot, atau lebih tua dari isi ring buffer (sudah terbuang)
+                return False
+            posisi = len(self.entries)
+            while posisi > 0 and self.entries[posisi - 1][0] > seq:
+                posisi -= 1
+            if posisi > 0 and self.entries[posisi - 1][0] == seq:
+                return False
+            if full:
+                # pesan tertua dibuang dulu agar ada tempat untuk disisipkan
+                if self.on_evict is not None:
+                    self.on_evict(self.entries[0][2])
+                self.entries.popleft()
+                posisi -= 1
+            self.entries.insert(posisi, (seq, sender, message))
+            return True
+
+    def dump(self):
+        with self.lock:
+            return {'last_seq': self.last_seq, 'entries': [(seq, sender, message.dump()) for seq, sender, message in self.entries]}
+
+    def load(self, state):
+        with self.lock:
+            self.entries.clear()
+            self.entries.extend((seq, sender, Message.load(message)) for seq, sender, message in state['entries'])
+            self.last_seq = self.loaded_seq = state['last_seq']
+
+    def since(self, cursor):
+        # pesan dengan seq > cursor, dibaca dari ujung kanan sehingga biayanya sebanding jumlah pesan baru
+        with self.lock:
+            count = min(self.last_seq - cursor, len(self.entries))
+            if count <= 0:
+                return [], self.last_seq
+            entries = list(islice(reversed(self.entries), count))
+            entries.reverse()
+            return entries, self.last_seq
+
+
+class PendingReply:
+    # Balasan inbox-wait yang belum siap. Server thread memanggil wait() (blok di thread koneksi itu),
+    # server asyncio memanggil wait_async() sehingga client yang menunggu hanya memakan satu future.
+    # watches: pasangan (mailbox, cursor) yang diawasi, yaitu inbox user dan timeline group-nya.
+    def __init__(self, watches, timeout, selesai):
+        self.watches = watches
+        self.timeout = timeout
+        self.selesai = selesai
+
+    def pasang(self, waiter):
+        # False bila salah satu mailbox sudah punya pesan baru
+        for i, (mailbox, cursor) in enumerate(self.watches):
+            if not mailbox.add_waiter(cursor, waiter):
+                self.lepas(waiter, i)
+                return False
+        return True
+
+    def lepas(self, waiter, count=None):
+        for mailbox, cursor in self.watches[:count]:
+            mailbox.remove_waiter(waiter)
+
+    def wait(self):
+        event = threading.Event()
+        if self.pasang(event.set):
+            event.wait(self.timeout)
+            self.lepas(event.set)
+        return self.selesai()
+
+    async def wait_async(self, executor=None):
+        # executor: pool tempat selesai() (membaca inbox) dijalankan, agar event loop tidak ikut bekerja
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def bangun():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        if self.pasang(bangun):
+            try:
+                await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.lepas(bangun)
+        if executor is not None:
+            return await loop.run_in_executor(executor, self.selesai)
+        return self.selesai()
@@ -0,0 +1,63 @@
+class FrameBuffer:
+    # Penampung byte dari socket yang memotong aliran menjadi frame berdasarkan terminator.
+    # Hanya byte yang baru diterima yang dipindai, dan setiap frame di-decode sekali saja,
+    # sehingga payload besar (mis. sendfile base64) tidak lagi disalin ulang setiap recv.
+    def __init__(self, terminator=b'\r\n', encoding='utf-8'):
+        self.terminator = terminator
+        self.encoding = encoding
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+        return self.potong()
+
+    def potong(self, limit=None):
+        frames = []
+        start = 0
+        with memoryview(self.buffer) as view:
+            while limit is None or len(frames) < limit:
+                idx = self.buffer.find(self.terminator, self.scanned)
+                if idx == -1:
+                    break
+                end = idx + len(self.terminator)
+                frames.append(str(view[start:end], self.encoding))
+                start = end
+                self.scanned = end
+        if start:
+            del self.buffer[:start]
+        if limit is not None and len(frames) == limit:
+            # sisa buffer belum dipindai
+            self.scanned = 0
+        else:
+            # terminator bisa terpotong di antara dua recv, jadi mundur sedikit dari ujung buffer
+            self.scanned = max(0, len(self.buffer) - len(self.terminator) + 1)
+        return frames
+
+    def pending(self):
+        return len(self.buffer)
+
+    def read_frame(self, sock, bufsize=65536):
+        # ambil satu frame utuh dari socket; byte sesudahnya tetap di buffer untuk panggilan berikutnya
+        while True:
+            frames = self.potong(1)
+            if frames:
+                return frames[0]
+            data = sock.recv(bufsize)
+            if not data:
+                return None
+            self.buffer += data
+
+    def read_raw(self, sock, count, fh, bufsize=65536):
+        # byte mentah sesudah frame (isi file download) ditulis ke fh tanpa dipindai sebagai frame
+        take = min(count, len(self.buffer))
+        fh.write(self.buffer[:take])
+        del self.buffer[:take]
+        self.scanned = 0
+        count -= take
+        while count > 0:
+            data = sock.recv(min(bufsize, count))
+            if not data:
+                raise ConnectionError('koneksi terputus saat menerima file')
+            fh.write(data)
+            count -= len(data)
@@ -4,6 +4,7 @@ import threading
 import json
 import logging
 from chat import Chat
+from framing import FrameBuffer
 
 chatserver = Chat()
 
@@ -14,20 +15,18 @@ class ProcessTheClient(threading.Thread):
 		threading.Thread.__init__(self)
 
 	def run(self):
-		rcv=""
+		frames = FrameBuffer(b'\r\n')
 		while True:
 			data = self.connection.recv(2048)
 			if data:
-				d = data.decode()
-				rcv=rcv+d
-				if rcv[-2:]=='\r\n':
-					#end of command, proses string
-					logging.warning("data dari client: {}" . format(rcv))
-					hasil = json.dumps(chatserver.proses(rcv))
+				#satu recv bisa berisi beberapa command (link realm mengirim tanpa menunggu balasan),
+				#jadi setiap baris diproses dan dibalas sendiri-sendiri sesuai urutan
+				for line in frames.feed(data):
+					logging.warning("data dari client: {}" . format(line))
+					hasil = json.dumps(chatserver.proses(line))
 					hasil=hasil+"\r\n\r\n"
 					logging.warning("balas ke  client: {}" . format(hasil))
 					self.connection.sendall(hasil.encode())
-					rcv=""
 			else:
 				break
 		self.connection.close()
@@ -0,0 +1,60 @@
+import base64
+import json
+
+
+class Message:
+    # Satu pesan chat. Objek yang sama dimasukkan ke outgoing pengirim, incoming penerima,
+    # timeline group, dan antrian realm; isi pesan dan isi file tidak disalin per penerima.
+    # Field yang bergantung pada penerima (msg_to) baru ditambahkan saat pesan dikirim ke client.
+    # Isi lampiran ada di BlobStore dan hanya direferensikan lewat blob_id.
+    __slots__ = ('msg_from', 'msg', 'group', 'file_name', 'file_content', 'blob_id', 'file_size')
+
+    def __init__(self, msg_from, msg=None, group=None, file_name=None, file_content=None, blob_id=None, file_size=None):
+        self.msg_from = msg_from
+        self.msg = msg
+        self.group = group
+        self.file_name = file_name
+        # file_content hanya ada pada pesan lama yang dipulihkan dari WAL/database
+        self.file_content = file_content
+        self.blob_id = blob_id
+        self.file_size = file_size
+
+    def to_dict(self, msg_to=None, blobs=None):
+        # urutan key sama dengan format pesan sebelumnya
+        pesan = {}
+        if self.group is not None:
+            pesan['group'] = self.group
+        pesan['msg_from'] = self.msg_from
+        if msg_to is not None:
+            pesan['msg_to'] = msg_to
+        if self.file_name is None:
+            pesan['msg'] = self.msg
+        else:
+            pesan['file_name'] = self.file_name
+            if self.blob_id is None:
+                pesan['file_content'] = self.file_content
+            elif blobs is not None:
+                # isi file ikut dikirim (antrian realm)
+                pesan['file_content'] = base64.b64encode(blobs.read(self.blob_id)).decode()
+            else:
+                # inbox dan push hanya membawa metadata, isi diambil lewat command download
+                pesan['blob_id'] = self.blob_id
+                pesan['size'] = self.file_size
+        return pesan
+
+    def to_inbox(self, msg_to=None, blobs=None):
+        # di inbox, pesan file dikirim sebagai string JSON seperti semula
+        pesan = self.to_dict(msg_to, blobs)
+        if self.file_name is not None:
+            return json.dumps(pesan)
+        return pesan
+
+    def dump(self):
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+    @classmethod
+    def load(cls, data):
+        # data lama bisa berupa dict dengan msg_to atau string JSON (pesan file)
+        if isinstance(data, str):
+            data = json.loads(data)
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
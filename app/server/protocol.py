@@ -0,0 +1,105 @@
+import json
+import struct
+from collections import deque
+
+# Protokol biner (dinegosiasikan dengan command teks "protocol binary").
+# Setiap frame: header tetap + token session + meta (JSON) + blob (byte mentah)
+#   magic(2) versi(1) opcode(1) panjang_token(1) panjang_meta(4) panjang_blob(4)
+HEADER = struct.Struct('!2sBBBII')
+MAGIC = b'CB'
+VERSION = 1
+REPLY = 0x80
+# frame yang dikirim server tanpa diminta (push pesan baru)
+PUSH = 0x7E
+
+OPCODES = {
+    1: 'auth',
+    2: 'register',
+    3: 'addgroup',
+    4: 'joingroup',
+    5: 'send',
+    6: 'sendgroup',
+    7: 'inbox',
+    8: 'sendfile',
+    9: 'sendgroupfile',
+    10: 'logout',
+    11: 'info',
+    12: 'subscribe',
+    13: 'upload-begin',
+    14: 'upload-chunk',
+    15: 'upload-commit',
+    16: 'download',
+    17: 'upload-status',
+    18: 'logoutall',
+    # command teks lama yang dibungkus utuh di blob, agar semua command tetap tersedia di mode biner
+    127: 'text',
+}
+COMMANDS = {command: opcode for opcode, command in OPCODES.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(opcode, sessionid="", meta=None, blob=b''):
+    return encode_header(opcode, sessionid, meta, len(blob)) + blob
+
+
+def encode_header(opcode, sessionid="", meta=None, bloblen=0):
+    # semua bagian frame kecuali blob; dipakai download yang mengirim blob langsung dari file
+    sid = sessionid.encode()
+    body = json.dumps(meta or {}).encode()
+    header = HEADER.pack(MAGIC, VERSION, opcode, len(sid), len(body), bloblen)
+    return b''.join([header, sid, body])
+
+
+class BinaryFrameBuffer:
+    # Pasangan FrameBuffer untuk mode biner: panjang frame diketahui dari header,
+    # jadi payload tidak perlu dipindai sama sekali.
+    def __init__(self, batas=None):
+        self.buffer = bytearray()
+        # ukuran frame maksimum; diperiksa dari header, sebelum payload-nya ditampung
+        self.batas = batas
+        self.frames = deque()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= HEADER.size:
+            magic, version, opcode, sidlen, metalen, bloblen = HEADER.unpack_from(self.buffer, start)
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError('Header frame tidak dikenal')
+            end = start + HEADER.size + sidlen + metalen + bloblen
+            if self.batas is not None and end - start > self.batas:
+                raise ProtocolError('Frame Terlalu Besar')
+            if len(self.buffer) < end:
+                break
+            pos = start + HEADER.size
+            try:
+                sessionid = self.buffer[pos:pos + sidlen].decode()
+                pos += sidlen
+                meta = json.loads(self.buffer[pos:pos + metalen]) if metalen else {}
+            except ValueError:
+                # termasuk UnicodeDecodeError; frame sesudahnya tidak bisa dipercaya lagi
+                raise ProtocolError('Frame Tidak Valid')
+            if not isinstance(meta, dict):
+                raise ProtocolError('Meta Frame Harus Objek JSON')
+            pos += metalen
+            blob = bytes(self.buffer[pos:end])
+            frames.append((opcode, sessionid, meta, blob))
+            start = end
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def pending(self):
+        return len(self.buffer)
+
+    def read_frame(self, sock, bufsize=65536):
+        while not self.frames:
+            data = sock.recv(bufsize)
+            if not data:
+                return None
+            self.frames.extend(self.feed(data))
+        return self.frames.popleft()
@@ -0,0 +1,34 @@
+import logging
+import threading
+
+
+class PushHub:
+    # Daftar koneksi yang berlangganan push per username. Koneksi cukup punya method
+    # push(payload) yang tidak boleh memblok (antrian kirim koneksi itu sendiri yang dibatasi),
+    # sehingga pengirim pesan tidak tertahan oleh pembaca yang lambat.
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, username, conn):
+        with self.lock:
+            self.subscribers.setdefault(username, set()).add(conn)
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            for username in [u for u, conns in self.subscribers.items() if conn in conns]:
+                self.subscribers[username].discard(conn)
+                if not self.subscribers[username]:
+                    del self.subscribers[username]
+
+    def publish(self, username, payload):
+        return self.publish_many([username], payload)
+
+    def publish_many(self, usernames, payload):
+        # satu payload yang sama untuk banyak user (anggota group), lock diambil sekali saja
+        with self.lock:
+            conns = [(username, conn) for username in usernames for conn in self.subscribers.get(username, ())]
+        for username, conn in conns:
+            if not conn.push(payload):
+                logging.warning("PUSH: antrian koneksi {} penuh, push dibuang".format(username))
+        return len(conns)
@@ -1,60 +1,515 @@
 from socket import *
 import socket
 import threading
+import asyncio
 import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from chat import Chat
+from mailboxes import PendingReply
+from blobs import FileReply
+from framing import FrameBuffer
+from protocol import BinaryFrameBuffer, ProtocolError, OPCODES, REPLY, PUSH, encode_frame, encode_header
+from queue import Queue, Full
+from shards import SERVER_PROCESSES, SUPERVISOR, supervisi
 
-chatserver = Chat()
+SERVER_IP = os.getenv("SERVER_IP") or "0.0.0.0"
+SERVER_PORT = int(os.getenv("SERVER_PORT") or "8889")
+# thread = satu thread per koneksi, async = satu event loop untuk semua koneksi
+SERVER_MODE = os.getenv("SERVER_MODE") or "thread"
+# batas frame yang menunggu dikirim per koneksi; push dibuang bila penuh (client bisa menyusul lewat inbox cursor)
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE") or "256")
+# command dijalankan di worker pool, bukan di thread/event loop yang membaca socket. Command berat
+# (file, realm) punya pool sendiri agar upload besar tidak menahan send/inbox user lain
+WORKER_THREADS = int(os.getenv("WORKER_THREADS") or "8")
+HEAVY_WORKERS = int(os.getenv("HEAVY_WORKERS") or "4")
+# antrian koneksi yang belum di-accept, agar reconnect serentak tidak ditolak kernel
+LISTEN_BACKLOG = int(os.getenv("LISTEN_BACKLOG") or "128")
+# koneksi aktif per proses; koneksi baru di atas batas ini dibalas "Server sibuk" lalu ditutup
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS") or "1024")
+# ukuran satu command/frame dari client; lebih besar dibalas error lalu koneksi ditutup
+# (file besar dikirim bertahap lewat upload-chunk)
+MAX_FRAME_SIZE = int(os.getenv("MAX_FRAME_SIZE") or str(16 * 1024 * 1024))
+# byte balasan/push yang belum terkirim per koneksi; di atas batas ini command berikutnya dari koneksi
+# tersebut menunggu client membaca dan push dibuang
+OUTBOUND_MAX_BYTES = int(os.getenv("OUTBOUND_MAX_BYTES") or str(4 * 1024 * 1024))
+SIBUK = {'status': 'ERROR', 'message': 'Server sibuk'}
+# lama sisa kiriman client dibuang sebelum koneksi yang melanggar protokol ditutup (detik)
+LINGER_TIMEOUT = 1.0
+
+#proses induk mode multi-proses tidak melayani client, jadi tidak punya Chat (lihat shards.supervisi)
+chatserver = Chat() if not SUPERVISOR else None
+workers = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix='worker')
+heavy_workers = ThreadPoolExecutor(HEAVY_WORKERS, thread_name_prefix='heavy')
+
+def pool(berat):
+	return heavy_workers if berat else workers
+
+def ukuran(data):
+	#FileReply hanya dihitung header-nya, isi file dikirim langsung dari disk
+	return len(data.header) if isinstance(data, FileReply) else len(data)
+
+class Pembatas:
+	#jumlah koneksi aktif di proses ini, dipakai bersama mode thread dan async
+	def __init__(self, batas):
+		self.batas = batas
+		self.aktif = 0
+		self.lock = threading.Lock()
+
+	def masuk(self, paksa=False):
+		#paksa: koneksi serahan shard lain, sudah diterima oleh shard asalnya
+		with self.lock:
+			if (self.aktif >= self.batas and not paksa):
+				return False
+			self.aktif += 1
+			return True
+
+	def keluar(self):
+		with self.lock:
+			self.aktif -= 1
+
+koneksi = Pembatas(MAX_CONNECTIONS)
+
+def tolak(connection, address):
+	#tidak menunggu client membaca: balasan sekecil ini selalu muat di buffer socket
+	logging.warning("koneksi {} ditolak, {} koneksi aktif" . format(address, koneksi.aktif))
+	try:
+		connection.send(ClientProtocol().balas(SIBUK))
+	except OSError:
+		pass
+	connection.close()
+
+class ClientProtocol:
+	#status protokol satu koneksi: teks CRLF secara default, pindah ke biner setelah "protocol binary"
+	def __init__(self, binary=False):
+		self.frames = FrameBuffer(b'\r\n')
+		self.binary = BinaryFrameBuffer(MAX_FRAME_SIZE) if binary else None
+		self.outbound = None
+		#(shard, byte yang belum dijalankan, mode biner) bila koneksi harus diserahkan ke shard lain
+		self.pindah = None
+
+	def feed(self, data):
+		#hanya memotong frame; menghasilkan (job, opcode, berat) dengan job() yang menjalankan command.
+		#opcode None berarti balasan teks. job() bisa mengembalikan PendingReply (inbox-wait) yang
+		#ditunggu oleh server masing-masing. Server menjalankan job satu per satu per koneksi, urutan balasan tetap.
+		#Mode multi-proses: command milik shard lain dan semua byte sesudahnya tidak dijalankan di sini,
+		#melainkan disimpan di self.pindah agar server menyerahkan koneksi ini ke shard tersebut
+		balasan = []
+		if (self.binary is not None):
+			frames = self.binary.feed(data)
+			for i, (opcode, sessionid, meta, blob) in enumerate(frames):
+				logging.warning("frame biner dari client: opcode {} meta {} blob {} byte" . format(opcode, meta, len(blob)))
+				command = OPCODES.get(opcode)
+				shard = None
+				if (command is None):
+					job = partial(dict, status='ERROR', message='**Protocol Tidak Benar')
+					berat = False
+				elif (command=='text'):
+					try:
+						rcv = blob.decode()
+					except UnicodeDecodeError:
+						raise ProtocolError('Frame Tidak Valid')
+					job = partial(chatserver.proses, rcv, defer=True, conn=self.outbound)
+					berat = chatserver.berat(rcv.split(" ", 1)[0].strip())
+					shard = chatserver.shard_teks(rcv)
+				else:
+					job = partial(chatserver.proses_frame, command, sessionid, meta, blob, defer=True, conn=self.outbound)
+					berat = chatserver.berat(command)
+					shard = chatserver.shard_frame(command, sessionid, meta)
+				if (shard is not None):
+					sisa = b''.join(encode_frame(*frame) for frame in frames[i:]) + bytes(self.binary.buffer)
+					self.pindah = (shard, sisa, True)
+					break
+				balasan.append((job, opcode, berat))
+			return balasan
+		#satu recv bisa berisi beberapa command sekaligus (pipelining)
+		try:
+			frames = self.frames.feed(data)
+		except UnicodeDecodeError:
+			#command teks harus UTF-8; byte acak dianggap pelanggaran protokol, bukan error server
+			raise ProtocolError('Frame Tidak Valid')
+		if (self.frames.pending() > MAX_FRAME_SIZE):
+			#command yang belum ada terminatornya sudah melebihi batas, tidak ditampung lebih jauh
+			raise ProtocolError('Frame Terlalu Besar')
+		for i, rcv in enumerate(frames):
+			logging.warning("data dari client: {}" . format(rcv))
+			if (rcv.split()==['protocol', 'binary']):
+				#client wajib menunggu balasan ini sebelum mengirim frame biner
+				balasan.append((partial(dict, status='OK', protocol='binary'), None, False))
+				self.binary = BinaryFrameBuffer(MAX_FRAME_SIZE)
+				balasan.extend(self.feed(bytes(self.frames.buffer)))
+				break
+			shard = chatserver.shard_teks(rcv)
+			if (shard is not None):
+				self.pindah = (shard, ''.join(frames[i:]).encode() + bytes(self.frames.buffer), False)
+				break
+			job = partial(chatserver.proses, rcv, defer=True, conn=self.outbound)
+			balasan.append((job, None, chatserver.berat(rcv.split(" ", 1)[0].strip())))
+		return balasan
+
+	def balas_error(self, message):
+		#balasan sebelum koneksi ditutup karena pelanggaran protokol; di mode biner tanpa opcode command
+		return self.balas({'status': 'ERROR', 'message': message}, 0 if self.binary is not None else None)
+
+	def balas_push(self, payload):
+		return self.balas(payload, PUSH if self.binary is not None else None)
+
+	def balas(self, hasil, opcode=None):
+		if isinstance(hasil, FileReply):
+			#isi file tidak ikut di-encode, penulis koneksi mengirimnya langsung dari disk
+			if (opcode is not None):
+				hasil.header = encode_header(opcode | REPLY, meta=hasil.meta, bloblen=hasil.count)
+			else:
+				hasil.header = (json.dumps(hasil.meta)+"\r\n\r\n").encode()
+			return hasil
+		if (opcode is not None):
+			return encode_frame(opcode | REPLY, meta=hasil)
+		hasil = json.dumps(hasil)
+		hasil=hasil+"\r\n\r\n"
+		logging.warning("balas ke  client: {}" . format(hasil))
+		return hasil.encode()
+
+class Outbound(threading.Thread):
+	#antrian kirim satu koneksi: balasan dan push ditulis oleh satu thread agar frame tidak bercampur
+	def __init__(self, connection, protokol):
+		self.connection = connection
+		self.protokol = protokol
+		self.queue = Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+		#byte di antrian yang belum terkirim
+		self.bytes = 0
+		self.cond = threading.Condition()
+		self.error = False
+		threading.Thread.__init__(self, daemon=True)
+
+	def send(self, data):
+		#backpressure: thread koneksi berhenti membaca command baru sampai client membaca balasannya
+		with self.cond:
+			while (self.bytes > OUTBOUND_MAX_BYTES):
+				self.cond.wait()
+			self.bytes += ukuran(data)
+		self.queue.put(data)
+
+	def push(self, payload):
+		#dipanggil dari thread pengirim pesan, tidak boleh menunggu pembaca yang lambat
+		data = self.protokol.balas_push(payload)
+		with self.cond:
+			if (self.bytes + len(data) > OUTBOUND_MAX_BYTES):
+				return False
+			self.bytes += len(data)
+		try:
+			self.queue.put_nowait(data)
+			return True
+		except Full:
+			self.terkirim(len(data))
+			return False
+
+	def terkirim(self, count):
+		with self.cond:
+			self.bytes -= count
+			self.cond.notify_all()
+
+	def close(self):
+		self.queue.put(None)
+		self.join()
+
+	def run(self):
+		while True:
+			data = self.queue.get()
+			if data is None:
+				break
+			try:
+				if self.error:
+					pass
+				elif isinstance(data, FileReply):
+					self.connection.sendall(data.header)
+					#zero-copy: kernel menyalin isi file langsung ke socket
+					self.connection.sendfile(data.fh, data.offset, data.count)
+				else:
+					self.connection.sendall(data)
+			except OSError:
+				self.error = True
+			finally:
+				if isinstance(data, FileReply):
+					data.fh.close()
+				self.terkirim(ukuran(data))
+
+def buat_listener(backlog):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if (SERVER_PROCESSES > 1):
+		#semua proses shard bind ke port yang sama, kernel membagi koneksi baru di antara mereka
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((SERVER_IP,SERVER_PORT))
+	sock.listen(backlog)
+	return sock
+
+def serahkan(connection, protokol):
+	#dipanggil setelah semua balasan sebelumnya terkirim; shard tujuan melanjutkan dari command yang diserahkan
+	shard, sisa, binary = protokol.pindah
+	try:
+		chatserver.shards.serahkan(shard, connection, sisa, binary)
+		logging.warning("koneksi diserahkan ke shard {}" . format(shard))
+	except OSError as e:
+		logging.warning("koneksi gagal diserahkan ke shard {}: {}" . format(shard, e))
+
+def tutup_pelan(connection):
+	#socket yang ditutup dengan data masuk belum terbaca mengirim RST, dan client kehilangan balasan
+	#error yang belum sempat dibacanya; sisa kiriman dibaca lalu dibuang, paling lama LINGER_TIMEOUT
+	batas = time.monotonic() + LINGER_TIMEOUT
+	try:
+		connection.shutdown(socket.SHUT_WR)
+		while True:
+			sisa = batas - time.monotonic()
+			if sisa <= 0:
+				break
+			connection.settimeout(sisa)
+			if not connection.recv(65536):
+				break
+	except OSError:
+		pass
 
 class ProcessTheClient(threading.Thread):
-	def __init__(self, connection, address):
+	def __init__(self, connection, address, protokol=None, awal=b''):
 		self.connection = connection
 		self.address = address
+		#koneksi yang diserahkan shard lain: status protokol dan byte yang belum dijalankan
+		self.protokol = protokol or ClientProtocol()
+		self.awal = awal
 		threading.Thread.__init__(self)
 
 	def run(self):
-		rcv=""
-		while True:
-			data = self.connection.recv(2048)
-			if data:
-				d = data.decode()
-				rcv=rcv+d
-				if rcv[-2:]=='\r\n':
-					#end of command, proses string
-					logging.warning("data dari client: {}" . format(rcv))
-					hasil = json.dumps(chatserver.proses(rcv))
-					hasil=hasil+"\r\n\r\n"
-					logging.warning("balas ke  client: {}" . format(hasil))
-					self.connection.sendall(hasil.encode())
-					rcv=""
-			else:
-				break
-		self.connection.close()
+		protokol = self.protokol
+		keluar = Outbound(self.connection, protokol)
+		protokol.outbound = keluar
+		keluar.start()
+		salah = False
+		try:
+			data = self.awal or self.connection.recv(65536)
+			while data:
+				for job, opcode, berat in protokol.feed(data):
+					#thread koneksi hanya membaca/menulis socket; jumlah command yang berjalan dibatasi ukuran pool
+					hasil = pool(berat).submit(job).result()
+					if isinstance(hasil, PendingReply):
+						hasil = hasil.wait()
+					keluar.send(protokol.balas(hasil, opcode))
+				if (protokol.pindah is not None):
+					break
+				data = self.connection.recv(65536)
+		except ProtocolError as e:
+			logging.warning("koneksi {} ditutup: {}" . format(self.address, e))
+			keluar.send(protokol.balas_error(str(e)))
+			salah = True
+		except ConnectionError as e:
+			logging.warning("koneksi {} ditutup: {}" . format(self.address, e))
+		except Exception:
+			#command yang gagal tak terduga menutup koneksi ini saja; koneksi tidak diserahkan ke shard lain
+			logging.exception("koneksi {} ditutup karena error" . format(self.address))
+			protokol.pindah = None
+		finally:
+			#slot koneksi, socket, dan thread penulis selalu dilepas, apa pun penyebab thread ini berhenti
+			chatserver.push.unsubscribe(keluar)
+			keluar.close()
+			if salah:
+				tutup_pelan(self.connection)
+			if (protokol.pindah is not None):
+				serahkan(self.connection, protokol)
+			self.connection.close()
+			koneksi.keluar()
+
+	@staticmethod
+	def terima(connection, binary, sisa):
+		#koneksi dari shard lain (ShardRouter.terima_serahan)
+		connection.setblocking(True)
+		try:
+			address = connection.getpeername()
+		except OSError:
+			address = None
+		koneksi.masuk(paksa=True)
+		ProcessTheClient(connection, address, ClientProtocol(binary), sisa).start()
 
 class Server(threading.Thread):
 	def __init__(self):
-		self.the_clients = []
-		self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		threading.Thread.__init__(self)
 
 	def run(self):
-		self.my_socket.bind(('0.0.0.0',8889))
-		self.my_socket.listen(1)
+		self.my_socket = buat_listener(LISTEN_BACKLOG)
 		while True:
 			self.connection, self.client_address = self.my_socket.accept()
+			if not koneksi.masuk():
+				tolak(self.connection, self.client_address)
+				continue
 			logging.warning("connection from {}" . format(self.client_address))
 			
-			clt = ProcessTheClient(self.connection, self.client_address)
-			clt.start()
-			self.the_clients.append(clt)
+			#thread koneksi tidak disimpan: selesai sendiri dan dibuang setelah koneksinya ditutup
+			ProcessTheClient(self.connection, self.client_address).start()
+
+class AsyncOutbound:
+	#pasangan Outbound untuk server asyncio; push dari thread lain masuk lewat call_soon_threadsafe
+	def __init__(self, sock, protokol):
+		self.sock = sock
+		self.protokol = protokol
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+		#self.bytes hanya diubah di event loop, jadi tidak perlu lock
+		self.bytes = 0
+		self.cond = asyncio.Condition()
+		self.selesai = False
+
+	async def send(self, data):
+		async with self.cond:
+			await self.cond.wait_for(lambda: self.bytes <= OUTBOUND_MAX_BYTES or self.selesai)
+		if data is not None:
+			self.bytes += ukuran(data)
+		await self.queue.put(data)
+
+	def push(self, payload):
+		if self.queue.full() or self.bytes > OUTBOUND_MAX_BYTES:
+			return False
+		self.loop.call_soon_threadsafe(self.taruh, self.protokol.balas_push(payload))
+		return True
+
+	def taruh(self, data):
+		if self.queue.full() or self.bytes + len(data) > OUTBOUND_MAX_BYTES:
+			logging.warning("push dibuang, antrian koneksi penuh")
+			return
+		self.bytes += len(data)
+		self.queue.put_nowait(data)
+
+	async def run(self):
+		#None = semua yang diantrikan sebelumnya sudah terkirim
+		try:
+			while True:
+				data = await self.queue.get()
+				if data is None:
+					break
+				try:
+					if isinstance(data, FileReply):
+						await self.loop.sock_sendall(self.sock, data.header)
+						await self.loop.sock_sendfile(self.sock, data.fh, data.offset, data.count)
+					else:
+						await self.loop.sock_sendall(self.sock, data)
+				finally:
+					if isinstance(data, FileReply):
+						data.fh.close()
+					self.bytes -= ukuran(data)
+				async with self.cond:
+					self.cond.notify_all()
+		finally:
+			#penulis berhenti: send() yang sedang menunggu tidak boleh tertahan selamanya
+			self.selesai = True
+			async with self.cond:
+				self.cond.notify_all()
+
+class AsyncServer:
+	#socket dibaca langsung dengan loop.sock_recv (bukan StreamReader) agar tidak ada byte yang tertahan
+	#di buffer asyncio saat koneksi diserahkan ke shard lain
+	def __init__(self):
+		self.tasks = set()
+
+	async def handle_client(self, sock, address, protokol=None, awal=b''):
+		logging.warning("connection from {}" . format(address))
+		loop = asyncio.get_running_loop()
+		protokol = protokol or ClientProtocol()
+		keluar = AsyncOutbound(sock, protokol)
+		protokol.outbound = keluar
+		penulis = asyncio.create_task(keluar.run())
+		try:
+			data = awal or await loop.sock_recv(sock, 65536)
+			while data:
+				for job, opcode, berat in protokol.feed(data):
+					#event loop tidak pernah menjalankan command sendiri, hanya menunggu hasil dari pool
+					hasil = await loop.run_in_executor(pool(berat), job)
+					if isinstance(hasil, PendingReply):
+						hasil = await hasil.wait_async(workers)
+					await keluar.send(protokol.balas(hasil, opcode))
+				if (protokol.pindah is not None):
+					break
+				data = await loop.sock_recv(sock, 65536)
+			if not penulis.done():
+				await keluar.send(None)
+				await penulis
+			if (protokol.pindah is not None):
+				await loop.run_in_executor(workers, serahkan, sock, protokol)
+		except ProtocolError as e:
+			logging.warning("koneksi {} ditutup: {}" . format(address, e))
+			if not penulis.done():
+				await keluar.send(protokol.balas_error(str(e)))
+				await keluar.send(None)
+				await asyncio.wait([penulis])
+			await self.tutup_pelan(sock)
+		except ConnectionError as e:
+			logging.warning("koneksi {} ditutup: {}" . format(address, e))
+		except Exception:
+			logging.exception("koneksi {} ditutup karena error" . format(address))
+		finally:
+			chatserver.push.unsubscribe(keluar)
+			penulis.cancel()
+			koneksi.keluar()
+			sock.close()
+
+	async def tutup_pelan(self, sock):
+		#pasangan tutup_pelan() untuk socket non-blocking
+		loop = asyncio.get_running_loop()
+		batas = loop.time() + LINGER_TIMEOUT
+		try:
+			sock.shutdown(socket.SHUT_WR)
+			while await asyncio.wait_for(loop.sock_recv(sock, 65536), max(0, batas - loop.time())):
+				pass
+		except (OSError, asyncio.TimeoutError):
+			pass
+
+	def mulai(self, sock, address, protokol=None, awal=b''):
+		#task disimpan sampai selesai agar tidak dibuang garbage collector
+		task = asyncio.create_task(self.handle_client(sock, address, protokol, awal))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	def terima(self, sock, binary, sisa):
+		#koneksi dari shard lain, dipanggil dari thread ShardRouter
+		sock.setblocking(False)
+		try:
+			address = sock.getpeername()
+		except OSError:
+			address = None
+		koneksi.masuk(paksa=True)
+		self.loop.call_soon_threadsafe(self.mulai, sock, address, ClientProtocol(binary), sisa)
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		listener = buat_listener(LISTEN_BACKLOG)
+		listener.setblocking(False)
+		if (chatserver.shards is not None):
+			chatserver.shards.terima_serahan(self.terima)
+		while True:
+			sock, address = await self.loop.sock_accept(listener)
+			if not koneksi.masuk():
+				tolak(sock, address)
+				continue
+			self.mulai(sock, address)
+
+	def run(self):
+		asyncio.run(self.serve())
 	
 
 def main():
-    print("Server is running...")
-    svr = Server()
-    svr.start()
+    if SUPERVISOR:
+        print("Server is running ({} mode, {} proses)..." . format(SERVER_MODE, SERVER_PROCESSES))
+        supervisi(os.path.realpath(__file__))
+        return
+    print("Server is running ({} mode)..." . format(SERVER_MODE))
+    if (SERVER_MODE=="async"):
+        svr = AsyncServer()
+        svr.run()
+    else:
+        if (chatserver.shards is not None):
+            chatserver.shards.terima_serahan(ProcessTheClient.terima)
+        svr = Server()
+        svr.start()
+        # thread utama tetap hidup: worker pool menolak job baru begitu interpreter mulai shutdown
+        svr.join()
 
 if __name__=="__main__":
-	main()
\ No newline at end of file
+	main()
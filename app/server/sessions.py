@@ -0,0 +1,134 @@
+import heapq
+import os
+import threading
+import time
+import uuid
+from collections.abc import Mapping
+
+# session dibuang bila tidak dipakai selama SESSION_IDLE_TTL detik, atau SESSION_TTL detik sejak login
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL") or str(24 * 3600))
+SESSION_TTL = float(os.getenv("SESSION_TTL") or str(7 * 24 * 3600))
+# login baru melebihi batas ini membuang session paling lama milik user yang sama
+SESSION_MAX_PER_USER = int(os.getenv("SESSION_MAX_PER_USER") or "16")
+# token bucket per session untuk command kirim pesan/file: SEND_RATE per detik, paling banyak SEND_BURST
+# sekaligus; SEND_RATE=0 mematikan batas
+SEND_RATE = float(os.getenv("SEND_RATE") or "20")
+SEND_BURST = float(os.getenv("SEND_BURST") or "40")
+
+
+class Session(dict):
+    # isi dict tetap seperti semula (username, userdetail, cursor, groups); waktu disimpan sebagai atribut
+    __slots__ = ('created', 'last_used', 'tokens', 'refill')
+
+    def deadline(self):
+        return min(self.last_used + SESSION_IDLE_TTL, self.created + SESSION_TTL)
+
+    def batasi(self):
+        # 0 bila boleh kirim sekarang, selain itu detik sampai token berikutnya tersedia. Tanpa lock:
+        # dua kiriman bersamaan dari session yang sama paling buruk lolos satu token lebih banyak
+        if SEND_RATE <= 0:
+            return 0
+        now = time.monotonic()
+        tokens = min(SEND_BURST, self.tokens + (now - self.refill) * SEND_RATE)
+        self.refill = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        return (1 - tokens) / SEND_RATE
+
+
+class SessionManager(Mapping):
+    # Tabel session: tokenid -> Session. Dibaca seperti dict (sessionid in sessions, sessions[id]);
+    # setiap akses memperpanjang idle TTL. Session kedaluwarsa dibuang lewat heap berisi
+    # (deadline, tokenid) yang diperiksa saat login dan info, jadi biaya pembersihan sebanding dengan
+    # session yang benar-benar kedaluwarsa. Index username -> tokenid dipakai logoutall dan batas
+    # session per user, sehingga memori tetap terbatas walaupun login terus berulang.
+    def __init__(self, milik=None):
+        self.sessions = {}
+        # mode multi-proses: token hanya dipakai bila milik(token), yaitu hash-nya jatuh ke shard ini
+        self.milik = milik
+        # username -> {tokenid: None}, urut menurut waktu login
+        self.index = {}
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def __getitem__(self, tokenid):
+        session = self.sessions[tokenid]
+        now = time.monotonic()
+        if session.deadline() <= now:
+            self.hapus(tokenid)
+            raise KeyError(tokenid)
+        session.last_used = now
+        return session
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def buat(self, username, userdetail):
+        tokenid = str(uuid.uuid4())
+        while self.milik is not None and not self.milik(tokenid):
+            tokenid = str(uuid.uuid4())
+        session = Session(username=username, userdetail=userdetail)
+        session.created = session.last_used = session.refill = time.monotonic()
+        session.tokens = SEND_BURST
+        with self.lock:
+            self.bersihkan(session.created)
+            tokens = self.index.setdefault(username, {})
+            while len(tokens) >= SESSION_MAX_PER_USER:
+                self.buang(next(iter(tokens)))
+            self.sessions[tokenid] = session
+            tokens[tokenid] = None
+            heapq.heappush(self.heap, (session.deadline(), tokenid))
+        return tokenid
+
+    def hapus(self, tokenid):
+        with self.lock:
+            return self.buang(tokenid)
+
+    def hapus_user(self, username):
+        # logout di semua perangkat
+        with self.lock:
+            tokens = list(self.index.get(username, ()))
+            for tokenid in tokens:
+                self.buang(tokenid)
+        return len(tokens)
+
+    def buang(self, tokenid):
+        # dipanggil dengan self.lock dipegang; entri heap milik token ini dilewati saat sweep
+        session = self.sessions.pop(tokenid, None)
+        if session is None:
+            return False
+        tokens = self.index.get(session['username'])
+        if tokens is not None:
+            tokens.pop(tokenid, None)
+            if not tokens:
+                del self.index[session['username']]
+        return True
+
+    def bersihkan(self, now):
+        # dipanggil dengan self.lock dipegang
+        while self.heap and self.heap[0][0] <= now:
+            deadline, tokenid = heapq.heappop(self.heap)
+            session = self.sessions.get(tokenid)
+            if session is None:
+                continue
+            deadline = session.deadline()
+            if deadline <= now:
+                self.buang(tokenid)
+            else:
+                # masih dipakai sejak entri ini dibuat, dijadwalkan ulang
+                heapq.heappush(self.heap, (deadline, tokenid))
+        # entri basi (session sudah logout) dibuang bila heap jauh lebih besar dari tabel
+        if len(self.heap) > 2 * len(self.sessions) + 64:
+            self.heap = [(session.deadline(), tokenid) for tokenid, session in self.sessions.items()]
+            heapq.heapify(self.heap)
+
+    def aktif(self):
+        # username -> jumlah session, tanpa tokenid; session yang sudah kedaluwarsa dibuang dulu
+        with self.lock:
+            self.bersihkan(time.monotonic())
+            return {username: len(tokens) for username, tokens in self.index.items()}
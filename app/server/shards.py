@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from os.path import dirname, join, realpath, splitext
+from framing import FrameBuffer
+
+# jumlah proses server; >1 = mode multi-proses, user dibagi ke proses (shard) menurut hash username
+SERVER_PROCESSES = int(os.getenv("SERVER_PROCESSES") or "1")
+# nomor shard proses ini, diisi supervisor saat menjalankan proses worker
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+# folder unix socket untuk RPC dan serah terima koneksi antar shard
+SHARD_DIR = os.getenv("SHARD_DIR") or join(dirname(realpath(__file__)), 'files', 'shard')
+# proses induk mode multi-proses hanya menjalankan dan mengawasi proses worker
+SUPERVISOR = SERVER_PROCESSES > 1 and SHARD_INDEX is None
+
+
+def per_shard(path):
+    # file/folder data (WAL, database, blob, spool realm) terpisah per shard: chat.db -> chat-shard1.db
+    if not path or SHARD_INDEX is None:
+        return path
+    root, ext = splitext(path)
+    return "{}-shard{}{}".format(root, SHARD_INDEX, ext)
+
+
+def shard_of(key, jumlah=SERVER_PROCESSES):
+    # crc32, bukan hash(): harus sama di semua proses dan setelah restart
+    return zlib.crc32(key.encode()) % jumlah
+
+
+def unix_listener(path):
+    os.makedirs(dirname(path), exist_ok=True)
+    try:
+        # socket sisa proses sebelumnya (restart)
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(64)
+    return sock
+
+
+def daemon(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class ShardRouter:
+    # Pembagian user antar proses. User (profil, session, inbox) dimiliki shard crc32(username) %
+    # SERVER_PROCESSES, group dimiliki shard crc32(nama group). Token session dibuat sehingga
+    # hash-nya jatuh ke shard pemilik user, jadi command cukup dirutekan dari token atau username.
+    # Koneksi client yang command-nya milik shard lain diserahkan utuh (file descriptor lewat
+    # SCM_RIGHTS) ke shard itu; pesan antar shard dikirim lewat RPC JSON di unix socket.
+    def __init__(self, index, jumlah=SERVER_PROCESSES, directory=SHARD_DIR):
+        self.index = index
+        self.jumlah = jumlah
+        self.directory = directory
+        # koneksi RPC yang sedang tidak dipakai, per shard tujuan
+        self.idle = {shard: [] for shard in self.lain()}
+        self.lock = threading.Lock()
+
+    def alamat(self, shard, jenis):
+        return join(self.directory, '{}-{}.sock'.format(jenis, shard))
+
+    def lain(self):
+        return [shard for shard in range(self.jumlah) if shard != self.index]
+
+    def pemilik(self, key):
+        return shard_of(key, self.jumlah)
+
+    def milik(self, key):
+        return self.pemilik(key) == self.index
+
+    def tujuan(self, key):
+        # shard lain pemilik key, None bila key milik shard ini
+        shard = self.pemilik(key)
+        return None if shard == self.index else shard
+
+#   ===================== RPC antar shard =====================
+    def panggil(self, shard, op, **args):
+        # satu permintaan per koneksi pada satu waktu; koneksi dipakai ulang, dibuka baru bila semua sibuk
+        request = json.dumps({'op': op, 'args': args}).encode() + b'\r\n'
+        conn = self.ambil(shard)
+        bekas = conn is not None
+        while True:
+            try:
+                if conn is None:
+                    conn = self.hubungkan(shard)
+                conn[0].sendall(request)
+                reply = conn[1].read_frame(conn[0])
+            except OSError as e:
+                logging.warning("SHARD: RPC {} ke shard {} gagal: {}".format(op, shard, e))
+                reply = None
+            if reply is not None:
+                with self.lock:
+                    self.idle[shard].append(conn)
+                return json.loads(reply)
+            if conn is not None:
+                conn[0].close()
+                conn = None
+            if not bekas:
+                return {'status': 'ERROR', 'message': 'Shard Tidak Tersedia'}
+            # koneksi lama putus (shard tujuan restart): diulang sekali dengan koneksi baru
+            bekas = False
+
+    def ambil(self, shard):
+        with self.lock:
+            return self.idle[shard].pop() if self.idle[shard] else None
+
+    def hubungkan(self, shard):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.alamat(shard, 'rpc'))
+        except OSError:
+            sock.close()
+            raise
+        return sock, FrameBuffer(b'\r\n\r\n')
+
+    def siarkan(self, op, **args):
+        # permintaan yang sama ke semua shard lain; shard yang gagal hanya dicatat
+        for shard in self.lain():
+            hasil = self.panggil(shard, op, **args)
+            if hasil.get('status') != 'OK':
+                logging.warning("SHARD: {} di shard {}: {}".format(op, shard, hasil.get('message')))
+
+    def layani(self, handler):
+        # handler(request) dijalankan langsung di thread koneksi RPC, bukan di worker pool: shard yang
+        # sedang menunggu balasan RPC tetap bisa melayani RPC dari shard lain (tidak saling mengunci)
+        listener = unix_listener(self.alamat(self.index, 'rpc'))
+
+        def layani_koneksi(conn):
+            frames = FrameBuffer(b'\r\n')
+            with conn:
+                while True:
+                    try:
+                        line = frames.read_frame(conn)
+                        if line is None:
+                            break
+                        conn.sendall(json.dumps(handler(json.loads(line))).encode() + b'\r\n\r\n')
+                    except OSError:
+                        break
+
+        def terima():
+            while True:
+                conn, _ = listener.accept()
+                daemon(layani_koneksi, conn)
+
+        return daemon(terima)
+
+#   ===================== Serah terima koneksi =====================
+    def serahkan(self, shard, sock, sisa, binary):
+        # sisa = byte dari client yang belum dijalankan, mulai dari command milik shard tujuan
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.alamat(shard, 'handoff'))
+            socket.send_fds(conn, [json.dumps({'binary': binary}).encode() + b'\n'], [sock.fileno()])
+            conn.sendall(sisa)
+
+    def terima_serahan(self, handler):
+        # handler(sock, binary, sisa) dipanggil untuk setiap koneksi yang diserahkan shard lain
+        listener = unix_listener(self.alamat(self.index, 'handoff'))
+
+        def terima():
+            while True:
+                conn, _ = listener.accept()
+                try:
+                    with conn:
+                        data, fds, flags, address = socket.recv_fds(conn, 65536, 1)
+                        chunks = [data]
+                        while True:
+                            data = conn.recv(65536)
+                            if not data:
+                                break
+                            chunks.append(data)
+                    header, sisa = b''.join(chunks).split(b'\n', 1)
+                    binary = json.loads(header)['binary']
+                except (OSError, ValueError) as e:
+                    logging.warning("SHARD: serah terima koneksi gagal: {}".format(e))
+                    continue
+                if fds:
+                    handler(socket.socket(fileno=fds[0]), binary, sisa)
+
+        return daemon(terima)
+
+
+def supervisi(script):
+    # proses induk: menjalankan SERVER_PROCESSES worker (SHARD_INDEX=0..n-1) dan menyalakan ulang yang mati
+    procs = {}
+
+    def mulai(index):
+        procs[index] = subprocess.Popen([sys.executable, script], env=dict(os.environ, SHARD_INDEX=str(index)))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for index in range(SERVER_PROCESSES):
+        mulai(index)
+    try:
+        while True:
+            time.sleep(1)
+            for index, proc in list(procs.items()):
+                if proc.poll() is not None:
+                    logging.warning("SHARD: worker {} berhenti (kode {}), dijalankan ulang".format(index, proc.returncode))
+                    mulai(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            proc.wait()
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from os.path import join
+from urllib.parse import quote
+
+# file spool dipadatkan saat berjalan bila ukurannya melewati batas ini dan dua kali isi yang belum di-ack
+REALM_SPOOL_COMPACT_BYTES = int(os.getenv("REALM_SPOOL_COMPACT_BYTES") or str(4 * 1024 * 1024))
+
+
+def node_id(directory):
+    # id server ini, dipakai penerima untuk membuang pesan realm duplikat; tetap sama setelah restart
+    os.makedirs(directory, exist_ok=True)
+    path = join(directory, 'node')
+    try:
+        with open(path) as fh:
+            return fh.read().strip()
+    except FileNotFoundError:
+        node = uuid.uuid4().hex
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(node)
+        os.replace(path + '.tmp', path)
+        return node
+
+
+class RealmSpool:
+    # Antrian keluar satu realm di disk. Setiap pesan yang diteruskan ditulis sebagai satu baris JSON
+    # dengan id berurutan sebelum handler membalas; di memori hanya disimpan posisi barisnya. Pesan
+    # dilepas setelah tujuan membalas (ack). Sampai itu pesan dikirim ulang setiap reconnect, termasuk
+    # setelah server restart, sehingga pengiriman at-least-once dan penerima membuang duplikat per id.
+    def __init__(self, directory, realm_id):
+        os.makedirs(directory, exist_ok=True)
+        self.path = join(directory, quote(realm_id, safe='') + '.spool')
+        # id -> (offset, panjang baris) untuk pesan yang belum di-ack, urut menurut id
+        self.pending = OrderedDict()
+        self.next_id = 1
+        # (address, port, handshake) agar link bisa dibuat ulang saat server start
+        self.tujuan = None
+        self.file = None
+        self.size = 0
+        # total panjang baris pesan yang belum di-ack
+        self.live = 0
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self.muat()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def muat(self):
+        offset = 0
+        with open(self.path, 'rb') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # baris terakhir yang terpotong karena crash di tengah penulisan
+                    logging.warning("SPOOL: record rusak di {} diabaikan".format(self.path))
+                    break
+                if 'id' in record:
+                    self.pending[record['id']] = (offset, len(line))
+                    self.next_id = max(self.next_id, record['id'] + 1)
+                elif 'ack' in record:
+                    for msg_id in record['ack']:
+                        self.pending.pop(msg_id, None)
+                elif 'next' in record:
+                    self.next_id = max(self.next_id, record['next'])
+                elif 'tujuan' in record:
+                    self.tujuan = record['tujuan']
+                offset += len(line)
+        self.padatkan()
+        if self.pending:
+            logging.warning("SPOOL: {} pesan realm belum terkirim di {}".format(len(self.pending), self.path))
+
+    def header(self):
+        lines = [json.dumps({'next': self.next_id}).encode() + b'\n']
+        if self.tujuan is not None:
+            lines.append(json.dumps({'tujuan': self.tujuan}).encode() + b'\n')
+        return b''.join(lines)
+
+    def padatkan(self):
+        # file ditulis ulang hanya berisi pesan yang belum di-ack; diganti lewat rename setelah fsync, jadi
+        # setelah crash yang tersisa selalu file lama atau file baru yang utuh (next id tidak pernah hilang)
+        pending = OrderedDict()
+        tmp = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmp, 'wb') as dst:
+            dst.write(self.header())
+            for msg_id, (offset, panjang) in self.pending.items():
+                src.seek(offset)
+                pending[msg_id] = (dst.tell(), panjang)
+                dst.write(src.read(panjang))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, self.path)
+        self.pending = pending
+        self.live = sum(panjang for offset, panjang in pending.values())
+        if self.file is not None:
+            # handle lama masih menunjuk file yang sudah diganti
+            self.file.close()
+            self.file = None
+            self.buka()
+
+    def buka(self):
+        # dipanggil dengan self.lock dipegang; file baru dibuat saat pertama kali ada yang ditulis
+        if self.file is None:
+            self.file = open(self.path, 'a+b')
+            self.size = self.file.seek(0, os.SEEK_END)
+            if self.size == 0:
+                self.tulis(self.header())
+        return self.file
+
+    def tulis(self, data):
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def set_tujuan(self, address, port, handshake):
+        with self.lock:
+            self.tujuan = [address, port, handshake]
+            self.buka()
+            self.tulis(json.dumps({'tujuan': self.tujuan}).encode() + b'\n')
+
+    def tambah(self, data):
+        # ditulis ke file (tahan crash proses) sebelum handler membalas; fsync per batch lewat sync()
+        with self.lock:
+            msg_id = self.next_id
+            self.next_id += 1
+            line = json.dumps({'id': msg_id, 'data': data}).encode() + b'\n'
+            self.buka()
+            self.pending[msg_id] = (self.size, len(line))
+            self.live += len(line)
+            self.tulis(line)
+            return msg_id
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+    def ids(self):
+        with self.lock:
+            return list(self.pending)
+
+    def panjang(self, msg_id):
+        return self.pending[msg_id][1]
+
+    def baca(self, msg_id):
+        with self.lock:
+            offset, panjang = self.pending[msg_id]
+            # spool yang baru dimuat belum punya handle sampai ada yang ditulis
+            line = os.pread(self.buka().fileno(), panjang, offset)
+        return json.loads(line)['data']
+
+    def ack(self, ids):
+        with self.lock:
+            for msg_id in ids:
+                entry = self.pending.pop(msg_id, None)
+                if entry is not None:
+                    self.live -= entry[1]
+            if self.file is None:
+                return
+            self.tulis(json.dumps({'ack': list(ids)}).encode() + b'\n')
+            # realm yang selalu sibuk tidak pernah kosong, jadi pemadatan tidak menunggu semua pesan di-ack;
+            # biaya menyalin isi yang belum di-ack terbagi ke semua byte yang ditulis sejak pemadatan terakhir
+            if self.size > max(REALM_SPOOL_COMPACT_BYTES, 2 * self.live):
+                self.padatkan()
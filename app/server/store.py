@@ -0,0 +1,258 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from types import MappingProxyType
+from mailboxes import Mailbox, MAILBOX_SIZE
+from messages import Message
+from shards import per_shard
+
+# memory = state di dict seperti semula, sqlite = disimpan di file CHAT_DB
+CHAT_STORE = os.getenv("CHAT_STORE") or "memory"
+CHAT_DB = per_shard(os.getenv("CHAT_DB") or "chat.db")
+SQLITE_FLUSH_MS = float(os.getenv("SQLITE_FLUSH_MS") or "5")
+
+
+def buat_store(blobs):
+    if CHAT_STORE == "sqlite":
+        return SqliteStore(CHAT_DB)
+    return MemoryStore(blobs)
+
+
+class MemoryStore:
+    # Store bawaan: users dan group adalah dict biasa, mailbox berupa ring buffer di memori.
+    # Profil user tidak diubah setelah dibuat (MappingProxyType) dan daftar anggota/keanggotaan
+    # diganti utuh saat berubah, jadi pembaca tidak perlu lock; lock hanya untuk penulis.
+    persistent = False
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.users = {}
+        self.group = {}
+        # username -> nama group yang diikuti, agar inbox tidak perlu memeriksa semua group
+        self.memberships = {}
+        self.lock = threading.Lock()
+
+    def add_user(self, username, password, nama, negara):
+        # profil lengkap dibuat dulu lalu dipasang dengan satu assignment
+        self.users[username] = MappingProxyType({
+            'nama': nama,
+            'negara': negara,
+            'password': password,
+            # referensi lampiran dipegang oleh incoming, bukan outgoing
+            'incoming': Mailbox(on_evict=self.lepas),
+            'outgoing': Mailbox()
+            })
+
+    def lepas(self, message):
+        if message.blob_id is not None:
+            self.blobs.release(message.blob_id)
+
+    def add_group(self, groupname, admin):
+        self.group[groupname]={
+            'admin': admin,
+            # tuple: join membuat tuple baru, pembaca (fan-out push) memakai snapshot tanpa lock
+            'members': (admin,),
+            # satu log untuk seluruh anggota; cursors = posisi timeline saat anggota bergabung, tempat
+            # session baru mulai membaca (posisi baca berikutnya disimpan per session / di cursor client)
+            'timeline': Mailbox(on_evict=self.lepas),
+            'cursors': {admin: 0}
+        }
+        self.tambah_membership(admin, groupname)
+
+    def add_member(self, groupname, username):
+        group = self.group[groupname]
+        # anggota baru mulai membaca dari pesan berikutnya
+        group['cursors'][username] = group['timeline'].last_seq
+        group['members'] = group['members'] + (username,)
+        self.tambah_membership(username, groupname)
+
+    def tambah_membership(self, username, groupname):
+        with self.lock:
+            self.memberships[username] = self.memberships.get(username, frozenset()) | {groupname}
+
+    def groups_of(self, username):
+        return [g for g in self.memberships.get(username, ()) if username in self.group[g]['cursors']]
+
+    def group_cursor(self, groupname, username):
+        return self.group[groupname]['cursors'].get(username, 0)
+
+    def set_group_cursor(self, groupname, username, cursor):
+        self.group[groupname]['cursors'][username] = cursor
+
+
+class SqliteMailbox(Mailbox):
+    # Mailbox yang isinya di tabel messages. Seq dan waiter inbox-wait tetap di memori,
+    # baris baru dikumpulkan store lalu di-insert per batch.
+    def __init__(self, store, username, box):
+        Mailbox.__init__(self, capacity=0)
+        self.store = store
+        self.username = username
+        self.box = box
+        self.last_seq = store.max_seq(username, box)
+
+    def simpan(self, seq, sender, message):
+        self.store.tunda_insert((self.username, self.box, seq, sender, json.dumps(message.dump())))
+
+    def since(self, cursor, limit=MAILBOX_SIZE):
+        # last_seq dibaca sebelum flush: baris setiap seq <= last_seq sudah ada di pending saat itu
+        # (append menaruhnya di bawah lock yang sama), jadi pasti ikut ter-flush. Append yang datang
+        # sesudahnya tidak ikut dibaca dan tidak terlewati cursor yang dikembalikan
+        with self.lock:
+            last_seq = self.last_seq
+        self.store.flush()
+        rows = self.store.query(
+            "SELECT seq, sender, body FROM messages WHERE recipient=? AND box=? AND seq>? AND seq<=? ORDER BY seq LIMIT ?",
+            (self.username, self.box, cursor, last_seq, limit))
+        entries = [(seq, sender, Message.load(json.loads(body))) for seq, sender, body in rows]
+        if len(entries) == limit:
+            # sisanya diambil pada poll berikutnya
+            last_seq = entries[-1][0]
+        return entries, last_seq
+
+
+class UserTable(Mapping):
+    # tampilan dict users di atas tabel users; profil di-cache karena jarang berubah
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+
+    def __getitem__(self, username):
+        user = self.cache.get(username)
+        if user is not None:
+            return user
+        rows = self.store.query("SELECT password, nama, negara FROM users WHERE username=?", (username,))
+        if not rows:
+            raise KeyError(username)
+        password, nama, negara = rows[0]
+        user = MappingProxyType({
+            'nama': nama,
+            'negara': negara,
+            'password': password,
+            'incoming': SqliteMailbox(self.store, username, 'in'),
+            'outgoing': SqliteMailbox(self.store, username, 'out')
+            })
+        # dua thread yang memuat user yang sama memakai objek (dan mailbox) yang sama
+        return self.cache.setdefault(username, user)
+
+    def __contains__(self, username):
+        return username in self.cache or bool(self.store.query("SELECT 1 FROM users WHERE username=?", (username,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.store.query("SELECT username FROM users")])
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM users")[0][0]
+
+
+class GroupTable(Mapping):
+    def __init__(self, store):
+        self.store = store
+        self.timelines = {}
+
+    def __getitem__(self, groupname):
+        rows = self.store.query("SELECT admin FROM groups WHERE name=?", (groupname,))
+        if not rows:
+            raise KeyError(groupname)
+        members = [row[0] for row in self.store.query(
+            "SELECT username FROM group_members WHERE name=? ORDER BY rowid", (groupname,))]
+        timeline = self.timelines.get(groupname)
+        if timeline is None:
+            timeline = self.timelines.setdefault(groupname, SqliteMailbox(self.store, groupname, 'group'))
+        return {'admin': rows[0][0], 'members': members, 'timeline': timeline}
+
+    def __iter__(self):
+        return iter([row[0] for row in self.store.query("SELECT name FROM groups")])
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM groups")[0][0]
+
+
+class SqliteStore:
+    # Store SQLite: journal WAL agar pembaca tidak menunggu penulis, query berparameter
+    # (statement di-cache sqlite3), pesan diindeks (recipient, box, seq) dan di-insert per batch.
+    persistent = True
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        # satu flush pada satu waktu, agar pembaca yang memanggil flush() pasti melihat baris sebelumnya
+        self.flush_lock = threading.Lock()
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, nama TEXT, negara TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, admin TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS group_members (name TEXT, username TEXT, cursor INTEGER DEFAULT 0, "
+                            "PRIMARY KEY (name, username))")
+            if 'cursor' not in [row[1] for row in self.db.execute("PRAGMA table_info(group_members)")]:
+                self.db.execute("ALTER TABLE group_members ADD COLUMN cursor INTEGER DEFAULT 0")
+            self.db.execute("CREATE INDEX IF NOT EXISTS group_members_username ON group_members (username)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (recipient TEXT, box TEXT, seq INTEGER, sender TEXT, body TEXT, "
+                            "PRIMARY KEY (recipient, box, seq)) WITHOUT ROWID")
+        self.users = UserTable(self)
+        self.group = GroupTable(self)
+        self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+        self.flusher.start()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            self.db.execute(sql, params)
+
+    def max_seq(self, username, box):
+        return self.query("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE recipient=? AND box=?", (username, box))[0][0]
+
+    def add_user(self, username, password, nama, negara):
+        self.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", (username, password, nama, negara))
+        self.users.cache.pop(username, None)
+
+    def add_group(self, groupname, admin):
+        self.flush()
+        cursor = self.max_seq(groupname, 'group')
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("INSERT OR REPLACE INTO groups VALUES (?, ?)", (groupname, admin))
+            self.db.execute("DELETE FROM group_members WHERE name=?", (groupname,))
+            self.db.execute("INSERT INTO group_members VALUES (?, ?, ?)", (groupname, admin, cursor))
+            self.db.execute("COMMIT")
+
+    def add_member(self, groupname, username):
+        cursor = self.group[groupname]['timeline'].last_seq
+        self.execute("INSERT OR IGNORE INTO group_members VALUES (?, ?, ?)", (groupname, username, cursor))
+
+    def groups_of(self, username):
+        return [row[0] for row in self.query("SELECT name FROM group_members WHERE username=?", (username,))]
+
+    def group_cursor(self, groupname, username):
+        rows = self.query("SELECT cursor FROM group_members WHERE name=? AND username=?", (groupname, username))
+        return rows[0][0] if rows else 0
+
+    def set_group_cursor(self, groupname, username, cursor):
+        self.execute("UPDATE group_members SET cursor=? WHERE name=? AND username=?", (cursor, groupname, username))
+
+    def tunda_insert(self, row):
+        with self.pending_lock:
+            self.pending.append(row)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                rows, self.pending = self.pending, []
+            if rows:
+                with self.lock:
+                    self.db.execute("BEGIN")
+                    self.db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+                    self.db.execute("COMMIT")
+
+    def run_flusher(self):
+        while True:
+            time.sleep(SQLITE_FLUSH_MS / 1000)
+            self.flush()
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+from os.path import dirname, join, realpath
+
+import pytest
+
+# modul server diimpor langsung (from chat import Chat) seperti di server_thread_chat.py
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+
+# folder data dibaca saat modul diimpor; diarahkan ke folder sementara agar app/server/files tidak tersentuh
+DATA = tempfile.mkdtemp(prefix='chat-test-')
+os.environ.setdefault('BLOB_DIR', join(DATA, 'blobs'))
+os.environ.setdefault('REALM_SPOOL_DIR', join(DATA, 'realm'))
+os.environ.setdefault('SHARD_DIR', join(DATA, 'shard'))
+os.environ.setdefault('SEND_RATE', '0')
+
+import chat
+
+
+@pytest.fixture
+def buat_chat(tmp_path, monkeypatch):
+    # Chat baru dengan blob, spool realm, dan WAL di tmp_path; wal=True memakai WAL_DIR yang sama
+    # untuk setiap Chat yang dibuat, sehingga Chat kedua memutar ulang log Chat pertama
+    monkeypatch.setattr(chat, 'BLOB_DIR', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(chat, 'REALM_SPOOL_DIR', str(tmp_path / 'realm'))
+
+    def buat(wal=False):
+        monkeypatch.setattr(chat, 'WAL_DIR', str(tmp_path / 'wal') if wal else '')
+        return chat.Chat()
+
+    return buat
+
+
+@pytest.fixture
+def masuk():
+    # token session baru (satu perangkat) untuk user bawaan
+    def masuk(chats, username, password='surabaya'):
+        hasil = chats.proses("auth {} {}\r\n".format(username, password))
+        assert hasil['status'] == 'OK', hasil
+        return hasil['tokenid']
+
+    return masuk
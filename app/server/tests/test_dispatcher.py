@@ -0,0 +1,32 @@
+from sessions import SessionManager
+
+
+def test_session_di_resolve_sekali_per_request(buat_chat, masuk, monkeypatch):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    lookup = []
+    getitem = SessionManager.__getitem__
+
+    def hitung(self, tokenid):
+        lookup.append(tokenid)
+        return getitem(self, tokenid)
+
+    monkeypatch.setattr(SessionManager, '__getitem__', hitung)
+    for data in ("send {} henderson halo\r\n", "inbox {}\r\n", "addgroup {} g1\r\n"):
+        lookup.clear()
+        assert chats.proses(data.format(messi))['status'] == 'OK'
+        assert lookup == [messi]
+
+
+def test_session_tidak_dikenal(buat_chat):
+    chats = buat_chat()
+    hasil = chats.proses("send bukan-token henderson halo\r\n")
+    assert hasil == {'status': 'ERROR', 'message': 'Session Tidak Ditemukan'}
+
+
+def test_hook_menerima_durasi_command(buat_chat):
+    chats = buat_chat()
+    dicatat = []
+    chats.commands.add_hook(lambda name, durasi, hasil: dicatat.append((name, hasil['status'])))
+    chats.proses("ping\r\n")
+    assert dicatat == [('ping', 'OK')]
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import server_thread_chat
+from framing import FrameBuffer
+from protocol import BinaryFrameBuffer, ProtocolError, HEADER, MAGIC, VERSION, COMMANDS, encode_frame
+
+
+def test_frame_terpotong_di_antara_dua_recv():
+    frames = FrameBuffer(b'\r\n')
+    assert frames.feed(b'auth messi sura') == []
+    assert frames.feed(b'baya\r') == []
+    assert frames.feed(b'\ninfo\r\nping') == ['auth messi surabaya\r\n', 'info\r\n']
+    assert frames.pending() == 4
+
+
+def test_frame_biner_dipotong_sesuai_header():
+    data = encode_frame(COMMANDS['send'], 'token', {'username_dest': 'henderson'}, b'') + encode_frame(COMMANDS['inbox'], 'token')
+    frames = BinaryFrameBuffer()
+    hasil = []
+    for i in range(len(data)):
+        hasil.extend(frames.feed(data[i:i + 1]))
+    assert hasil == [(COMMANDS['send'], 'token', {'username_dest': 'henderson'}, b''), (COMMANDS['inbox'], 'token', {}, b'')]
+    assert frames.pending() == 0
+
+
+def test_frame_biner_terlalu_besar_ditolak_dari_header():
+    frames = BinaryFrameBuffer(batas=1024)
+    header = HEADER.pack(MAGIC, VERSION, COMMANDS['sendfile'], 0, 2, 10 * 1024 * 1024)
+    # payload belum dikirim sama sekali
+    with pytest.raises(ProtocolError, match='Frame Terlalu Besar'):
+        frames.feed(header)
+
+
+@pytest.mark.parametrize('meta, pesan', [
+    (b'{bukan json', 'Frame Tidak Valid'),
+    (b'\xff\xfe', 'Frame Tidak Valid'),
+    (b'[1, 2]', 'Meta Frame Harus Objek JSON'),
+])
+def test_meta_frame_biner_tidak_valid(meta, pesan):
+    data = HEADER.pack(MAGIC, VERSION, COMMANDS['inbox'], 0, len(meta), 0) + meta
+    with pytest.raises(ProtocolError, match=pesan):
+        BinaryFrameBuffer().feed(data)
+
+
+def test_header_frame_biner_tidak_dikenal():
+    with pytest.raises(ProtocolError):
+        BinaryFrameBuffer().feed(b'XX' + bytes(HEADER.size))
+
+
+def test_command_teks_melebihi_batas(monkeypatch):
+    monkeypatch.setattr(server_thread_chat, 'MAX_FRAME_SIZE', 1024)
+    protokol = server_thread_chat.ClientProtocol()
+    protokol.feed(b'x' * 1000)
+    with pytest.raises(ProtocolError, match='Frame Terlalu Besar'):
+        protokol.feed(b'x' * 100)
+
+
+def test_command_teks_di_bawah_batas_dijalankan(monkeypatch):
+    monkeypatch.setattr(server_thread_chat, 'MAX_FRAME_SIZE', 1024)
+    protokol = server_thread_chat.ClientProtocol()
+    jobs = protokol.feed(b'ping\r\nping\r\n')
+    assert [job() for job, opcode, berat in jobs] == [{'status': 'OK', 'message': 'pong'}] * 2
+
+
+def test_command_teks_bukan_utf8():
+    with pytest.raises(ProtocolError, match='Frame Tidak Valid'):
+        server_thread_chat.ClientProtocol().feed(b'\xff\xfe bad\r\n')
+
+
+def test_frame_biner_melebihi_batas_setelah_negosiasi(monkeypatch):
+    monkeypatch.setattr(server_thread_chat, 'MAX_FRAME_SIZE', 1024)
+    protokol = server_thread_chat.ClientProtocol()
+    jobs = protokol.feed(b'protocol binary\r\n')
+    assert jobs[0][0]() == {'status': 'OK', 'protocol': 'binary'}
+    with pytest.raises(ProtocolError, match='Frame Terlalu Besar'):
+        protokol.feed(encode_frame(COMMANDS['text'], blob=b'x' * 2048))
+
+
+def test_balasan_error_sebelum_koneksi_ditutup():
+    protokol = server_thread_chat.ClientProtocol()
+    hasil = protokol.balas_error('Frame Terlalu Besar')
+    assert json.loads(hasil.decode().rstrip('\r\n')) == {'status': 'ERROR', 'message': 'Frame Terlalu Besar'}
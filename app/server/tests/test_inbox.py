@@ -0,0 +1,78 @@
+from chat import baca_cursor, tulis_cursor
+
+
+def pesan(hasil, pengirim):
+    return [m['msg'] for m in hasil['messages'].get(pengirim, [])]
+
+
+def test_cursor_komposit():
+    assert tulis_cursor(7, {}) == 7
+    cursor = tulis_cursor(7, {'grup a': 3, 'g,2': 5})
+    assert baca_cursor(cursor) == (7, {'grup a': 3, 'g,2': 5})
+    assert baca_cursor('4') == (4, {})
+    assert baca_cursor(4) == (4, {})
+
+
+def test_inbox_tanpa_cursor_memajukan_posisi_session(buat_chat, masuk):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    henderson = masuk(chats, 'henderson')
+    chats.proses("send {} henderson satu\r\n".format(messi))
+    hasil = chats.proses("inbox {}\r\n".format(henderson))
+    assert pesan(hasil, 'messi') == ['satu']
+    assert hasil['cursor'] == 1
+    assert chats.proses("inbox {}\r\n".format(henderson))['messages'] == {}
+    chats.proses("send {} henderson dua\r\n".format(messi))
+    assert pesan(chats.proses("inbox {}\r\n".format(henderson)), 'messi') == ['dua']
+
+
+def test_cursor_eksplisit_tidak_memajukan_posisi(buat_chat, masuk):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    henderson = masuk(chats, 'henderson')
+    for isi in ('satu', 'dua'):
+        chats.proses("send {} henderson {}\r\n".format(messi, isi))
+    assert pesan(chats.proses("inbox {} 1\r\n".format(henderson)), 'messi') == ['dua']
+    assert pesan(chats.proses("inbox {} 1\r\n".format(henderson)), 'messi') == ['dua']
+    # posisi session masih di awal
+    assert pesan(chats.proses("inbox {}\r\n".format(henderson)), 'messi') == ['satu', 'dua']
+
+
+def test_pesan_group_terbaca_di_setiap_perangkat(buat_chat, masuk):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    hp = masuk(chats, 'henderson')
+    laptop = masuk(chats, 'henderson')
+    assert chats.proses("addgroup {} g1\r\n".format(messi))['status'] == 'OK'
+    assert chats.proses("joingroup {} g1\r\n".format(hp))['status'] == 'OK'
+    chats.proses("sendgroup {} g1 halo grup\r\n".format(messi))
+    hasil = chats.proses("inbox {}\r\n".format(hp))
+    assert pesan(hasil, 'messi') == ['halo grup']
+    assert baca_cursor(hasil['cursor']) == (0, {'g1': 1})
+    # membaca dari satu perangkat tidak menghabiskan pesan group di perangkat lain
+    assert pesan(chats.proses("inbox {}\r\n".format(laptop)), 'messi') == ['halo grup']
+    assert chats.proses("inbox {}\r\n".format(hp))['messages'] == {}
+    # cursor lama dari client tetap melihat pesan yang sama
+    assert pesan(chats.proses("inbox {} 0,g1=0\r\n".format(hp)), 'messi') == ['halo grup']
+
+
+def test_group_yang_baru_diikuti_dibaca_dari_posisi_bergabung(buat_chat, masuk):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    henderson = masuk(chats, 'henderson')
+    chats.proses("addgroup {} g1\r\n".format(messi))
+    chats.proses("sendgroup {} g1 sebelum\r\n".format(messi))
+    chats.proses("joingroup {} g1\r\n".format(henderson))
+    chats.proses("sendgroup {} g1 sesudah\r\n".format(messi))
+    assert pesan(chats.proses("inbox {}\r\n".format(henderson)), 'messi') == ['sesudah']
+
+
+def test_inbox_wait_langsung_kembali_bila_ada_pesan(buat_chat, masuk):
+    chats = buat_chat()
+    messi = masuk(chats, 'messi')
+    henderson = masuk(chats, 'henderson')
+    chats.proses("send {} henderson halo\r\n".format(messi))
+    hasil = chats.proses("inbox-wait {} 0 5\r\n".format(henderson))
+    assert pesan(hasil, 'messi') == ['halo']
+    # tanpa pesan baru, timeout 0 langsung dibalas kosong
+    assert chats.proses("inbox-wait {} 1 0\r\n".format(henderson))['messages'] == {}
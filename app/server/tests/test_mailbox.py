@@ -0,0 +1,133 @@
+import threading
+
+from mailboxes import Mailbox
+from messages import Message
+from store import SqliteStore
+
+
+def isi(entries):
+    return [message.msg for seq, sender, message in entries]
+
+
+def test_since_hanya_pesan_setelah_cursor():
+    mailbox = Mailbox()
+    for i in range(5):
+        assert mailbox.append('messi', Message('Lionel Messi', 'pesan{}'.format(i))) == i + 1
+    entries, cursor = mailbox.since(2)
+    assert isi(entries) == ['pesan2', 'pesan3', 'pesan4']
+    assert cursor == 5
+    # membaca tidak menghapus: cursor yang sama memberi hasil yang sama
+    assert isi(mailbox.since(2)[0]) == ['pesan2', 'pesan3', 'pesan4']
+    assert mailbox.since(5) == ([], 5)
+
+
+def test_ring_buffer_membuang_pesan_tertua():
+    dibuang = []
+    mailbox = Mailbox(capacity=3, on_evict=dibuang.append)
+    for i in range(5):
+        mailbox.append('messi', Message('Lionel Messi', 'pesan{}'.format(i)))
+    assert [message.msg for message in dibuang] == ['pesan0', 'pesan1']
+    # cursor yang tertinggal hanya mendapat pesan yang masih ada, seq tetap naik
+    entries, cursor = mailbox.since(0)
+    assert isi(entries) == ['pesan2', 'pesan3', 'pesan4']
+    assert cursor == 5
+
+
+def test_restore_idempoten():
+    mailbox = Mailbox()
+    assert mailbox.restore(1, 'messi', Message('Lionel Messi', 'a'))
+    assert mailbox.restore(2, 'messi', Message('Lionel Messi', 'b'))
+    assert not mailbox.restore(2, 'messi', Message('Lionel Messi', 'b'))
+    assert isi(mailbox.since(0)[0]) == ['a', 'b']
+    # pesan baru melanjutkan seq hasil replay
+    assert mailbox.append('messi', Message('Lionel Messi', 'c')) == 3
+
+
+def test_restore_seq_tidak_berurutan():
+    # dua pengirim bersamaan: record WAL seq 2 bisa tertulis sebelum seq 1
+    dibuang = []
+    mailbox = Mailbox(capacity=3, on_evict=dibuang.append)
+    for seq in (2, 1, 1, 4, 3):
+        mailbox.restore(seq, 'messi', Message('Lionel Messi', 'pesan{}'.format(seq)))
+    assert [seq for seq, sender, message in mailbox.entries] == [2, 3, 4]
+    assert [message.msg for message in dibuang] == ['pesan1']
+    # lebih tua dari isi ring buffer yang penuh: tidak dimasukkan lagi
+    assert not mailbox.restore(1, 'messi', Message('Lionel Messi', 'pesan1'))
+    assert isi(mailbox.since(2)[0]) == ['pesan3', 'pesan4']
+
+
+def test_restore_tidak_mengulang_isi_snapshot():
+    mailbox = Mailbox()
+    mailbox.load({'last_seq': 5, 'entries': [(5, 'messi', Message('Lionel Messi', 'lima').dump())]})
+    # seq 3 sudah tercakup snapshot (terbuang dari ring buffer sebelum snapshot)
+    assert not mailbox.restore(3, 'messi', Message('Lionel Messi', 'tiga'))
+    assert mailbox.restore(7, 'messi', Message('Lionel Messi', 'tujuh'))
+    assert mailbox.restore(6, 'messi', Message('Lionel Messi', 'enam'))
+    assert isi(mailbox.since(0)[0]) == ['lima', 'enam', 'tujuh']
+
+
+def test_waiter_dipanggil_saat_pesan_masuk():
+    mailbox = Mailbox()
+    bangun = threading.Event()
+    assert mailbox.add_waiter(0, bangun.set)
+    mailbox.append('messi', Message('Lionel Messi', 'halo'))
+    assert bangun.is_set()
+    # sudah ada pesan setelah cursor: tidak perlu menunggu
+    assert not mailbox.add_waiter(0, bangun.set)
+
+
+def test_sqlite_mailbox_poll_bersamaan_tidak_melewatkan_pesan(tmp_path):
+    store = SqliteStore(str(tmp_path / 'chat.db'))
+    store.add_user('henderson', 'surabaya', 'Jordan Henderson', 'Inggris')
+    mailbox = store.users['henderson']['incoming']
+    jumlah = 2000
+    diterima = []
+    selesai = threading.Event()
+
+    def kirim():
+        for i in range(jumlah):
+            mailbox.append('messi', Message('Lionel Messi', str(i)))
+        selesai.set()
+
+    def poll():
+        cursor = 0
+        while True:
+            akhir = selesai.is_set()
+            entries, cursor = mailbox.since(cursor)
+            diterima.extend(isi(entries))
+            if akhir:
+                break
+
+    threads = [threading.Thread(target=kirim), threading.Thread(target=poll)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert diterima == [str(i) for i in range(jumlah)]
+
+
+def test_sqlite_store_persisten(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    store = SqliteStore(path)
+    store.add_user('henderson', 'surabaya', 'Jordan Henderson', 'Inggris')
+    for i in range(3):
+        store.users['henderson']['incoming'].append('messi', Message('Lionel Messi', str(i)))
+    store.flush()
+    store.db.close()
+    store = SqliteStore(path)
+    mailbox = store.users['henderson']['incoming']
+    assert mailbox.last_seq == 3
+    assert isi(mailbox.since(1)[0]) == ['1', '2']
+    assert mailbox.append('messi', Message('Lionel Messi', '3')) == 4
+
+
+def test_sqlite_cursor_group_dimulai_dari_posisi_bergabung(tmp_path):
+    store = SqliteStore(str(tmp_path / 'chat.db'))
+    store.add_group('g1', 'messi')
+    timeline = store.group['g1']['timeline']
+    timeline.append('messi', Message('Lionel Messi', 'sebelum', group='g1'))
+    store.add_member('g1', 'henderson')
+    assert store.group_cursor('g1', 'henderson') == 1
+    assert store.group_cursor('g1', 'messi') == 0
+    timeline.append('messi', Message('Lionel Messi', 'sesudah', group='g1'))
+    assert isi(timeline.since(store.group_cursor('g1', 'henderson'))[0]) == ['sesudah']
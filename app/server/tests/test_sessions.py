@@ -0,0 +1,34 @@
+import time
+
+import sessions
+from sessions import SessionManager
+
+
+def test_session_kedaluwarsa_tidak_terlihat_aktif_tanpa_login_baru(monkeypatch):
+    monkeypatch.setattr(sessions, 'SESSION_IDLE_TTL', 0.05)
+    manager = SessionManager()
+    tokenid = manager.buat('messi', {})
+    assert manager.aktif() == {'messi': 1}
+    time.sleep(0.1)
+    # belum ada login lagi yang menyapu heap
+    assert manager.aktif() == {}
+    assert tokenid not in manager
+
+
+def test_session_yang_dipakai_tetap_aktif(monkeypatch):
+    monkeypatch.setattr(sessions, 'SESSION_IDLE_TTL', 0.2)
+    manager = SessionManager()
+    tokenid = manager.buat('messi', {})
+    for i in range(3):
+        time.sleep(0.1)
+        assert manager[tokenid]['username'] == 'messi'
+    assert manager.aktif() == {'messi': 1}
+
+
+def test_logoutall_membuang_semua_session_user():
+    manager = SessionManager()
+    tokens = [manager.buat('messi', {}) for i in range(3)]
+    manager.buat('henderson', {})
+    assert manager.hapus_user('messi') == 3
+    assert manager.aktif() == {'henderson': 1}
+    assert not any(tokenid in manager for tokenid in tokens)
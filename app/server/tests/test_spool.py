@@ -0,0 +1,167 @@
+import json
+
+import pytest
+
+import spool
+from spool import RealmSpool, node_id
+
+
+def test_pesan_tetap_ada_sampai_di_ack(tmp_path):
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    ids = [antrian.tambah("recvrealmprivatemsg messi r1 henderson {}\r\n".format(i)) for i in range(3)]
+    assert ids == [1, 2, 3]
+    antrian.ack([1])
+    assert antrian.baca(2) == "recvrealmprivatemsg messi r1 henderson 1\r\n"
+    # setelah restart yang belum di-ack dikirim ulang, id baru tidak mengulang id lama
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    assert antrian.ids() == [2, 3]
+    assert antrian.baca(3) == "recvrealmprivatemsg messi r1 henderson 2\r\n"
+    antrian.ack([2, 3])
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    assert len(antrian) == 0
+    assert antrian.tambah("x") == 4
+
+
+def test_tujuan_disimpan(tmp_path):
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    antrian.set_tujuan('127.0.0.1', 9000, "recvrealm r1 127.0.0.1 8889\r\n")
+    assert RealmSpool(str(tmp_path), 'r1').tujuan == ['127.0.0.1', 9000, "recvrealm r1 127.0.0.1 8889\r\n"]
+
+
+def test_spool_dipadatkan_saat_berjalan(tmp_path, monkeypatch):
+    monkeypatch.setattr(spool, 'REALM_SPOOL_COMPACT_BYTES', 4096)
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    isi = 'x' * 100
+    for i in range(1000):
+        antrian.ack([antrian.tambah(isi)])
+    # satu pesan belum di-ack, file tidak tumbuh terus walaupun realm tidak pernah kosong
+    sisa = antrian.tambah(isi)
+    for i in range(1000):
+        antrian.ack([antrian.tambah(isi)])
+    assert antrian.size <= 4096 + 200
+    assert (tmp_path / 'r1.spool').stat().st_size == antrian.size
+    assert antrian.baca(sisa) == isi
+    # handle file dibuka ulang setelah dipadatkan: tulisan berikutnya masuk ke file yang baru
+    baru = antrian.tambah('terakhir')
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    assert antrian.ids() == [sisa, baru]
+    assert antrian.baca(baru) == 'terakhir'
+    assert antrian.tambah(isi) == baru + 1
+
+
+def test_record_terpotong_diabaikan(tmp_path):
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    antrian.tambah('satu')
+    with open(antrian.path, 'ab') as fh:
+        fh.write(b'{"id": 2, "da')
+    antrian = RealmSpool(str(tmp_path), 'r1')
+    assert antrian.ids() == [1]
+    assert antrian.tambah('dua') == 2
+
+
+def test_node_id_tetap_setelah_restart(tmp_path):
+    assert node_id(str(tmp_path)) == node_id(str(tmp_path))
+
+
+def test_file_realm_rusak_tidak_masuk_spool(buat_chat, masuk):
+    chats = buat_chat()
+    chats.proses("recvrealm r1 127.0.0.1 1\r\n")
+    messi = masuk(chats, 'messi')
+    spool = chats.realms['r1'].spool
+    for data in ("sendfilerealm {} r1 henderson a.txt abc\r\n", "sendgroupfilerealm {} r1 henderson,lineker a.txt abc\r\n"):
+        hasil = chats.proses(data.format(messi))
+        assert hasil == {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
+    assert len(spool) == 0
+    hasil = chats.proses("sendfilerealm {} r1 henderson a.txt aGFsbw==\r\n".format(messi))
+    assert hasil['status'] == 'OK'
+    assert len(spool) == 1
+
+
+def batch(chats, node, items):
+    data = "recvrealmbatch r1 {}\r\n".format(json.dumps({'node': node, 'items': items}))
+    return chats.proses(data)
+
+
+def pesan_realm(chats, username):
+    hasil = chats.get_realm_chat('r1', username)
+    assert hasil['status'] == 'OK', hasil
+    return [m['msg'] for m in hasil['messages']]
+
+
+def item(msg_id, isi):
+    return [msg_id, "recvrealmprivatemsg messi r1 henderson {}".format(isi)]
+
+
+def test_batch_yang_dikirim_ulang_tidak_diterapkan_dua_kali(buat_chat):
+    chats = buat_chat()
+    # link balik ke port yang tidak dipakai: penerima tetap mengenal realm walaupun link-nya putus
+    assert chats.proses("recvrealm r1 127.0.0.1 1\r\n")['status'] == 'OK'
+    hasil = batch(chats, 'n1', [item(1, 'satu'), item(2, 'dua')])
+    assert [r['status'] for r in hasil['results']] == ['OK', 'OK']
+    # reconnect: pengirim mengulang semua yang belum di-ack
+    hasil = batch(chats, 'n1', [item(1, 'satu'), item(2, 'dua'), item(3, 'tiga')])
+    assert [r.get('message') for r in hasil['results']][:2] == ['Duplikat', 'Duplikat']
+    # id dari server lain dihitung terpisah
+    batch(chats, 'n2', [item(1, 'lain')])
+    assert pesan_realm(chats, 'henderson') == ['satu', 'dua', 'tiga', 'lain']
+
+
+def test_command_yang_tidak_boleh_ada_di_batch(buat_chat):
+    chats = buat_chat()
+    chats.proses("recvrealm r1 127.0.0.1 1\r\n")
+    hasil = batch(chats, 'n1', [[1, "register x y z w"], item(2, 'dua')])
+    assert hasil['results'][0]['message'] == '**Protocol Tidak Benar'
+    assert 'x' not in chats.users
+    assert pesan_realm(chats, 'henderson') == ['dua']
+
+
+@pytest.mark.parametrize('commands', [
+    {'node': 'n1', 'items': [['a', 'recvrealmprivatemsg messi r1 henderson x']]},
+    {'node': 'n1', 'items': [[1]]},
+    {'node': 'n1', 'items': [[1, 'x', 'y']]},
+    {'node': 'n1', 'items': [[1, 2]]},
+    {'node': 'n1', 'items': [[True, 'recvrealmprivatemsg messi r1 henderson x']]},
+    {'node': 'n1', 'items': 'bukan daftar'},
+    {'node': 5, 'items': []},
+    {'items': []},
+    [1, 2],
+])
+def test_batch_tidak_valid_ditolak(buat_chat, commands):
+    chats = buat_chat()
+    chats.proses("recvrealm r1 127.0.0.1 1\r\n")
+    hasil = chats.proses("recvrealmbatch r1 {}\r\n".format(json.dumps(commands)))
+    assert hasil == {'status': 'ERROR', 'message': '--Protocol Tidak Benar'}
+    # tidak ada yang diterapkan dan dedup tidak bergeser
+    assert chats.realms['r1'].chat == {}
+    assert chats.realms['r1'].applied == {}
+
+
+def test_batch_ditahan_saat_shard_penerima_tidak_tersedia(buat_chat):
+    chats = buat_chat()
+    chats.proses("recvrealm r1 127.0.0.1 1\r\n")
+    jalankan = chats.jalankan
+    gagal = {'dua'}
+
+    def shard_mati(data, conn=None):
+        if data.rsplit(" ", 1)[-1] in gagal:
+            return {'status': 'ERROR', 'message': 'Shard Tidak Tersedia'}
+        return jalankan(data, conn)
+
+    chats.jalankan = shard_mati
+    # batch ditolak seluruhnya (tidak di-ack), pesan sebelum yang gagal sudah diterapkan
+    assert batch(chats, 'n1', [item(1, 'satu'), item(2, 'dua'), item(3, 'tiga')])['status'] == 'ERROR'
+    # batch berikutnya yang sudah dikirim (pipelining) juga ditolak, agar pesan 2 tidak terlewati dedup
+    assert batch(chats, 'n1', [item(4, 'empat')])['status'] == 'ERROR'
+    gagal.clear()
+    hasil = batch(chats, 'n1', [item(1, 'satu'), item(2, 'dua'), item(3, 'tiga'), item(4, 'empat')])
+    assert hasil['status'] == 'OK'
+    assert pesan_realm(chats, 'henderson') == ['satu', 'dua', 'tiga', 'empat']
+
+
+def test_penerima_realm_tidak_dikenal(buat_chat):
+    chats = buat_chat()
+    chats.proses("recvrealm r1 127.0.0.1 1\r\n")
+    hasil = batch(chats, 'n1', [[1, "recvrealmgroupmsg messi r1 henderson,siapa halo"]])
+    assert hasil['results'][0]['message'] == 'User Tidak Ditemukan'
+    # diperiksa sebelum disimpan: penerima yang ada pun tidak mendapat salinan
+    assert 'Jordan Henderson' not in chats.realms['r1'].chat
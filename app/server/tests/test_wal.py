@@ -0,0 +1,123 @@
+import errno
+
+import pytest
+
+from wal import WriteAheadLog, WALError
+
+
+def test_record_kembali_setelah_load(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), lambda: {}, flush_interval=0)
+    wal.load()
+    wal.start()
+    for i in range(3):
+        wal.append({'op': 'tes', 'n': i}, sync=True)
+    snapshot, records = WriteAheadLog(str(tmp_path), lambda: {}).load()
+    assert snapshot is None
+    assert [record['n'] for record in records] == [0, 1, 2]
+
+
+def test_baris_terpotong_diabaikan(tmp_path):
+    (tmp_path / 'chat.wal').write_bytes(b'{"op":"tes","n":0}\n{"op":"te')
+    snapshot, records = WriteAheadLog(str(tmp_path), lambda: {}).load()
+    assert records == [{'op': 'tes', 'n': 0}]
+
+
+def test_snapshot_mengosongkan_log(tmp_path):
+    state = {'n': 0}
+    wal = WriteAheadLog(str(tmp_path), lambda: dict(state), flush_interval=0)
+    wal.load()
+    wal.start()
+    for i in range(1, 5):
+        wal.append({'op': 'tes', 'n': i}, sync=True)
+        state['n'] = i
+        if i == 2:
+            wal.snapshot()
+    snapshot, records = WriteAheadLog(str(tmp_path), lambda: {}).load()
+    assert snapshot == {'n': 2}
+    assert [record['n'] for record in records] == [3, 4]
+
+
+def test_chat_dipulihkan_dari_wal(buat_chat, masuk):
+    chats = buat_chat(wal=True)
+    messi = masuk(chats, 'messi')
+    assert chats.proses("register ronaldo rahasia Cristiano_Ronaldo Portugal\r\n")['status'] == 'OK'
+    chats.proses("send {} ronaldo halo\r\n".format(messi))
+    chats.proses("addgroup {} g1\r\n".format(messi))
+    ronaldo = masuk(chats, 'ronaldo', 'rahasia')
+    chats.proses("joingroup {} g1\r\n".format(ronaldo))
+    chats.proses("sendgroup {} g1 halo grup\r\n".format(messi))
+
+    pulih = buat_chat(wal=True)
+    ronaldo = masuk(pulih, 'ronaldo', 'rahasia')
+    hasil = pulih.proses("inbox {}\r\n".format(ronaldo))
+    assert [m['msg'] for m in hasil['messages']['messi']] == ['halo', 'halo grup']
+    assert pulih.users['ronaldo']['nama'] == 'Cristiano Ronaldo'
+    assert list(pulih.group['g1']['members']) == ['messi', 'ronaldo']
+    # seq dilanjutkan, bukan diulang dari awal
+    messi = masuk(pulih, 'messi')
+    pulih.proses("send {} ronaldo lagi\r\n".format(messi))
+    hasil = pulih.proses("inbox {}\r\n".format(ronaldo))
+    assert [m['msg'] for m in hasil['messages']['messi']] == ['lagi']
+
+
+def test_replay_idempoten_di_atas_snapshot(buat_chat, masuk):
+    chats = buat_chat(wal=True)
+    messi = masuk(chats, 'messi')
+    chats.proses("send {} henderson satu\r\n".format(messi))
+    chats.wal.snapshot()
+    chats.proses("send {} henderson dua\r\n".format(messi))
+    # record yang sudah tercakup snapshot ikut diputar ulang (crash sebelum log dikosongkan)
+    chats.wal.file.write(b'{"op":"message","from":"messi","to":"henderson","seq":1,"message":{"msg_from":"Lionel Messi","msg":"satu"}}\n')
+    chats.wal.file.flush()
+
+    pulih = buat_chat(wal=True)
+    entries, cursor = pulih.users['henderson']['incoming'].since(0)
+    assert [message.msg for seq, sender, message in entries] == ['satu', 'dua']
+    assert cursor == 2
+
+
+def test_record_tidak_berurutan_tidak_hilang(buat_chat, tmp_path):
+    # seq diambil di bawah lock mailbox, record ditulis setelahnya: pengirim kedua bisa mencatat lebih dulu
+    record = '{{"op":"{op}",{tujuan},"from":"messi","seq":{seq},"message":{{"msg_from":"Lionel Messi","msg":"{msg}"}}}}\n'
+    (tmp_path / 'wal').mkdir()
+    (tmp_path / 'wal' / 'chat.wal').write_text(
+        record.format(op='message', tujuan='"to":"henderson"', seq=2, msg='kedua')
+        + record.format(op='message', tujuan='"to":"henderson"', seq=1, msg='pertama')
+        + '{"op":"addgroup","group":"g1","admin":"messi"}\n'
+        + record.format(op='groupmessage', tujuan='"group":"g1"', seq=2, msg='g kedua')
+        + record.format(op='groupmessage', tujuan='"group":"g1"', seq=1, msg='g pertama'))
+    chats = buat_chat(wal=True)
+    entries, cursor = chats.users['henderson']['incoming'].since(0)
+    assert [message.msg for seq, sender, message in entries] == ['pertama', 'kedua']
+    entries, cursor = chats.group['g1']['timeline'].since(0)
+    assert [message.msg for seq, sender, message in entries] == ['g pertama', 'g kedua']
+
+
+class DiskPenuh:
+    def write(self, data):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def close(self):
+        pass
+
+
+def test_gagal_tulis_membangunkan_penunggu(tmp_path):
+    wal = WriteAheadLog(str(tmp_path), lambda: {}, flush_interval=0)
+    wal.load()
+    wal.start()
+    wal.file = DiskPenuh()
+    with pytest.raises(WALError, match='Gagal Menyimpan Data'):
+        wal.append({'op': 'tes'}, sync=True)
+    wal.join(5)
+    assert not wal.is_alive()
+    # log tidak ditulis lagi, record berikutnya langsung ditolak
+    with pytest.raises(WALError):
+        wal.append({'op': 'tes'})
+
+
+def test_gagal_tulis_dibalas_error(buat_chat, masuk):
+    chats = buat_chat(wal=True)
+    messi = masuk(chats, 'messi')
+    chats.wal.file = DiskPenuh()
+    hasil = chats.proses("send {} henderson halo\r\n".format(messi))
+    assert hasil == {'status': 'ERROR', 'message': 'Gagal Menyimpan Data'}
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from os.path import join
+
+# batas satu potongan setelah di-decode; file besar dikirim dalam banyak upload-chunk
+UPLOAD_CHUNK_MAX = int(os.getenv("UPLOAD_CHUNK_MAX") or str(4 * 1024 * 1024))
+# upload yang tidak disentuh selama ini (detik) dibuang beserta file sementaranya
+UPLOAD_TTL = float(os.getenv("UPLOAD_TTL") or str(24 * 3600))
+
+
+class UploadError(Exception):
+    def __init__(self, message, **extra):
+        Exception.__init__(self, message)
+        self.hasil = dict({'status': 'ERROR', 'message': message}, **extra)
+
+
+class Upload:
+    FIELDS = ('upload_id', 'username', 'mode', 'tujuan', 'filename', 'size', 'checksum')
+
+    def __init__(self, upload_id, username, mode, tujuan, filename, size, checksum, path):
+        self.upload_id = upload_id
+        self.username = username
+        # mode 'user' atau 'group', tujuan = username atau nama group
+        self.mode = mode
+        self.tujuan = tujuan
+        self.filename = filename
+        self.size = size
+        self.checksum = checksum
+        self.path = path
+        self.received = 0
+        # sha256 dihitung sambil potongan ditulis, jadi commit tidak perlu membaca ulang file.
+        # None = upload dipulihkan dari disk, hash dihitung ulang dari .part saat dibutuhkan
+        self.hash = hashlib.sha256()
+        self.lock = threading.Lock()
+
+    def meta(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def sha256(self):
+        if self.hash is None:
+            self.hash = hashlib.sha256()
+            with open(self.path, 'rb') as fh:
+                for potongan in iter(lambda: fh.read(1024 * 1024), b''):
+                    self.hash.update(potongan)
+        return self.hash
+
+
+class UploadManager:
+    # Upload file bertahap: isi file langsung ditulis ke file sementara per potongan,
+    # sehingga memori server tetap kecil berapa pun ukuran file dan koneksi bisa menjalankan
+    # command lain di sela potongan. Setiap upload punya <id>.json (tujuan, ukuran, checksum)
+    # dan <id>.part; byte yang sudah diterima = panjang .part, jadi upload bisa dilanjutkan
+    # dari koneksi lain atau setelah server restart.
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.muat()
+
+    def muat(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(join(self.directory, name), 'rb') as fh:
+                    meta = json.load(fh)
+                upload = Upload(path=join(self.directory, meta['upload_id'] + '.part'), **meta)
+                upload.received = os.path.getsize(upload.path)
+            except (OSError, ValueError, KeyError, TypeError):
+                logging.warning("UPLOAD: metadata {} rusak, diabaikan".format(name))
+                continue
+            upload.hash = None
+            self.uploads[upload.upload_id] = upload
+        if self.uploads:
+            logging.warning("UPLOAD: {} upload belum selesai dipulihkan".format(len(self.uploads)))
+
+    def begin(self, username, mode, tujuan, filename, size, checksum):
+        if mode not in ('user', 'group'):
+            raise UploadError('Mode Upload Tidak Dikenal')
+        if size < 0:
+            raise UploadError('Ukuran Tidak Valid')
+        self.bersihkan()
+        upload_id = uuid.uuid4().hex
+        upload = Upload(upload_id, username, mode, tujuan, filename, size, checksum.lower(),
+                        join(self.directory, upload_id + '.part'))
+        open(upload.path, 'wb').close()
+        tmp = join(self.directory, upload_id + '.json.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump(upload.meta(), fh)
+        os.replace(tmp, join(self.directory, upload_id + '.json'))
+        with self.lock:
+            self.uploads[upload_id] = upload
+        return upload
+
+    def get(self, upload_id, username):
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.username != username:
+            raise UploadError('Upload Tidak Ditemukan')
+        return upload
+
+    def chunk(self, upload_id, username, offset, data):
+        upload = self.get(upload_id, username)
+        if len(data) > UPLOAD_CHUNK_MAX:
+            raise UploadError('Potongan Terlalu Besar', max=UPLOAD_CHUNK_MAX)
+        with upload.lock:
+            # potongan harus berurutan; offset yang diharapkan dikirim balik agar client bisa menyesuaikan
+            if offset != upload.received:
+                raise UploadError('Offset Tidak Sesuai', offset=upload.received)
+            if upload.received + len(data) > upload.size:
+                raise UploadError('Ukuran Melebihi Yang Diumumkan', offset=upload.received)
+            hasher = upload.sha256()
+            with open(upload.path, 'ab') as fh:
+                fh.write(data)
+            hasher.update(data)
+            upload.received += len(data)
+            return upload.received
+
+    def commit(self, upload_id, username):
+        # upload yang lengkap dan checksum-nya cocok dilepas dari daftar; file sementara jadi milik pemanggil
+        upload = self.get(upload_id, username)
+        with upload.lock:
+            if upload.received != upload.size:
+                raise UploadError('Upload Belum Lengkap', offset=upload.received)
+            blob_id = upload.sha256().hexdigest()
+            if blob_id != upload.checksum:
+                self.buang(upload)
+                raise UploadError('Checksum Tidak Sesuai')
+            with self.lock:
+                self.uploads.pop(upload_id, None)
+            self.hapus(upload_id + '.json')
+        return upload, blob_id
+
+    def buang(self, upload):
+        with self.lock:
+            self.uploads.pop(upload.upload_id, None)
+        self.hapus(upload.upload_id + '.part')
+        self.hapus(upload.upload_id + '.json')
+
+    def hapus(self, name):
+        try:
+            os.remove(join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def bersihkan(self):
+        # upload yang ditinggalkan terlalu lama (dilihat dari waktu tulis .part terakhir)
+        batas = time.time() - UPLOAD_TTL
+        for upload in list(self.uploads.values()):
+            try:
+                basi = os.path.getmtime(upload.path) < batas
+            except OSError:
+                basi = True
+            if basi:
+                logging.warning("UPLOAD: {} kedaluwarsa, dibuang".format(upload.upload_id))
+                self.buang(upload)
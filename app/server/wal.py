@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import threading
+import time
+from os.path import join
+
+
+class WALError(Exception):
+    pass
+
+
+class WriteAheadLog(threading.Thread):
+    # Log append-only, satu record JSON per baris. Handler hanya menaruh record di antrian;
+    # thread ini menulis sekumpulan record lalu satu kali fsync (group commit), sehingga
+    # banyak pesan berbagi biaya fsync yang sama. Setiap snapshot_every record, state penuh
+    # ditulis ke snapshot dan log dikosongkan agar replay saat startup tetap cepat.
+    def __init__(self, directory, state_fn, flush_interval=0.005, snapshot_every=10000):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = join(directory, 'chat.wal')
+        self.snapshot_path = join(directory, 'chat.snapshot')
+        self.state_fn = state_fn
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.cond = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.durable = 0
+        self.since_snapshot = 0
+        self.file = None
+        # diisi bila write/fsync gagal; sejak itu log berhenti ditulis dan append/wait_durable gagal
+        self.error = None
+        threading.Thread.__init__(self, daemon=True)
+
+    def load(self):
+        # (snapshot, daftar record setelah snapshot); record boleh tumpang tindih dengan snapshot,
+        # pemanggil yang memastikan replay idempoten
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as fh:
+                snapshot = json.load(fh)
+        records = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as fh:
+                for line in fh:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # baris terakhir yang terpotong karena crash di tengah penulisan
+                        logging.warning("WAL: record rusak diabaikan")
+                        break
+        self.since_snapshot = len(records)
+        return snapshot, records
+
+    def start(self):
+        self.file = open(self.log_path, 'ab')
+        threading.Thread.start(self)
+
+    def append(self, record, sync=False):
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        with self.cond:
+            if self.error is not None:
+                raise WALError(self.error)
+            self.pending.append(line)
+            self.appended += 1
+            nomor = self.appended
+            self.cond.notify_all()
+        if sync:
+            self.wait_durable(nomor)
+        return nomor
+
+    def wait_durable(self, nomor):
+        with self.cond:
+            while self.durable < nomor:
+                if self.error is not None:
+                    raise WALError(self.error)
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # beri waktu sebentar agar record lain ikut dalam batch yang sama
+            time.sleep(self.flush_interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+                target = self.appended
+            try:
+                self.file.write(b''.join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.since_snapshot += len(batch)
+                with self.cond:
+                    self.durable = target
+                    self.cond.notify_all()
+                if self.since_snapshot >= self.snapshot_every:
+                    self.snapshot()
+            except Exception:
+                # disk penuh/EIO: setelah fsync gagal isi file tidak bisa dipercaya, jadi log tidak dicoba
+                # ditulis lagi. Handler yang menunggu record ini dibangunkan dan membalas error
+                logging.exception("WAL: gagal menulis log, perubahan berikutnya tidak disimpan")
+                with self.cond:
+                    self.error = 'Gagal Menyimpan Data'
+                    self.pending = []
+                    self.cond.notify_all()
+                return
+
+    def snapshot(self):
+        state = self.state_fn()
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(json.dumps(state).encode())
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self.file.close()
+        self.file = open(self.log_path, 'wb')
+        self.since_snapshot = 0
+        logging.warning("WAL: snapshot ditulis, log dikosongkan")